@@ -0,0 +1,219 @@
+import operator, re
+from misc_functions import getKey
+
+# Spelling variants which are normalized before comparing names (e.g. "sulphate" --> "sulfate")
+SPELLING_VARIANTS = [("sulph", "sulf"), ("aluminium", "aluminum"), ("caesium", "cesium")]
+
+# Chemical suffixes which change the meaning of a name (e.g. sulfite and sulfate are different compounds)
+CHEMICAL_SUFFIXES = ["ite", "ate", "ide", "ous", "ic"]
+
+# Pairs of names which must never be resolved to each other, and misspellings which must be (see checkAutoResolveRules)
+UNSAFE_PAIRS = [("sodium sulfite", "sodium sulfate"), ("sodium nitrite", "sodium nitrate"), ("sodium chlorite", "sodium chloride"),
+    ("potassium iodite", "potassium iodide"), ("sodium phosphite", "sodium phosphate"), ("sodium thiosulfite", "sodium thiosulfate"),
+    ("ferrous chloride", "ferric chloride"), ("sodium thiosulfate", "sodium sulfate"), ("methanol", "ethanol"),
+    ("cerium chloride", "cesium chloride"), ("sodium malate", "sodium maleate"), ("1-butanol", "1-butenol"),
+    ("sodium oxalate", "sodium oxamate")]
+SAFE_PAIRS = [("amonium sulfate", "ammonium sulfate"), ("sodium cloride", "sodium chloride"), ("sodium sulphate", "sodium sulfate"),
+    ("magnesium cloride", "magnesium chloride"), ("ammoniumsulfate", "ammonium sulfate"), ("ammmonium sulfate", "ammonium sulfate"),
+    ("magnesium cholride", "magnesium chloride")]
+
+# Number of candidates (by shared trigrams) which are scored by edit distance
+CANDIDATE_LIMIT = 12
+
+class AliasIndex:
+    """A character trigram index over the keys and values of a compound dictionary
+    Suggests canonical compound names for misspelled or unrecognized names.
+    Candidates are found by counting shared trigrams, and then ranked by edit distance"""
+
+    def __init__(self, compoundDictionary=None):
+        self.forms = [] # Normalized forms of the keys and values, indexed by form id
+        self.canonical = [] # Maps a form id to the canonical name (dictionary value) it refers to
+        self.formIds = {} # Maps a normalized form to its form id
+        self.trigrams = {} # Maps a trigram to a list of form ids
+        self.tokens = set() # Words of the canonical names, used to recognize names which are compounds of their own (see isTypoVariant)
+        if compoundDictionary != None:
+            for key, value in compoundDictionary.items():
+                self.addAlias(key, value)
+
+    def __len__(self):
+        return len(self.forms)
+
+    def addAlias(self, alias, canonicalName):
+        """Adds an alias (e.g. a dictionary key) and its canonical name to the index
+        The canonical name is also added as an alias of itself"""
+        self.tokens.update(getTokens(canonicalName))
+        for name in (alias, canonicalName):
+            form = normalizeName(name)
+            if form == "":
+                continue
+            if form in self.formIds:
+                self.canonical[self.formIds[form]] = canonicalName
+                continue
+            formId = len(self.forms)
+            self.forms.append(form)
+            self.canonical.append(canonicalName)
+            self.formIds[form] = formId
+            for trigram in getTrigrams(form):
+                if trigram in self.trigrams:
+                    self.trigrams[trigram].append(formId)
+                else:
+                    self.trigrams[trigram] = [formId]
+
+    def suggest(self, name, limit=5): # list
+        """Returns a list of up to limit (canonical name, similarity) tuples, most similar first
+        Similarity is 1 minus the edit distance divided by the length of the longer normalized name"""
+        form = normalizeName(name)
+        if form == "":
+            return []
+        if form in self.formIds:
+            return [(self.canonical[self.formIds[form]], 1.0)]
+
+        sharedCounts = {}
+        for trigram in getTrigrams(form):
+            for formId in self.trigrams.get(trigram, ()):
+                sharedCounts[formId] = sharedCounts.get(formId, 0) + 1
+        candidates = sorted(sharedCounts.items(), key=operator.itemgetter(1), reverse=True)[:CANDIDATE_LIMIT]
+
+        best = {} # Maps a canonical name to its best similarity
+        for formId, shared in candidates:
+            other = self.forms[formId]
+            longest = max(len(form), len(other))
+            distance = getEditDistance(form, other, maxDistance=longest // 3)
+            if distance == None:
+                continue
+            similarity = 1 - distance / longest
+            canonicalName = self.canonical[formId]
+            if similarity > best.get(canonicalName, 0):
+                best[canonicalName] = similarity
+
+        return sorted(best.items(), key=operator.itemgetter(1), reverse=True)[:limit]
+
+    def resolveAll(self, names, threshold=0.85, margin=0.05): # dictionary
+        """Takes a list of names and returns a dictionary mapping names to a (canonical name, similarity) tuple
+        Only names whose best suggestion has a similarity of at least threshold are included,
+        and only if the second best suggestion is at least margin less similar (so ambiguous names are left out)
+        Names which are not a typo of their best suggestion, or which are made of words of other canonical names
+        (see isTypoVariant), are never included"""
+        output = {}
+        for name in set(names):
+            suggestions = self.suggest(name, limit=2)
+            if suggestions == [] or suggestions[0][1] < threshold or not isTypoVariant(name, suggestions[0][0], self.tokens):
+                continue
+            if len(suggestions) > 1 and suggestions[0][1] - suggestions[1][1] < margin:
+                continue
+            output[name] = suggestions[0]
+        return output
+
+def normalizeName(name): # string
+    """Returns the form of a name used for comparisons: the dictionary key, with spelling variants replaced"""
+    form = getKey(name)
+    for variant, replacement in SPELLING_VARIANTS:
+        form = form.replace(variant, replacement)
+    return form
+
+def getTokens(name): # list
+    """Returns the lowercase words and numbers of a name, with spelling variants replaced"""
+    tokens = re.findall("[a-z0-9]+", name.lower())
+    for variant, replacement in SPELLING_VARIANTS:
+        tokens = [token.replace(variant, replacement) for token in tokens]
+    return tokens
+
+def getSuffix(token): # string
+    """Returns the chemical suffix a token ends with (see CHEMICAL_SUFFIXES), or "" if it has none"""
+    for suffix in CHEMICAL_SUFFIXES:
+        if token.endswith(suffix):
+            return suffix
+    return ""
+
+def isTypoVariant(name, canonicalName, knownTokens=None): # bool
+    """Returns True if name can only be a misspelling of canonicalName, so that it is safe to resolve it without asking
+    Every word must match exactly, except for one word of canonicalName which was mistyped in one of these ways (see getTypoPosition):
+    a missing letter (e.g. amonium), a doubled letter (e.g. ammmonium) or two swapped letters (e.g. cholride)
+    The mistake must be after the first letter and before the letter in front of a chemical suffix, since the end of a word
+    tells compounds apart (e.g. sulfite and sulfate, malate and maleate). Words with numbers must match exactly
+    If knownTokens is not None, names whose words all appear in knownTokens (the words of the dictionary values)
+    are plausible compound names on their own, and are never resolved"""
+    if normalizeName(name) == normalizeName(canonicalName):
+        return True
+    tokens, canonicalTokens = getTokens(name), getTokens(canonicalName)
+    if knownTokens != None and all(token in knownTokens for token in tokens):
+        return False
+    if len(tokens) != len(canonicalTokens):
+        return False
+    different = [(a, b) for a, b in zip(tokens, canonicalTokens) if a != b]
+    if len(different) != 1:
+        return False
+    a, b = different[0]
+    if len(b) < 4 or not a.isalpha() or not b.isalpha():
+        return False
+    position = getTypoPosition(a, b)
+    if position == None:
+        return False
+    return 0 < position[0] and position[1] < len(b) - len(getSuffix(b)) - (1 if getSuffix(b) != "" else 0)
+
+def getTypoPosition(typo, word): # tuple
+    """Returns the (first, last) positions in word changed by a single missing letter, doubled letter or swap of two adjacent
+    letters which turns word into typo, or None if typo is not such a misspelling of word"""
+    if len(typo) == len(word) - 1:
+        for i in range(len(word)):
+            if word[:i] + word[i+1:] == typo:
+                return (i, i)
+    elif len(typo) == len(word) + 1:
+        for i in range(1, len(typo)):
+            if typo[i] == typo[i-1] and typo[:i] + typo[i+1:] == word:
+                return (i - 1, i - 1)
+    elif len(typo) == len(word):
+        for i in range(len(word) - 1):
+            if typo[i] != word[i]:
+                if typo[i] == word[i+1] and typo[i+1] == word[i] and typo[i+2:] == word[i+2:]:
+                    return (i, i + 1)
+                return None
+    return None
+
+def checkAutoResolveRules(): # list
+    """Returns the pairs of UNSAFE_PAIRS which isTypoVariant accepts and the pairs of SAFE_PAIRS which it rejects
+    Unsafe pairs must be rejected by the shape of the mistake alone, and safe pairs accepted with the words of every pair as knownTokens
+    An empty list means that automatic resolution (see AliasIndex.resolveAll) is safe to use"""
+    knownTokens = {token for pair in UNSAFE_PAIRS for name in pair for token in getTokens(name)}
+    knownTokens.update(token for typo, name in SAFE_PAIRS for token in getTokens(name))
+    wrong = [(a, b) for a, b in UNSAFE_PAIRS if isTypoVariant(a, b) or isTypoVariant(b, a)]
+    wrong += [(a, b) for a, b in SAFE_PAIRS if not isTypoVariant(a, b, knownTokens)]
+    return wrong
+
+def getTrigrams(form): # set
+    """Returns the set of character trigrams of a normalized name, padded so that short names have trigrams too"""
+    padded = "^" + form + "$"
+    return {padded[i:i+3] for i in range(len(padded)-2)}
+
+def getEditDistance(a, b, maxDistance=None): # int
+    """Returns the Levenshtein distance between two strings
+    If maxDistance is not None, only cells within maxDistance of the diagonal are computed,
+    and None is returned as soon as the distance is known to be larger than maxDistance"""
+    if maxDistance == None:
+        maxDistance = max(len(a), len(b))
+    if abs(len(a) - len(b)) > maxDistance:
+        return None
+    tooFar = maxDistance + 1
+    previousRow = [j if j <= maxDistance else tooFar for j in range(len(b)+1)]
+    for i in range(1, len(a)+1):
+        start = max(1, i - maxDistance)
+        end = min(len(b), i + maxDistance)
+        currentRow = [tooFar] * (len(b)+1)
+        if start == 1:
+            currentRow[0] = i if i <= maxDistance else tooFar
+        characterA = a[i-1]
+        rowMinimum = currentRow[0]
+        for j in range(start, end+1):
+            cost = previousRow[j-1] + (characterA != b[j-1])
+            if previousRow[j] + 1 < cost:
+                cost = previousRow[j] + 1
+            if currentRow[j-1] + 1 < cost:
+                cost = currentRow[j-1] + 1
+            currentRow[j] = cost
+            if cost < rowMinimum:
+                rowMinimum = cost
+        if rowMinimum > maxDistance:
+            return None
+        previousRow = currentRow
+    distance = previousRow[-1]
+    return distance if distance <= maxDistance else None
@@ -0,0 +1,213 @@
+import os, json, hashlib, inspect
+from pathlib import Path
+from time import time, perf_counter
+import pdb_crystal_database as database
+from pdb_crystal_database import Structure, ExpansionTable, loadStructures, writeStructures, STRUCTURES_FILE, STRUCTURE_DIR
+from misc_functions import getKey
+
+ARTIFACT_DIR = STRUCTURE_DIR / "artifacts"
+MANIFEST_NAME = "artifacts.json"
+MANIFEST_VERSION = 1
+
+class Stage:
+    """A stage of the cached pipeline (see getStages)
+    A stage is up to date when its key is the key it was last run with and its output files are unchanged since then.
+    The key is a hash of the input files, the outputs of the upstream stages, and the source code of the functions it runs,
+    so editing a replacement list, the stage's code or anything upstream makes the stage run again.
+    Bump version to make a stage run again after a change the key can not see (e.g. in a library)"""
+
+    def __init__(self, name, upstream, inputFiles, code, outputFiles, run, load=None, version=1):
+        self.name = name
+        self.upstream = upstream # Names of the stages whose values run receives
+        self.inputFiles = inputFiles
+        self.code = code # Functions and classes whose source code is part of the key
+        self.outputFiles = outputFiles
+        self.run = run # run(*upstream values) writes the output files and returns the value of the stage
+        self.load = load # load() returns the value of the stage from its output files, if downstream stages need it
+        self.version = version
+
+    def getCodeHash(self): # string
+        sha = hashlib.sha256()
+        for code in self.code:
+            sha.update(inspect.getsource(code).encode())
+        return sha.hexdigest()
+
+def getStages(structureFile=STRUCTURES_FILE, artifactDir=ARTIFACT_DIR, processes=1): # list
+    """Returns the stages of the pipeline, in the order they run:
+    fetched (the structure file) --> parsed --> standardized --> sensible split --> frequency tables, csv and xml
+    The parsed and standardized structures are kept in artifactDir, so the structure file itself is never modified"""
+    parsedFile = Path(artifactDir) / "parsed.pkl"
+    standardizedFile = Path(artifactDir) / "standardized.pkl"
+
+    def parse(structureList): # list
+        database.parseAllDetails(structureList)
+        writeStructures(structureList, parsedFile)
+        return structureList
+
+    def standardize(structureList): # list
+        database.standardizeAllNames(structureList, processes=processes)
+        writeStructures(structureList, standardizedFile)
+        return structureList
+
+    def splitSensible(structureList): # list
+        sensibleStructures = database.exportSensibleStructures(structureList)
+        sensibleIds = {id(structure) for structure in sensibleStructures}
+        database.exportDetails(structureList, database.DETAILS_FILE)
+        database.exportDetails(database.getUnknowns(structureList), database.UNKNOWN_DETAILS_FILE)
+        database.exportDetails([s for s in structureList if id(s) not in sensibleIds], database.NON_SENSIBLE_DETAILS_FILE)
+        return sensibleStructures
+
+    def countFrequencies(structureList, sensibleStructures):
+        database.getCompoundFrequencies(sensibleStructures, database.COMPOUND_FREQUENCY_FILE, database.COMPOUND_FREQUENCY_CSV_FILE)
+        database.getCompoundFrequencies(structureList, database.UNKNOWN_FREQUENCY_FILE, database.UNKNOWN_FREQUENCY_CSV_FILE, mode="unknown")
+        database.getCompoundFrequencies(structureList, database.PENDING_FREQUENCY_FILE, database.PENDING_FREQUENCY_CSV_FILE, mode="pending")
+        database.getSetFrequencies(sensibleStructures, database.SET_FREQUENCY_FILE, database.SET_FREQUENCY_CSV_FILE)
+
+    return [
+        Stage("fetched", [], [structureFile], [], [], lambda: loadStructures(structureFile), lambda: loadStructures(structureFile)),
+        Stage("parsed", ["fetched"],
+            [database.LOWERCASE_REPLACEMENT_FILE, database.SENSITIVE_REPLACEMENT_FILE, database.STOP_WORDS_FILE, database.COMPOUND_DICTIONARY_FILE],
+            [Structure.parseDetails, database.parseAllDetails, database.isNumber, database.isConcentraton, database.isPercent,
+                database.isCompound, database.averageNumberString, database.wordReplacement, getKey],
+            [parsedFile], parse, lambda: loadStructures(parsedFile)),
+        Stage("standardized", ["parsed"], [database.COMPOUND_DICTIONARY_FILE, database.MIXTURES_FILE],
+            [Structure.standardizeNames, ExpansionTable, database.scaleConcentration, database.standardizeAllNames, database.standardizeChunk],
+            [standardizedFile, database.MISSING_COMPONENTS_FILE], standardize, lambda: loadStructures(standardizedFile)),
+        Stage("sensible", ["standardized"], [database.COMPOUND_DICTIONARY_FILE, database.UNKNOWN_LIST_FILE],
+            [database.getSensibleStructures, database.isSensible, database.exportSensibleStructures, database.getUnknowns,
+                Structure.hasUnknown, database.exportDetails, database.writeDetails],
+            [database.SENSIBLE_STRUCTURES_FILE, database.SENSIBLE_DETAILS_FILE, database.DETAILS_FILE, database.UNKNOWN_DETAILS_FILE,
+                database.NON_SENSIBLE_DETAILS_FILE], splitSensible, lambda: loadStructures(database.SENSIBLE_STRUCTURES_FILE)),
+        Stage("frequencies", ["standardized", "sensible"], [database.COMPOUND_DICTIONARY_FILE, database.UNKNOWN_LIST_FILE],
+            [database.getCompoundFrequencies, database.countCompoundFrequencies, database.writeCompoundFrequencies,
+                database.getSetFrequencies, database.countSetFrequencies, database.writeSetFrequencies],
+            [database.COMPOUND_FREQUENCY_FILE, database.COMPOUND_FREQUENCY_CSV_FILE, database.UNKNOWN_FREQUENCY_FILE,
+                database.UNKNOWN_FREQUENCY_CSV_FILE, database.PENDING_FREQUENCY_FILE, database.PENDING_FREQUENCY_CSV_FILE,
+                database.SET_FREQUENCY_FILE, database.SET_FREQUENCY_CSV_FILE], countFrequencies),
+        Stage("csv", ["sensible"], [], [database.exportCsv, database.writeCsvRows], [database.CSV_FILE],
+            lambda sensibleStructures: database.exportCsv(sensibleStructures, database.CSV_FILE)),
+        Stage("xml", ["sensible"], [],
+            [database.exportXml, database.writeXmlStart, database.writeXmlStructures, database.writeXmlEnd, Structure.getXml], [database.XML_FILE],
+            lambda sensibleStructures: database.exportXml(sensibleStructures, database.XML_FILE)),
+    ]
+
+class ArtifactCache:
+    """Remembers the key and output hashes of every stage which has run (in artifactDir/artifacts.json)
+    File hashes are cached by size and modification time, so unchanged files (e.g. a large structure file) are only hashed once"""
+
+    def __init__(self, artifactDir=ARTIFACT_DIR):
+        self.artifactDir = Path(artifactDir)
+        if not os.path.exists(self.artifactDir):
+            os.makedirs(self.artifactDir)
+        self.manifestFile = self.artifactDir / MANIFEST_NAME
+        self.stages = {} # Maps a stage name to {"key", "outputs" (file --> hash), "outputHash", "seconds", "created"}
+        self.files = {} # Maps a file to [size, modification time in ns, sha256]
+        if self.manifestFile.exists():
+            with open(self.manifestFile) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.stages = manifest["stages"]
+                self.files = manifest["files"]
+
+    def save(self):
+        temporaryFile = str(self.manifestFile) + ".tmp"
+        with open(temporaryFile, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "stages": self.stages, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(temporaryFile, self.manifestFile)
+
+    def getFileHash(self, fileName): # string
+        """Returns the sha256 hash of a file, or None if it does not exist
+        A directory (e.g. a .shards structure directory) is hashed from the names and hashes of the files in it"""
+        path = Path(fileName)
+        if path.is_dir():
+            sha = hashlib.sha256()
+            for child in sorted(path.rglob("*")):
+                if child.is_file():
+                    sha.update("{} {}\n".format(child.relative_to(path).as_posix(), self.getFileHash(child)).encode())
+            return sha.hexdigest()
+        try:
+            status = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self.files.get(str(path))
+        if cached != None and cached[0] == status.st_size and cached[1] == status.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        self.files[str(path)] = [status.st_size, status.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def getKey(self, stage, upstreamHashes): # string
+        inputs = {"stage": stage.name, "version": stage.version, "code": stage.getCodeHash(), "upstream": upstreamHashes,
+            "inputs": {str(fileName): self.getFileHash(fileName) for fileName in stage.inputFiles}}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def getOutputHashes(self, stage): # dictionary
+        return {str(fileName): self.getFileHash(fileName) for fileName in stage.outputFiles}
+
+    def isUpToDate(self, stage, key): # boolean
+        """Returns True if a stage last ran with the same key, and none of its output files were deleted or changed since"""
+        entry = self.stages.get(stage.name)
+        return entry != None and entry["key"] == key and entry["outputs"] == self.getOutputHashes(stage)
+
+    def record(self, stage, key, seconds):
+        outputs = self.getOutputHashes(stage)
+        self.stages[stage.name] = {"key": key, "outputs": outputs, "outputHash": getOutputHash(key, outputs), "seconds": seconds,
+            "created": time()}
+        self.save()
+
+def getOutputHash(key, outputs): # string
+    """Returns the hash downstream stages see for a stage: its key if it has no output files (so it only depends on its inputs),
+    otherwise the hash of its outputs, so a stage which runs again and writes the same files does not make downstream stages run"""
+    if outputs == {}:
+        return key
+    return hashlib.sha256(json.dumps(outputs, sort_keys=True).encode()).hexdigest()
+
+def runCachedPipeline(structureFile=STRUCTURES_FILE, artifactDir=ARTIFACT_DIR, force=[], processes=1, dryRun=False): # dictionary
+    """Runs the stages of the pipeline (see getStages), skipping the ones which are up to date
+    A stage runs if its key or output files changed, so only the stages downstream of a change are recomputed
+    Stages named in force always run. If dryRun is True, nothing runs and the stages which would run are printed
+    Returns a dictionary mapping every stage name to "skipped", "ran" or (for a dry run) "stale" """
+    start = perf_counter()
+    cache = ArtifactCache(artifactDir)
+    if not dryRun:
+        database.updateMiscDictionaries() # standardizeAllNames rewrites the dictionaries, so hash them as they will be
+    stages = getStages(structureFile, artifactDir, processes)
+    stageDictionary = {stage.name: stage for stage in stages}
+    values = {} # Values of the stages which ran or were loaded
+    outputHashes = {}
+    status = {}
+    for stage in stages:
+        if any(status[name] == "stale" for name in stage.upstream):
+            status[stage.name] = "stale" # Its key depends on outputs which do not exist yet
+            continue
+        key = cache.getKey(stage, {name: outputHashes[name] for name in stage.upstream})
+        if stage.name not in force and cache.isUpToDate(stage, key):
+            status[stage.name] = "skipped"
+            outputHashes[stage.name] = cache.stages[stage.name]["outputHash"]
+            print("Stage {} is up to date".format(stage.name))
+            continue
+        if dryRun:
+            status[stage.name] = "stale"
+            print("Stage {} would run".format(stage.name))
+            continue
+        print("Running stage {}...".format(stage.name))
+        for name in stage.upstream:
+            if name not in values:
+                values[name] = stageDictionary[name].load()
+        stageStart = perf_counter()
+        values[stage.name] = stage.run(*[values[name] for name in stage.upstream])
+        cache.record(stage, key, perf_counter() - stageStart)
+        status[stage.name] = "ran"
+        outputHashes[stage.name] = cache.stages[stage.name]["outputHash"]
+    cache.save()
+    print("Ran {} of {} stages in {:.1f} s".format(list(status.values()).count("ran"), len(stages), perf_counter() - start))
+    return status
+
+if __name__ == "__main__":
+    # Replaces the parse, standardize and export steps of pdb_crystal_database.py: only the stages which changed are run again
+    runCachedPipeline(STRUCTURES_FILE)
+    # runCachedPipeline(STRUCTURES_FILE, dryRun=True) # Print which stages would run
+    # runCachedPipeline(STRUCTURES_FILE, force=["parsed"]) # Reparse everything
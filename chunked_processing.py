@@ -0,0 +1,225 @@
+import os, sys, csv, itertools, resource
+from pathlib import Path
+from time import perf_counter
+import pdb_crystal_database as database
+from profiling import profiled
+from pdb_crystal_database import (writeStructures, updateMiscDictionaries, getExpansionTable, importNLTK, isSensible, writeDetails,
+    countCompoundFrequencies, writeCompoundFrequencies, countSetFrequencies, writeSetFrequencies, writeCsvRows, writeXmlStart,
+    writeXmlStructures, writeXmlEnd, addMissingCounts, writeMissingComponents, loadStructures, STRUCTURES_FILE, STRUCTURE_DIR,
+    SENSIBLE_STRUCTURES_FILE, CSV_FILE, XML_FILE, DETAILS_FILE, SENSIBLE_DETAILS_FILE, NON_SENSIBLE_DETAILS_FILE, UNKNOWN_DETAILS_FILE,
+    COMPOUND_FREQUENCY_FILE, UNKNOWN_FREQUENCY_FILE, PENDING_FREQUENCY_FILE, SET_FREQUENCY_FILE, COMPOUND_FREQUENCY_CSV_FILE,
+    UNKNOWN_FREQUENCY_CSV_FILE, PENDING_FREQUENCY_CSV_FILE, SET_FREQUENCY_CSV_FILE, MISSING_COMPONENTS_FILE)
+
+# The sensible structures are written as a snapshot, which can be written one structure at a time (see snapshot.py)
+# They can also be copied to the pickle file written by the in-memory pipeline (SENSIBLE_STRUCTURES_FILE), which loads them all at once
+SENSIBLE_SNAPSHOT_FILE = STRUCTURE_DIR / "sensible_structures.snapshot"
+
+CHUNK_SIZE = 5000 # Structures held in memory at once
+
+def iterStructureChunks(structureFile=STRUCTURES_FILE, chunkSize=CHUNK_SIZE): # generator
+    """Yields the structures of a structure file as lists of at most chunkSize structures, in the order of the file
+    SQLite databases and snapshots are read one chunk at a time. A pickle file can only be loaded whole,
+    so it is loaded and then split into chunks (memory use is not bounded in that case)"""
+    from sqlite_database import isSqliteFile, connect, readStructures
+    if isSqliteFile(structureFile):
+        if not Path(structureFile).exists():
+            raise FileNotFoundError(2, "No such file or directory", str(structureFile))
+        connection = connect(structureFile)
+        try:
+            lastRowid = 0
+            while True:
+                rowids = [row[0] for row in connection.execute("SELECT rowid FROM structures WHERE rowid > ? ORDER BY rowid LIMIT ?", (lastRowid, chunkSize))]
+                if rowids == []:
+                    return
+                yield readStructures(connection, "WHERE rowid > ? AND rowid <= ?", (lastRowid, rowids[-1]))
+                lastRowid = rowids[-1]
+        finally:
+            connection.close()
+    elif Path(structureFile).suffix == ".snapshot":
+        from snapshot import SnapshotReader
+        with SnapshotReader(structureFile) as reader:
+            structures = reader.iterStructures()
+            while True:
+                chunk = list(itertools.islice(structures, chunkSize))
+                if chunk == []:
+                    return
+                yield chunk
+    else:
+        print("WARNING: {} is a pickle file, which has to be loaded whole. Use a database or snapshot to bound memory use".format(structureFile))
+        structureList = loadStructures(structureFile)
+        for i in range(0, len(structureList), chunkSize):
+            yield structureList[i:i+chunkSize]
+
+class ChunkedStructureWriter:
+    """Writes structures to a structure file one chunk at a time
+    The structures are written to a temporary file which replaces structureFile when the writer is closed,
+    so structureFile can be the file the chunks are being read from.
+    A pickle file can only be written whole, so its structures are kept in memory until the writer is closed"""
+
+    def __init__(self, structureFile):
+        from sqlite_database import isSqliteFile, connect
+        self.structureFile = structureFile
+        self.count = 0
+        self.connection = None
+        self.snapshotWriter = None
+        self.structureList = None
+        if isSqliteFile(structureFile):
+            self.temporaryFile = str(structureFile) + ".tmp"
+            removeDatabase(self.temporaryFile)
+            self.connection = connect(self.temporaryFile)
+        elif Path(structureFile).suffix == ".snapshot":
+            from snapshot import SnapshotWriter
+            self.snapshotWriter = SnapshotWriter(structureFile)
+        else:
+            self.structureList = []
+
+    def addStructures(self, structureList):
+        from sqlite_database import insertStructures
+        if self.connection != None:
+            with self.connection:
+                insertStructures(self.connection, structureList)
+        elif self.snapshotWriter != None:
+            self.snapshotWriter.addStructures(structureList)
+        else:
+            self.structureList.extend(structureList)
+        self.count += len(structureList)
+
+    def close(self):
+        if self.connection != None:
+            self.connection.close()
+            removeDatabase(self.structureFile)
+            os.replace(self.temporaryFile, self.structureFile)
+        elif self.snapshotWriter != None:
+            self.snapshotWriter.close()
+        else:
+            writeStructures(self.structureList, self.structureFile)
+
+def removeDatabase(databaseFile):
+    """Removes a SQLite database and its write-ahead log files, if they exist"""
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(str(databaseFile) + suffix):
+            os.remove(str(databaseFile) + suffix)
+
+class ChunkedExporter:
+    """Writes the output files of exportOutputFiles one chunk of structures at a time
+    Details, xml and csv files are appended to as each chunk arrives, and the frequency counters are kept
+    for the whole database and written when the exporter is closed. The files are the same as the ones
+    written by exportOutputFiles for the whole structure list
+    The sensible structures are written to sensibleFile one chunk at a time. If sensiblePickleFile is not None, they are also
+    written to it when the exporter is closed, which loads every sensible structure at once"""
+
+    def __init__(self, sensibleFile=SENSIBLE_SNAPSHOT_FILE, sensiblePickleFile=None):
+        self.dictionaryValues = set(database.compoundDictionary.values())
+        self.sensibleFile = sensibleFile
+        self.sensiblePickleFile = sensiblePickleFile
+        self.sensibleWriter = ChunkedStructureWriter(sensibleFile)
+        self.detailsFile = open(DETAILS_FILE, "w")
+        self.sensibleDetailsFile = open(SENSIBLE_DETAILS_FILE, "w")
+        self.unknownDetailsFile = open(UNKNOWN_DETAILS_FILE, "w")
+        self.nonsensibleDetailsFile = open(NON_SENSIBLE_DETAILS_FILE, "w")
+        self.xmlFile = open(XML_FILE, "w")
+        self.csvFile = open(CSV_FILE, "w", newline="")
+        self.csvWriter = csv.writer(self.csvFile, dialect='excel-tab', delimiter="\t")
+        self.compoundFrequency = {"Total Compounds": 0}
+        self.unknownFrequency = {"Total Compounds": 0}
+        self.pendingFrequency = {"Total Compounds": 0}
+        self.setFrequency = {}
+        self.count = 0
+        self.sensibleCount = 0
+
+    def addStructures(self, structureList):
+        sensibleStructures = []
+        nonsensibleStructures = []
+        for structure in structureList:
+            if isSensible(structure, self.dictionaryValues):
+                sensibleStructures.append(structure)
+            else:
+                nonsensibleStructures.append(structure)
+        if sensibleStructures != [] and self.sensibleCount == 0:
+            writeXmlStart(self.xmlFile)
+
+        self.sensibleWriter.addStructures(sensibleStructures)
+        writeDetails(sensibleStructures, self.sensibleDetailsFile)
+        writeDetails(structureList, self.detailsFile)
+        writeDetails([structure for structure in structureList if structure.hasUnknown()], self.unknownDetailsFile)
+        writeDetails(nonsensibleStructures, self.nonsensibleDetailsFile)
+        countCompoundFrequencies(sensibleStructures, "recognized", self.compoundFrequency)
+        countCompoundFrequencies(structureList, "unknown", self.unknownFrequency)
+        countCompoundFrequencies(structureList, "pending", self.pendingFrequency)
+        countSetFrequencies(sensibleStructures, self.setFrequency)
+        writeXmlStructures(sensibleStructures, self.xmlFile)
+        writeCsvRows(sensibleStructures, self.csvWriter)
+        self.count += len(structureList)
+        self.sensibleCount += len(sensibleStructures)
+
+    def close(self):
+        """Writes the frequency files and closes the output files"""
+        print("Retrieved {} sensible structures".format(self.sensibleCount))
+        self.sensibleWriter.close()
+        if self.sensiblePickleFile != None and Path(self.sensiblePickleFile) != Path(self.sensibleFile):
+            writeStructures(loadStructures(self.sensibleFile), self.sensiblePickleFile)
+        if self.sensibleCount == 0:
+            writeXmlStart(self.xmlFile, False)
+        writeXmlEnd(self.xmlFile, self.sensibleCount > 0)
+        for f in [self.detailsFile, self.sensibleDetailsFile, self.unknownDetailsFile, self.nonsensibleDetailsFile, self.xmlFile, self.csvFile]:
+            f.close()
+        writeCompoundFrequencies(self.compoundFrequency, COMPOUND_FREQUENCY_FILE, COMPOUND_FREQUENCY_CSV_FILE)
+        writeCompoundFrequencies(self.unknownFrequency, UNKNOWN_FREQUENCY_FILE, UNKNOWN_FREQUENCY_CSV_FILE)
+        writeCompoundFrequencies(self.pendingFrequency, PENDING_FREQUENCY_FILE, PENDING_FREQUENCY_CSV_FILE)
+        writeSetFrequencies(self.setFrequency, SET_FREQUENCY_FILE, SET_FREQUENCY_CSV_FILE)
+
+@profiled
+def processInChunks(structureFile=STRUCTURES_FILE, chunkSize=CHUNK_SIZE, parse=True, standardize=True, outputFile=None,
+        sensibleFile=SENSIBLE_SNAPSHOT_FILE, sensiblePickleFile=None, missingFile=MISSING_COMPONENTS_FILE): # ChunkedExporter
+    """Runs the whole pipeline (parseAllDetails, standardizeAllNames and exportOutputFiles) on a structure file
+    one chunk of chunkSize structures at a time, so memory use depends on the chunk size instead of the size of the database
+    The output files are the same as the ones written by the in-memory pipeline
+    If parse or standardize is True, the processed structures are written to outputFile (structureFile by default)
+    Works best with a SQLite database or a snapshot, since a pickle file must be loaded whole
+    The sensible structures are written to sensibleFile. To also write the pickle file of the in-memory pipeline, pass
+    sensiblePickleFile=SENSIBLE_STRUCTURES_FILE, which loads every sensible structure at once (memory use is then not bounded)
+    Returns the ChunkedExporter, which holds the compound, unknown, pending and set frequencies"""
+    if parse and 'nltk' not in sys.modules:
+        importNLTK()
+    if standardize:
+        updateMiscDictionaries() # Also calls updateDictionary
+        table = getExpansionTable()
+    if outputFile == None and (parse or standardize):
+        outputFile = structureFile
+    print("Processing {} in chunks of {} structures...".format(structureFile, chunkSize))
+
+    start = perf_counter()
+    structureWriter = ChunkedStructureWriter(outputFile) if outputFile != None else None
+    exporter = ChunkedExporter(sensibleFile, sensiblePickleFile)
+    missingCounts = {}
+    for chunk in iterStructureChunks(structureFile, chunkSize):
+        for structure in chunk:
+            if parse:
+                try:
+                    structure.parseDetails()
+                except Exception as e:
+                    structure.printError("Unable to parse details", e)
+            if standardize:
+                try:
+                    addMissingCounts(missingCounts, structure.standardizeNames(table))
+                except Exception as e:
+                    structure.printError("Unable to standardize compound names", e)
+        if structureWriter != None:
+            structureWriter.addStructures(chunk)
+        exporter.addStructures(chunk)
+        print("Processed {} structures ({:.0f} structures/s)...".format(exporter.count, exporter.count / (perf_counter() - start)))
+    exporter.close()
+    if structureWriter != None:
+        print("Writing to structure file {}...".format(outputFile))
+        structureWriter.close()
+    if standardize:
+        writeMissingComponents(missingCounts, missingFile)
+    print("Processed {} structures in {:.1f} s. Peak memory: {:.0f} MB".format(exporter.count, perf_counter() - start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    return exporter
+
+if __name__ == "__main__":
+    # Convert the pickle file once, so it can be read one chunk at a time (see sqlite_database.py or snapshot.py)
+    # from snapshot import convertPickleToSnapshot
+    # convertPickleToSnapshot(STRUCTURES_FILE, STRUCTURE_DIR / "structures.snapshot")
+    processInChunks(STRUCTURE_DIR / "structures.snapshot", chunkSize=CHUNK_SIZE)
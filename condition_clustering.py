@@ -0,0 +1,292 @@
+import csv, math, random, statistics
+from bisect import bisect
+from itertools import accumulate
+from time import perf_counter
+import pdb_crystal_database as database
+from pdb_crystal_database import getSensibleStructures, loadStructures, parseConcentration, SENSIBLE_STRUCTURES_FILE, OUTPUT_DIR
+
+CLUSTER_FILE = OUTPUT_DIR / "condition_clusters.txt"
+CLUSTER_CSV_FILE = OUTPUT_DIR / "condition_clusters.csv"
+
+# Weights of the parts of a condition vector
+CLASS_WEIGHT = 0.5 # Classes of the compounds (see classification_dictionary.json), so similar compounds pull conditions together
+PH_WEIGHT = 0.5 # pH, scaled by PH_SCALE around pH 7
+PH_SCALE = 2.0
+
+# Concentrations are weighted by their log, so 100 mM and 200 mM are closer than 1 mM and 100 mM
+MAX_MILLIMOLAR = 4000.0
+MAX_PERCENT = 100.0
+UNKNOWN_CONCENTRATION_WEIGHT = 0.5
+
+COCKTAIL_FRACTION = 0.5 # A compound is part of the representative cocktail of a cluster if at least this fraction of the members have it
+
+def getConcentrationWeight(concentration): # float
+    """Returns a weight between 0 and 1 for a concentration string, growing with the log of the concentration"""
+    value, units = parseConcentration(concentration)
+    if value == None or value <= 0:
+        return UNKNOWN_CONCENTRATION_WEIGHT
+    maximum = MAX_MILLIMOLAR if units == "mM" else MAX_PERCENT
+    return min(math.log1p(value) / math.log1p(maximum), 1.0)
+
+def getConditionVector(structure, classificationDictionary): # dictionary
+    """Returns the sparse condition vector of a (standardized) structure, as a dictionary mapping features to values:
+    a feature for each compound (its concentration weight), for each class of its compounds (the summed weights of the compounds
+    in the class, times CLASS_WEIGHT) and for its pH (scaled distance from pH 7, left out if the pH is unknown)"""
+    vector = {}
+    for i in range(0, len(structure.compounds), 2):
+        compound = structure.compounds[i]
+        if compound in vector:
+            continue # Keep the first concentration of a compound which appears twice
+        weight = getConcentrationWeight(structure.compounds[i+1])
+        vector[compound] = weight
+        for compoundClass in getClasses(compound, classificationDictionary):
+            feature = "class:" + compoundClass
+            vector[feature] = vector.get(feature, 0.0) + weight * CLASS_WEIGHT
+    pH = getPH(structure)
+    if pH != None and pH != 7:
+        vector["pH"] = (pH - 7) / PH_SCALE * PH_WEIGHT
+    return vector
+
+def getClasses(compound, classificationDictionary): # list
+    """Returns the classes of a compound, flattening nested lists (the dictionary is edited by hand, e.g. [["Polymer"], "Additive"])"""
+    classes = []
+    for compoundClass in classificationDictionary.get(compound, []):
+        if isinstance(compoundClass, list):
+            classes.extend(compoundClass)
+        else:
+            classes.append(compoundClass)
+    return classes
+
+def getPH(structure): # float
+    try:
+        return float(structure.pH) if structure.pH != None else None
+    except (TypeError, ValueError):
+        return None
+
+def getSquaredNorm(vector): # float
+    return sum(value * value for value in vector.values())
+
+class SparseCentroid:
+    """A k-means centroid stored as scale * values, so moving it toward a sparse vector only touches the features of the vector
+    Its squared norm is updated along with it, so the distance to a vector only needs a sparse dot product"""
+
+    def __init__(self, vector):
+        self.values = dict(vector)
+        self.scale = 1.0
+        self.norm = getSquaredNorm(vector) # Squared norm
+        self.count = 1 # Vectors it has moved toward, counting the one it started at
+
+    def dot(self, vector): # float
+        values = self.values
+        return sum(value * values.get(feature, 0.0) for feature, value in vector.items()) * self.scale
+
+    def getDistance(self, vector, vectorNorm): # float
+        """Returns the squared distance to a vector with squared norm vectorNorm"""
+        return max(vectorNorm - 2 * self.dot(vector) + self.norm, 0.0)
+
+    def update(self, vector):
+        """Moves the centroid toward a vector with a learning rate of 1 / count (see MiniBatchKMeans)"""
+        self.count += 1
+        rate = 1.0 / self.count
+        self.scale *= 1 - rate
+        self.norm *= (1 - rate) ** 2
+        for feature, value in vector.items():
+            old = self.values.get(feature, 0.0) * self.scale
+            new = old + rate * value
+            self.values[feature] = new / self.scale
+            self.norm += new * new - old * old
+        if self.scale < 1e-6:
+            self.values = self.getVector()
+            self.scale = 1.0
+            self.norm = getSquaredNorm(self.values)
+
+    def getVector(self): # dictionary
+        return {feature: value * self.scale for feature, value in self.values.items()}
+
+class MiniBatchKMeans:
+    """Mini-batch k-means (Sculley, "Web-Scale K-Means Clustering", 2010) on sparse vectors
+    Each iteration assigns a random batch of vectors to their nearest centroids and moves each centroid toward its vectors
+    with a learning rate of 1 / (vectors it has seen), so the cost of an iteration does not depend on the number of vectors.
+    Vectors are weighted (e.g. by how many structures have the same condition), and the centroids start from k-means++"""
+
+    def __init__(self, k=50, batchSize=1000, iterations=100, seed=0):
+        self.k = k
+        self.batchSize = batchSize
+        self.iterations = iterations
+        self.random = random.Random(seed)
+        self.centroids = []
+
+    def fit(self, vectors, weights):
+        norms = [getSquaredNorm(vector) for vector in vectors]
+        cumulativeWeights = list(accumulate(weights))
+        def sample(count): # list
+            return [bisect(cumulativeWeights, self.random.random() * cumulativeWeights[-1]) for i in range(count)]
+        self.initialize(vectors, norms, sample(min(20 * self.k, 20 * len(vectors))))
+        for iteration in range(self.iterations):
+            batch = sample(self.batchSize)
+            # Assign the whole batch first, then update, as in the paper
+            assignments = [self.getNearest(vectors[i], norms[i])[0] for i in batch]
+            for i, cluster in zip(batch, assignments):
+                self.centroids[cluster].update(vectors[i])
+            if (iteration+1) % 20 == 0:
+                print("Finished iteration {} of {}...".format(iteration+1, self.iterations))
+
+    def initialize(self, vectors, norms, sample):
+        """Picks the starting centroids from a sample of the vectors with k-means++"""
+        distinct = list(dict.fromkeys(sample))
+        k = min(self.k, len(distinct))
+        first = self.random.choice(distinct)
+        self.centroids = [SparseCentroid(vectors[first])]
+        distances = [self.centroids[0].getDistance(vectors[i], norms[i]) for i in distinct]
+        while len(self.centroids) < k:
+            total = sum(distances)
+            if total == 0:
+                break # Every sampled vector is already a centroid
+            position = bisect(list(accumulate(distances)), self.random.random() * total)
+            centroid = SparseCentroid(vectors[distinct[min(position, len(distinct)-1)]])
+            self.centroids.append(centroid)
+            distances = [min(distance, centroid.getDistance(vectors[i], norms[i])) for distance, i in zip(distances, distinct)]
+
+    def getNearest(self, vector, vectorNorm): # tuple
+        """Returns (centroid number, squared distance) of the centroid nearest to a vector"""
+        best = 0
+        bestDistance = math.inf
+        for number, centroid in enumerate(self.centroids):
+            distance = centroid.getDistance(vector, vectorNorm)
+            if distance < bestDistance:
+                best = number
+                bestDistance = distance
+        return best, bestDistance
+
+class Cluster:
+    """A cluster of structures with similar crystallization conditions"""
+
+    def __init__(self, number, centroid):
+        self.number = number
+        self.centroid = centroid # Condition vector of the centroid (see getConditionVector)
+        self.members = [] # Structures in the cluster
+        self.medoid = None # The member nearest to the centroid
+        self.medoidDistance = math.inf
+        self.cocktail = [] # Representative cocktail: compounds followed by concentrations, like Structure.compounds
+        self.pH = None # Median pH of the members
+        self.classes = [] # Classes of the centroid, strongest first
+
+    def makeCocktail(self, fraction=COCKTAIL_FRACTION):
+        """Sets the representative cocktail: the compounds which at least fraction of the members have (at least the most common one),
+        each at the median concentration of the members in its most common units, and the median pH"""
+        concentrations = {} # Maps a compound to the concentration strings of the members which have it
+        for structure in self.members:
+            seen = set()
+            for i in range(0, len(structure.compounds), 2):
+                if structure.compounds[i] not in seen:
+                    seen.add(structure.compounds[i])
+                    concentrations.setdefault(structure.compounds[i], []).append(structure.compounds[i+1])
+        ranked = sorted(concentrations.items(), key=lambda item: len(item[1]), reverse=True)
+        self.cocktail = []
+        for position, (compound, values) in enumerate(ranked):
+            if position > 0 and len(values) < fraction * len(self.members):
+                break
+            self.cocktail.extend([compound, getMedianConcentration(values)])
+        pHs = [pH for pH in (getPH(structure) for structure in self.members) if pH != None]
+        self.pH = statistics.median(pHs) if pHs != [] else None
+        classes = [(feature[len("class:"):], value) for feature, value in self.centroid.items() if feature.startswith("class:")]
+        strongest = max([value for compoundClass, value in classes], default=0)
+        # Leave out classes which only a few members have
+        self.classes = [compoundClass for compoundClass, value in sorted(classes, key=lambda item: item[1], reverse=True) if value >= strongest / 4]
+
+def getMedianConcentration(concentrations): # string
+    """Returns the median of concentration strings, in their most common units, as a concentration string"""
+    values = {} # Maps units to values
+    for concentration in concentrations:
+        value, units = parseConcentration(concentration)
+        if value != None:
+            values.setdefault(units, []).append(value)
+    if values == {}:
+        return None
+    units, unitValues = max(values.items(), key=lambda item: len(item[1]))
+    median = statistics.median(unitValues)
+    return "{:g}".format(median) if units == "mM" else "{:g}{}".format(median, units)
+
+def clusterConditions(structureList=None, k=50, batchSize=1000, iterations=200, seed=0, textFilename=CLUSTER_FILE, csvFilename=CLUSTER_CSV_FILE): # list
+    """Clusters the conditions of the sensible structures into k clusters with mini-batch k-means,
+    and writes a representative cocktail (see Cluster.makeCocktail), the member count and the structure nearest to the centroid
+    of each cluster to textFilename and csvFilename (TAB-DELIMITED), largest cluster first
+    structureList is filtered with getSensibleStructures. If it is None, the sensible structure file is loaded instead
+    Structures with the same condition vector are clustered once, so the cost grows with the number of distinct conditions
+    Returns the list of clusters, largest first"""
+    start = perf_counter()
+    if structureList == None:
+        structureList = loadStructures(SENSIBLE_STRUCTURES_FILE)
+    structureList = getSensibleStructures(structureList)
+
+    print("Building condition vectors of {} structures...".format(len(structureList)))
+    vectorNumbers = {} # Maps a condition (sorted vector items) to its number in vectors
+    vectors = []
+    weights = []
+    structureVectors = [] # Vector number of each structure
+    for structure in structureList:
+        vector = getConditionVector(structure, database.classificationDictionary)
+        key = tuple(sorted(vector.items()))
+        number = vectorNumbers.get(key)
+        if number == None:
+            number = len(vectors)
+            vectorNumbers[key] = number
+            vectors.append(vector)
+            weights.append(0)
+        weights[number] += 1
+        structureVectors.append(number)
+    if vectors == []:
+        print("No sensible structures to cluster")
+        return []
+
+    print("Clustering {} distinct conditions into {} clusters...".format(len(vectors), k))
+    kMeans = MiniBatchKMeans(k, batchSize, iterations, seed)
+    kMeans.fit(vectors, weights)
+
+    print("Assigning structures to clusters...")
+    clusters = [Cluster(number, centroid.getVector()) for number, centroid in enumerate(kMeans.centroids)]
+    nearest = [kMeans.getNearest(vector, getSquaredNorm(vector)) for vector in vectors]
+    totalDistance = 0.0
+    for structure, number in zip(structureList, structureVectors):
+        cluster, distance = nearest[number]
+        cluster = clusters[cluster]
+        cluster.members.append(structure)
+        totalDistance += distance
+        if distance < cluster.medoidDistance:
+            cluster.medoid = structure
+            cluster.medoidDistance = distance
+    clusters = [cluster for cluster in clusters if cluster.members != []]
+    for cluster in clusters:
+        cluster.makeCocktail()
+    clusters.sort(key=lambda cluster: len(cluster.members), reverse=True)
+
+    writeClusters(clusters, textFilename, csvFilename)
+    print("Clustered {} structures into {} clusters in {:.1f} s (mean squared distance to centroid: {:.4f})".format(len(structureList),
+        len(clusters), perf_counter() - start, totalDistance / len(structureList)))
+    return clusters
+
+def writeClusters(clusters, textFilename=None, csvFilename=None):
+    """Exports clusters to a readable txt file and/or a TAB-DELIMITED csv file"""
+    if textFilename != None:
+        print("Exporting condition clusters to \"{}\"...".format(textFilename))
+        with open(textFilename, "w") as f:
+            for cluster in clusters:
+                f.write("Cluster {} ({} structures), pH {}, classes: {}\n".format(cluster.number, len(cluster.members), cluster.pH,
+                    ", ".join(cluster.classes[:4])))
+                for i in range(0, len(cluster.cocktail), 2):
+                    f.write("    {:50s} {}\n".format(cluster.cocktail[i], cluster.cocktail[i+1]))
+                f.write("    Nearest structure {}: {}\n\n".format(cluster.medoid.pdbid, cluster.medoid.details))
+
+    if csvFilename != None:
+        with open(csvFilename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, dialect='excel-tab', delimiter="\t")
+            writer.writerow(["cluster", "structures", "pH", "classes", "cocktail", "nearest pdbid", "nearest compounds"])
+            for cluster in clusters:
+                cocktail = ", ".join("{} {}".format(cluster.cocktail[i+1], cluster.cocktail[i]) for i in range(0, len(cluster.cocktail), 2))
+                writer.writerow([cluster.number, len(cluster.members), cluster.pH, ", ".join(cluster.classes), cocktail,
+                    cluster.medoid.pdbid, str(cluster.medoid.compounds)])
+
+if __name__ == "__main__":
+    # Run after exportOutputFiles, which writes the sensible structure file
+    clusterConditions(k=50)
+    # clusterConditions(loadStructures(database.STRUCTURES_FILE), k=200, iterations=500)
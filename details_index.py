@@ -0,0 +1,180 @@
+import pickle, re
+from pdb_crystal_database import loadStructures, STRUCTURES_FILE, STRUCTURE_DIR
+
+DETAILS_INDEX_FILE = STRUCTURE_DIR / "details_index.pkl"
+
+# Tokens are maximal runs of word characters, so that a token which is surrounded by
+# other characters in a query must also be a whole token in any details string that contains the query
+TOKEN_PATTERN = re.compile(r"\w+")
+
+class DetailsIndex:
+    """An inverted index over the (lowercased) crystallization details of a list of structures
+    Maps every token to the set of documents that contain it, which answers token, phrase
+    and substring queries by intersecting posting sets and only checking the remaining candidates"""
+
+    def __init__(self):
+        self.pdbids = [] # Maps a document id to a pdbid (None if the document was removed)
+        self.details = [] # Maps a document id to the lowercased details string
+        self.documentIds = {} # Maps a pdbid to its document id
+        self.postings = {} # Maps a token to a set of document ids
+
+    def __len__(self):
+        return len(self.documentIds)
+
+    def __contains__(self, pdbid):
+        return pdbid in self.documentIds
+
+    def addStructure(self, structure):
+        """Adds a structure to the index, or updates it if it is already indexed
+        Structures without details are removed from the index"""
+        if structure.details == None:
+            self.removeStructure(structure.pdbid)
+            return
+        details = structure.details.lower()
+        if structure.pdbid in self.documentIds:
+            documentId = self.documentIds[structure.pdbid]
+            if self.details[documentId] == details:
+                return # Nothing changed
+            self.removeStructure(structure.pdbid)
+
+        documentId = len(self.pdbids)
+        self.pdbids.append(structure.pdbid)
+        self.details.append(details)
+        self.documentIds[structure.pdbid] = documentId
+        for token in set(TOKEN_PATTERN.findall(details)):
+            if token in self.postings:
+                self.postings[token].add(documentId)
+            else:
+                self.postings[token] = {documentId}
+
+    def addStructures(self, structureList):
+        """Adds (or updates) every structure in a list"""
+        print("Indexing details of {} structures...".format(len(structureList)))
+        for structure in structureList:
+            self.addStructure(structure)
+
+    def removeStructure(self, pdbid):
+        """Removes a structure from the index, if it is indexed"""
+        documentId = self.documentIds.pop(pdbid, None)
+        if documentId == None:
+            return
+        for token in set(TOKEN_PATTERN.findall(self.details[documentId])):
+            documents = self.postings[token]
+            documents.discard(documentId)
+            if not documents:
+                del self.postings[token]
+        self.pdbids[documentId] = None
+        self.details[documentId] = None
+
+    def compact(self):
+        """Renumbers the documents without the slots of removed structures, so document ids do not grow without bound across updates"""
+        if len(self.documentIds) == len(self.pdbids):
+            return
+        newIds = {} # Maps an old document id to its new one
+        pdbids = []
+        details = []
+        for documentId, pdbid in enumerate(self.pdbids):
+            if pdbid != None:
+                newIds[documentId] = len(pdbids)
+                pdbids.append(pdbid)
+                details.append(self.details[documentId])
+        self.pdbids = pdbids
+        self.details = details
+        self.documentIds = {pdbid: documentId for documentId, pdbid in enumerate(pdbids)}
+        self.postings = {token: {newIds[d] for d in documents} for token, documents in self.postings.items()}
+
+    def getDocuments(self, tokenConditions): # set
+        """Takes a list of (token, condition) tuples and returns the set of documents which have a matching token for every tuple
+        condition is one of "exact", "prefix", "suffix" or "contains" and says how a document token must match the token"""
+        # Check exact tokens first, since they only need one lookup and are usually the most selective
+        tokenConditions = sorted(tokenConditions, key=lambda t: t[1] != "exact")
+        documents = None
+        for token, condition in tokenConditions:
+            if condition == "exact":
+                matches = self.postings.get(token, set())
+            else:
+                matches = set()
+                for indexedToken, tokenDocuments in self.postings.items():
+                    if ((condition == "prefix" and indexedToken.startswith(token)) or
+                        (condition == "suffix" and indexedToken.endswith(token)) or
+                        (condition == "contains" and token in indexedToken)):
+                        matches |= tokenDocuments
+            documents = set(matches) if documents == None else documents & matches
+            if not documents:
+                return set()
+        return documents if documents != None else set()
+
+    def searchTokens(self, tokens): # set
+        """Returns the set of pdbids whose details contain every token in a list (in any order)"""
+        documents = self.getDocuments([(token.lower(), "exact") for token in tokens])
+        return {self.pdbids[d] for d in documents}
+
+    def searchPhrase(self, phrase): # set
+        """Returns the set of pdbids whose details contain the tokens of phrase consecutively
+        (e.g. "peg 3350 mme" matches "PEG 3350 MME" and "peg-3350, mme", but not "peg3350 mme")"""
+        tokens = TOKEN_PATTERN.findall(phrase.lower())
+        if tokens == []:
+            return set()
+        output = set()
+        for d in self.getDocuments([(token, "exact") for token in tokens]):
+            documentTokens = TOKEN_PATTERN.findall(self.details[d])
+            for j in range(len(documentTokens)-len(tokens)+1):
+                if documentTokens[j:j+len(tokens)] == tokens:
+                    output.add(self.pdbids[d])
+                    break
+        return output
+
+    def searchSubstring(self, searchString): # set
+        """Returns the set of pdbids whose details contain searchString (ignoring case)
+        Gives the same result as checking searchString.lower() in structure.details.lower() for every structure"""
+        searchString = searchString.lower()
+        tokenConditions = []
+        for match in TOKEN_PATTERN.finditer(searchString):
+            # A token at the edge of the search string may only be part of a token in the details
+            openStart = match.start() == 0
+            openEnd = match.end() == len(searchString)
+            if openStart and openEnd:
+                condition = "contains"
+            elif openStart:
+                condition = "suffix"
+            elif openEnd:
+                condition = "prefix"
+            else:
+                condition = "exact"
+            tokenConditions.append((match.group(), condition))
+
+        if tokenConditions == []: # Only punctuation or whitespace, so every document is a candidate
+            documents = {d for d in self.documentIds.values()}
+        else:
+            documents = self.getDocuments(tokenConditions)
+        return {self.pdbids[d] for d in documents if searchString in self.details[d]}
+
+def buildDetailsIndex(structureList, indexFile=None): # DetailsIndex
+    """Builds a DetailsIndex from a list of structures
+    If indexFile is not None, the index is also saved to that file"""
+    index = DetailsIndex()
+    index.addStructures(structureList)
+    if indexFile != None:
+        writeDetailsIndex(index, indexFile)
+    return index
+
+def loadDetailsIndex(indexFile=DETAILS_INDEX_FILE): # DetailsIndex
+    """Returns a DetailsIndex from a pickle file"""
+    print("Loading details index from file {}...".format(indexFile))
+    with open(indexFile, "rb") as f:
+        return pickle.load(f)
+
+def writeDetailsIndex(index, indexFile=DETAILS_INDEX_FILE):
+    """Writes a DetailsIndex to a pickle file, compacting it first (see DetailsIndex.compact)"""
+    index.compact()
+    print("Writing details index to file {}...".format(indexFile))
+    with open(indexFile, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+if __name__ == "__main__":
+    structureList = loadStructures(STRUCTURES_FILE)
+    index = buildDetailsIndex(structureList, indexFile=DETAILS_INDEX_FILE)
+    # index = loadDetailsIndex(DETAILS_INDEX_FILE)
+    # print(index.searchPhrase("mother liquor"))
+    # print(index.searchSubstring("peg 3350 mme"))
+    # parseAllDetails(structureList, searchString="mother liquor", detailsIndex=index)
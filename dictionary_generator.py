@@ -1,6 +1,8 @@
-import json, csv, sys, pickle, collections, os
+import json, csv, sys, pickle, collections, os, heapq
+from time import time
 from misc_functions import loadJson, writeJson, printList, getKey, listToFile, fileToList
 from pdb_crystal_database import loadStructures, parseAllDetails, writeStructures, Structure
+from alias_index import AliasIndex, checkAutoResolveRules
 from pathlib import Path
 
 # Make sure directories exist
@@ -33,7 +35,8 @@ INPUT_ADD_STOP_WORD = "add" # Adds a single stop word to the stopWord list
 INPUT_PASS = "pass" # Skips the current compound, does nothing to it
 INPUT_UNDO = "u" # Undo - NOTE: undo is unreliable and should only be used for single dictionary changes
 # To undo a mistake safely, EXIT THE SCRIPT and make the change in the text/json files directly
-INPUT_SAVE = "save" # Save files - currently done automatically after every change
+INPUT_SAVE = "save" # Save files - also done automatically every SAVE_EVERY changes or SAVE_INTERVAL seconds
+INPUT_SUGGESTION = "#" # Use one of the suggested names, e.g. "#1" uses the first suggestion
 INPUT_QUIT = "quit" # Exit the script
 INPUT_QUIT_WITHOUT_SAVING = "quit no save" # Exit the script without saving files
 
@@ -57,8 +60,19 @@ except FileNotFoundError:
     print("The unknown list file specified ({}) was not found. A blank file will be created at the specified location".format(UNKNOWN_LIST_FILE))
     unknownList = []
 
+stopWordSet = set(stopWords) # Used for membership tests, stopWords keeps the order of the file
+unknownSet = set(unknownList) # Likewise for unknownList
+
 passList = [] # A temporary list to allow the user to temporarily skip a compound
 
+# Automatic saves are batched, since saveFiles rewrites every file
+SAVE_EVERY = 20 # Number of changes before the files are saved
+SAVE_INTERVAL = 60 # Number of seconds before the files are saved, if anything changed
+unsavedChanges = 0
+lastSaveTime = time()
+
+aliasIndex = None # Built the first time suggestions are needed, see getAliasIndex
+
 def getCompoundList(structureList, sortedByFrequency=True, useGetKey=False): # list
     """Takes in a list of Structure Objects and returns a list of just the compound names
     If sortedByFrequency is True, the compound names are sorted by frequency
@@ -101,23 +115,112 @@ def printRecognizedCompounds(compoundList):
 
 def removeStopWords(s, stopWords):
     """Takes a string and returns a string with stop words removed
-    stopWords = A list of words to remove"""
+    stopWords = A set (or list) of words to remove"""
     words = s.split(" ")
     words = [word for word in words if word not in stopWords]
     return printList(words, " ")
 
+def addStopWord(word): # boolean
+    """Adds a word to the stop words, returns False if it was already a stop word"""
+    if word in stopWordSet:
+        return False
+    stopWords.append(word)
+    stopWordSet.add(word)
+    return True
+
+def addUnknown(key):
+    """Adds a key to the unknown list"""
+    if key not in unknownSet:
+        unknownList.append(key)
+        unknownSet.add(key)
+
+def removeUnknown(key):
+    """Removes a key from the unknown list"""
+    unknownList.remove(key)
+    unknownSet.discard(key)
+
 def saveFiles():
     """Saves all of the lists and dictionaries to their respective files"""
+    global unsavedChanges, lastSaveTime
     writeJson(compoundDictionary, COMPOUND_DICTIONARY_FILE, indent=2)
     writeJson(unknownList, UNKNOWN_LIST_FILE, indent=2)
     writeJson(stopWords, STOP_WORDS_FILE, indent=2)
+    unsavedChanges = 0
+    lastSaveTime = time()
     print("Files saved")
 
+def requestSave():
+    """Records a change and saves the files once SAVE_EVERY changes have been made or SAVE_INTERVAL seconds have passed
+    Unsaved changes are still written by saveFiles when quitting"""
+    global unsavedChanges
+    unsavedChanges += 1
+    if unsavedChanges >= SAVE_EVERY or time() - lastSaveTime >= SAVE_INTERVAL:
+        saveFiles()
+
+def getAliasIndex(): # AliasIndex
+    """Returns the alias index of the compound dictionary, building it if necessary"""
+    global aliasIndex
+    if aliasIndex == None:
+        aliasIndex = AliasIndex(compoundDictionary)
+    return aliasIndex
+
+def addToDictionary(compound, nameOfCompound, autoAdd=True):
+    """Maps the key of compound to nameOfCompound in the compound dictionary, and adds the alias to the alias index
+    If autoAdd is True, the key of nameOfCompound is also mapped to itself (if it is not already in the dictionary)"""
+    compoundDictionary[getKey(compound)] = nameOfCompound
+    if autoAdd and getKey(nameOfCompound.lower()) not in compoundDictionary:
+        compoundDictionary[getKey(nameOfCompound.lower())] = nameOfCompound
+    if aliasIndex != None:
+        aliasIndex.addAlias(getKey(compound), nameOfCompound)
+
+def printSuggestions(compound, limit=5): # list
+    """Prints a numbered list of suggested dictionary names for a compound, and returns the list of suggested names"""
+    suggestions = getAliasIndex().suggest(compound, limit=limit)
+    if suggestions != []:
+        print("Suggestions: " + ", ".join("{}{} {} ({:.2f})".format(INPUT_SUGGESTION, n+1, name, similarity)
+            for n, (name, similarity) in enumerate(suggestions)))
+    return [name for name, similarity in suggestions]
+
+def getSuggestionInput(inputText, suggestions): # string
+    """Replaces an input such as "#1" with the suggested name it refers to, other inputs are returned unchanged"""
+    if inputText[:len(INPUT_SUGGESTION)] == INPUT_SUGGESTION:
+        number = inputText[len(INPUT_SUGGESTION):]
+        if number.isdigit() and 1 <= int(number) <= len(suggestions):
+            return suggestions[int(number)-1]
+    return inputText
+
+def autoResolvePending(compoundList, threshold=0.9, apply=False): # dictionary
+    """Maps obvious misspellings of dictionary names (e.g. "amonium sulfate") without prompting
+    Finds every pending compound in compoundList whose best suggestion has a similarity of at least threshold
+    and differs from it by a typo only: a missing, doubled or swapped letter which is not near a chemical suffix, in a name which
+    is not made of words of dictionary values (so sulfite, malate or cerium are never resolved, see alias_index.isTypoVariant)
+    Returns (and prints) a dictionary mapping those compounds to their suggested names
+    If apply is True, the mappings are also added to the dictionary and the files are saved"""
+    wrongPairs = checkAutoResolveRules()
+    if wrongPairs != []:
+        raise ValueError("Automatic resolution rules misclassify {}".format(wrongPairs))
+    pending = set()
+    for compound in compoundList:
+        compound = removeStopWords(compound, stopWordSet)
+        if compound in [" ", "", "-", ":"] or getKey(compound) in compoundDictionary or getKey(compound) in unknownSet:
+            continue
+        pending.add(compound)
+    print("Resolving {} pending compounds with a similarity threshold of {}...".format(len(pending), threshold))
+    resolved = getAliasIndex().resolveAll(pending, threshold=threshold)
+    for compound, (name, similarity) in sorted(resolved.items()):
+        print("{:40s} --> {:40s} ({:.2f})".format(compound, name, similarity))
+    print("Resolved {} of {} pending compounds".format(len(resolved), len(pending)))
+    if apply:
+        for compound, (name, similarity) in resolved.items():
+            addToDictionary(compound, name, autoAdd=False)
+        saveFiles()
+    return {compound: name for compound, (name, similarity) in resolved.items()}
+
 def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
     """ Iterates through a list and substitutes elements based on a dictionary
     If no key is found for the element, the user is prompted to enter an entry
     See INPUT definitions above for more options
-    If autoSave is True, then the files will save after every step
+    If autoSave is True, then the files will be saved automatically (see requestSave)
     If autoAdd is True, the dictionary will automatically add an identical key for every value entered
         For example, if "nacl" is mapped to "sodium chloride", the key "sodiumchloride" is also added to map to "sodium chloride"
     """
@@ -127,8 +230,8 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
     while(i < len(compoundList)+1):
         if i < len(compoundList):
             compound = compoundList[i]
-            compound = removeStopWords(compound, stopWords)
-            if getKey(compound) in compoundDictionary or getKey(compound) in unknownList or compound in passList:
+            compound = removeStopWords(compound, stopWordSet)
+            if getKey(compound) in compoundDictionary or getKey(compound) in unknownSet or compound in passList:
                 pass
             elif compound in [" ", "", "-", ":"]:
                 pass
@@ -137,7 +240,8 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                 runAgain = True
                 while(runAgain and getKey(compound) not in compoundDictionary):
                     runAgain = False
-                    inputText = input("Enter the name of the following compound:\n{}\n$:".format(compound))
+                    suggestions = printSuggestions(compound)
+                    inputText = getSuggestionInput(input("Enter the name of the following compound:\n{}\n$:".format(compound)), suggestions)
                     # PARSE INPUT
                     if inputText == INPUT_QUIT: # Quit
                         saveFiles()
@@ -148,14 +252,12 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                         saveFiles()
                         runAgain = True
                     elif inputText == INPUT_UNKNOWN: # Unknown compound
-                        unknownList.append(getKey(compound))
+                        addUnknown(getKey(compound))
                         history.append(i)
                     elif inputText == INPUT_STOP_WORDS:
                         ignored_words = compound.split(" ")
                         for word in ignored_words:
-                            if word not in stopWords:
-                                stopWords.append(word)
-                                writeJson(stopWords, STOP_WORDS_FILE, indent=2)
+                            addStopWord(word)
                         history.append(i)
                     elif inputText == INPUT_UNDO:
                         if history == []:
@@ -168,19 +270,17 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                                 oldValue = compoundDictionary[oldNameKey]
                                 del compoundDictionary[oldNameKey]
                                 print("Removed key from dictionary:\n{} : {}".format(oldNameKey, oldValue))
-                            elif oldNameKey in unknownList:
-                                del unknownList[index(oldNameKey)]
+                            elif oldNameKey in unknownSet:
+                                removeUnknown(oldNameKey)
                                 print("Removed {} from unknownList".format(oldNameKey))
                             saveFiles()
                             del history[-1]
                             i = oldIndex - 1
                     elif inputText[:len(INPUT_ADD_STOP_WORD)] == INPUT_ADD_STOP_WORD: # Add stop word
                         wordToAdd = inputText[len(INPUT_ADD_STOP_WORD)+1:]
-                        if wordToAdd not in stopWords:
-                            stopWords.append(wordToAdd)
-                            writeJson(stopWords, STOP_WORDS_FILE, indent=2)
+                        if addStopWord(wordToAdd):
                             print("Added stop word {}".format(wordToAdd))
-                            compound = removeStopWords(compound, stopWords)
+                            compound = removeStopWords(compound, stopWordSet)
                             runAgain = True
                     elif inputText == INPUT_PASS:
                         passList.append(compound)
@@ -192,16 +292,14 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                             nameOfCompound = compound
                         inputText = input("Add the following key to the dictionary? (Press n to cancel, ENTER to confirm):\n{} : {}\n$:".format(compound, nameOfCompound))
                         if inputText != "n":
-                            compoundDictionary[getKey(compound)] = nameOfCompound
-                            # Add the value to the dictionary with itself as the key
-                            if autoAdd and getKey(nameOfCompound.lower()) not in compoundDictionary:
-                                compoundDictionary[getKey(nameOfCompound.lower())] = nameOfCompound
+                            # Also adds the value to the dictionary with itself as the key
+                            addToDictionary(compound, nameOfCompound, autoAdd=autoAdd)
                             history.append(i)
                             print("Added")
                         else:
                             runAgain = True
                 if autoSave:
-                    saveFiles()
+                    requestSave()
         else: # END
             runAgain = True
             while(runAgain):
@@ -224,8 +322,8 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                             oldValue = compoundDictionary[oldNameKey]
                             del compoundDictionary[oldNameKey]
                             print("Removed key from dictionary:\n{} : {}".format(oldNameKey, oldValue))
-                        elif oldNameKey in unknownList:
-                            del unknownList[index(oldNameKey)]
+                        elif oldNameKey in unknownSet:
+                            removeUnknown(oldNameKey)
                             print("Removed {} from unknownList".format(oldNameKey))
                         saveFiles()
                         del history[-1]
@@ -235,6 +333,238 @@ def generateDictionary(compoundList, autoSave=True, autoAdd=True): # dictionary
                     sys.exit()
         i += 1
 
+class TriageQueue:
+    """A queue of the pending (unrecognized) compounds in a list of structures, deduplicated by dictionary key
+    and ranked by the number of structures that would become sensible if the compound were added to the dictionary,
+    that is, the number of structures in which it is the only unrecognized compound.
+    Ties are broken by the number of structures the compound appears in.
+    The ranking is updated incrementally after every decision, instead of rescanning the structures"""
+
+    def __init__(self, structureList):
+        print("Building triage queue...")
+        self.structureList = structureList
+        self.names = {} # Maps a key to a Counter of the (stop word free) names that have that key
+        self.structures = {} # Maps a key to the list of structure ids that contain it
+        self.blockers = [] # Maps a structure id to the set of its keys that are not in the dictionary
+        self.entries = [] # Maps a structure id to the list of (key, name) tuples of its pending compounds
+        self.words = {} # Maps a word of a compound to the list of structure ids that contain it, to find the structures a stop word affects
+        self.dead = set() # Structure ids with an unknown compound, which can never become sensible
+        self.scores = collections.Counter() # Maps a key to the number of structures in which it is the only blocker
+        self.heap = []
+        self.removed = set() # Keys that have been resolved, marked unknown or passed
+
+        for structureId, structure in enumerate(structureList):
+            self.blockers.append(set())
+            self.entries.append([])
+            self.addEntries(structureId)
+            for word in {word for compound in structure.compounds[::2] for word in compound.split(" ")}:
+                if word in self.words:
+                    self.words[word].append(structureId)
+                else:
+                    self.words[word] = [structureId]
+
+        for key in self.names:
+            self.addKey(key)
+        print("{} pending compounds in triage queue".format(len(self)))
+
+    def addEntries(self, structureId): # set
+        """Adds the pending compounds of a structure to the queue, and returns the set of keys that were new to the queue"""
+        keys = set()
+        newKeys = set()
+        entries = self.entries[structureId]
+        for compound in self.structureList[structureId].compounds[::2]:
+            name = removeStopWords(compound, stopWordSet)
+            if name in [" ", "", "-", ":"]:
+                continue
+            key = getKey(name)
+            if key in compoundDictionary:
+                continue
+            keys.add(key)
+            entries.append((key, name))
+            if key not in self.names:
+                self.names[key] = collections.Counter()
+                self.structures[key] = []
+                newKeys.add(key)
+            self.names[key][name] += 1
+        for key in keys:
+            self.structures[key].append(structureId)
+        self.blockers[structureId] = keys
+        if keys & unknownSet:
+            self.dead.add(structureId)
+        elif len(keys) == 1:
+            self.scores[next(iter(keys))] += 1
+        return newKeys
+
+    def removeEntries(self, structureId):
+        """Removes the pending compounds of a structure from the queue (see addEntries)"""
+        blockers = self.blockers[structureId]
+        if structureId in self.dead:
+            self.dead.discard(structureId)
+        elif len(blockers) == 1:
+            self.scores[next(iter(blockers))] -= 1
+        for key, name in self.entries[structureId]:
+            self.names[key][name] -= 1
+            if self.names[key][name] == 0:
+                del self.names[key][name]
+        for key in {key for key, name in self.entries[structureId]}:
+            self.structures[key].remove(structureId)
+        self.blockers[structureId] = set()
+        self.entries[structureId] = []
+
+    def addKey(self, key):
+        """Pushes a key that is new to the queue, or marks it as removed if it is unknown or passed"""
+        if key in unknownSet or self.getName(key) in passList:
+            self.removed.add(key)
+        else:
+            self.push(key)
+
+    def addStopWords(self, words): # int
+        """Updates the queue after stop words were added (see addStopWord), since they change the names and keys of compounds
+        Only the structures that contain one of the words are updated. Returns the number of structures updated"""
+        structureIds = set()
+        for word in words:
+            structureIds.update(self.words.get(word, ()))
+        changedKeys = set()
+        for structureId in structureIds:
+            changedKeys.update(key for key, name in self.entries[structureId])
+            self.removeEntries(structureId)
+        newKeys = set()
+        for structureId in structureIds:
+            newKeys.update(self.addEntries(structureId))
+            changedKeys.update(key for key, name in self.entries[structureId])
+        for key in changedKeys:
+            if not self.names[key]: # No compound has this key anymore
+                del self.names[key]
+                del self.structures[key]
+                del self.scores[key]
+                self.removed.discard(key)
+            elif key in newKeys:
+                self.addKey(key)
+            elif key not in self.removed:
+                self.push(key)
+        return len(structureIds)
+
+    def __len__(self):
+        return len(self.names) - len(self.removed)
+
+    def push(self, key):
+        heapq.heappush(self.heap, (-self.scores[key], -len(self.structures[key]), key))
+
+    def getName(self, key): # string
+        """Returns the most common name of the compound with a certain key"""
+        return self.names[key].most_common(1)[0][0]
+
+    def pop(self): # tuple
+        """Removes and returns the highest ranked pending compound as a tuple of (key, name, score, frequency)
+        Returns None if the queue is empty"""
+        while self.heap:
+            negativeScore, negativeFrequency, key = heapq.heappop(self.heap)
+            # Skip stale entries, which are left in the heap when a score or frequency changes, or a key is removed by a stop word
+            if key in self.removed or key not in self.names or -negativeScore != self.scores[key] or -negativeFrequency != len(self.structures[key]):
+                continue
+            return (key, self.getName(key), self.scores[key], -negativeFrequency)
+        return None
+
+    def resolve(self, key):
+        """Marks a key as added to the dictionary, and updates the scores of the compounds that share a structure with it"""
+        if key not in self.names or key in self.removed:
+            return
+        self.removed.add(key)
+        for structureId in self.structures[key]:
+            blockers = self.blockers[structureId]
+            blockers.discard(key)
+            if structureId not in self.dead and len(blockers) == 1:
+                otherKey = next(iter(blockers))
+                self.scores[otherKey] += 1
+                if otherKey not in self.removed:
+                    self.push(otherKey)
+
+    def reject(self, key, unknown=False):
+        """Removes a key from the queue without adding it to the dictionary
+        If unknown is True, then the structures that contain the key can never become sensible,
+        so they no longer count towards the scores of other compounds"""
+        if key not in self.names or key in self.removed:
+            return
+        self.removed.add(key)
+        if unknown:
+            for structureId in self.structures[key]:
+                if structureId not in self.dead:
+                    self.dead.add(structureId)
+                    blockers = self.blockers[structureId]
+                    if len(blockers) == 1:
+                        self.scores[next(iter(blockers))] -= 1
+
+    def update(self):
+        """Resolves every key in the queue that has since been added to the dictionary
+        (e.g. keys added automatically along with the value entered for another compound)"""
+        for key in [key for key in self.names if key not in self.removed and key in compoundDictionary]:
+            self.resolve(key)
+
+def triageDictionary(structureList, autoAdd=True):
+    """Prompts for the names of the pending compounds in a list of structures, most useful compound first
+    Each compound is only asked for once, and compounds are ranked with a TriageQueue so that every answer
+    makes as many structures sensible as possible
+    Accepts the same inputs as generateDictionary, except for undo
+    If autoAdd is True, the dictionary will automatically add an identical key for every value entered"""
+    queue = TriageQueue(structureList)
+    count = 0
+    while True:
+        item = queue.pop()
+        if item == None:
+            print("No more pending compounds")
+            saveFiles()
+            return
+        key, compound, score, frequency = item
+        count += 1
+        print("Compound {} ({} left) - makes {} structures sensible, appears in {} structures".format(count, len(queue), score, frequency))
+        runAgain = True
+        while runAgain:
+            runAgain = False
+            suggestions = printSuggestions(compound)
+            inputText = getSuggestionInput(input("Enter the name of the following compound:\n{}\n$:".format(compound)), suggestions)
+            if inputText == INPUT_QUIT:
+                saveFiles()
+                sys.exit()
+            elif inputText == INPUT_QUIT_WITHOUT_SAVING:
+                sys.exit()
+            elif inputText == INPUT_SAVE:
+                saveFiles()
+                runAgain = True
+            elif inputText == INPUT_UNKNOWN:
+                addUnknown(key)
+                queue.reject(key, unknown=True)
+                requestSave()
+            elif inputText == INPUT_STOP_WORDS or inputText[:len(INPUT_ADD_STOP_WORD)] == INPUT_ADD_STOP_WORD:
+                if inputText == INPUT_STOP_WORDS:
+                    words = compound.split(" ")
+                else:
+                    words = [inputText[len(INPUT_ADD_STOP_WORD)+1:]]
+                for word in words:
+                    if addStopWord(word):
+                        print("Added stop word {}".format(word))
+                requestSave()
+                queue.addStopWords(words)
+            elif inputText == INPUT_PASS:
+                passList.append(compound)
+                queue.reject(key)
+            elif inputText == "" or inputText == INPUT_UNDO:
+                if inputText == INPUT_UNDO:
+                    print("Undo is not supported while triaging. Edit the json files directly instead")
+                runAgain = True
+            else: # Normal input to add to dictionary
+                nameOfCompound = inputText
+                if inputText == INPUT_SAME:
+                    nameOfCompound = compound
+                inputText = input("Add the following key to the dictionary? (Press n to cancel, ENTER to confirm):\n{} : {}\n$:".format(compound, nameOfCompound))
+                if inputText != "n":
+                    addToDictionary(compound, nameOfCompound, autoAdd=autoAdd)
+                    queue.resolve(key)
+                    queue.update()
+                    requestSave()
+                    print("Added")
+                else:
+                    runAgain = True
+
 if __name__ == "__main__":
     structureList = loadStructures(STRUCTURES_FILE)
     # getCompressedDictionary(compoundDictionary, COMPRESSED_DICTIONARY_FILE)
@@ -242,4 +572,6 @@ if __name__ == "__main__":
     # writeStructures(structureList, STRUCTURES_FILE)
     # compoundList = getCompoundList(structureList, useGetKey=False)
     # generateDictionary(compoundList)
+    # triageDictionary(structureList)
+    # autoResolvePending(compoundList, threshold=0.9, apply=False)
     # printRecognizedCompounds(compoundList)
@@ -1,9 +1,13 @@
 import pickle, json, os, sys, traceback
 import xml.etree.ElementTree as etree
 from pathlib import Path
-from pdb_crystal_database import loadStructures, writeStructures, getStructure, Structure
+from pdb_crystal_database import loadStructures, writeStructures, Structure
 from misc_functions import loadJson, writeJson
-from time import sleep
+from profiling import profiled
+from details_index import DetailsIndex, loadDetailsIndex, writeDetailsIndex
+from sqlite_database import isSqliteFile, connect, upsertStructures, deleteStructures
+from fetch_metrics import FetchMetrics, OK, CACHED, EMPTY, TIMEOUT, ERROR
+from time import sleep, time, perf_counter
 
 try:
     import requests
@@ -21,27 +25,140 @@ STRUCTURE_DIR = Path("Structures/")
 
 WITHOUT_DETAILS_FILE = INPUT_DIR / "pdbs_without_details.json"
 STRUCTURES_FILE = STRUCTURE_DIR / "structures.pkl" # The database file. Must be placed in proper location
+FETCH_LOG_FILE = STRUCTURE_DIR / "fetch_log.json" # Maps pdbids to the time they were fetched and the hash of what was fetched
+
+# PDB web services - may be replaced by a local stand-in server (see mock_pdb_server.py)
+CUSTOM_REPORT_URL = "http://www.rcsb.org/pdb/rest/customReport.xml?pdbids="
+GET_CURRENT_URL = "https://www.rcsb.org/pdb/json/getCurrent"
+
+# Columns every record of a customReport must have (their text may be "null"). A response without one of them is malformed
+REQUIRED_COLUMNS = ["dimStructure.pdbxDetails", "dimStructure.pmc", "dimStructure.phValue", "dimStructure.crystallizationTempK",
+    "dimStructure.crystallizationMethod", "dimStructure.resolution", "dimEntity.sequence"]
+
+MAX_AGE = 90 * 24 * 60 * 60 # Seconds before a structure is considered stale and refetched by refreshStructures
+REQUEST_TIMEOUT = 10 # Seconds to wait for the PDB to answer a request
+REQUEST_DELAY = 0.05 # Seconds fetchStructures waits before each request, to avoid sending too many requests
 
 structureList = []
 pdbsWithoutDetails = []
 
-def loadPdb(pdbid): # ElementTree root
-    """Loads a pdbid as an xml file and returns the <root> branch"""
-    try:
-        response = requests.get("http://www.rcsb.org/pdb/rest/customReport.xml?pdbids="+pdbid+
-        "&customReportColumns=crystallizationMethod,crystallizationTempK,pdbxDetails,phValue,pmc,sequence,resolution&service=wsfile", timeout=10)
-    except (requests.Timeout, requests.exceptions.ConnectionError):
-        print("Request timeout on PDB: {}".format(pdbid))
+def loadPdb(pdbid, cache=None, offline=False, refresh=False, metrics=None, retries=0): # ElementTree root
+    """Loads a pdbid as an xml file and returns the <root> branch
+    If cache is a ResponseCache (see response_cache.py), cached responses are used instead of downloading them again,
+        and downloaded responses are added to the cache
+    If offline is True, only cached responses are used and nothing is downloaded
+    If refresh is True, the response is always downloaded (and the cached response is replaced)
+    If metrics is a FetchMetrics (see fetch_metrics.py), the outcome and latency of the request are recorded in it
+    Requests which time out, get a server error or a malformed response (see getMissingColumns) are tried again up to retries times
+    Malformed responses are never cached
+    Returns None if the pdbid has no entry, or the request failed"""
+    content = cache.get(pdbid) if cache != None and not refresh else None
+    if content != None:
+        try:
+            root = etree.fromstring(content)
+        except etree.ParseError:
+            root = None
+        if root != None and root.find("record") != None and getMissingColumns(root) == []:
+            if metrics != None:
+                metrics.record(CACHED)
+            return root
+        content = None # A broken cached response is downloaded again
+    if offline:
         return None
-    root = etree.fromstring(response.content)
-    if (root.find("record") != None):
-        return root
-    else:
-        print("\n-------------------- ERROR --------------------\nNo entry found with PDB ID "
-        + str(pdbid)+"\n-----------------------------------------------\n")
+
+    for attempt in range(retries+1):
+        if attempt > 0:
+            if metrics != None:
+                metrics.recordRetry()
+            sleep(attempt) # Back off a little more after every failure
+        start = perf_counter()
+        try:
+            response = requests.get(CUSTOM_REPORT_URL+pdbid+
+            "&customReportColumns=crystallizationMethod,crystallizationTempK,pdbxDetails,phValue,pmc,sequence,resolution&service=wsfile", timeout=REQUEST_TIMEOUT)
+        except (requests.Timeout, requests.exceptions.ConnectionError):
+            print("Request timeout on PDB: {}".format(pdbid))
+            if metrics != None:
+                metrics.record(TIMEOUT, perf_counter() - start, final=attempt == retries)
+            continue
+        seconds = perf_counter() - start
+        if response.status_code != 200:
+            print("ERROR: The PDB returned status {} for PDB ID {}".format(response.status_code, pdbid))
+            if metrics != None:
+                metrics.record(ERROR, seconds, len(response.content), final=attempt == retries or response.status_code < 500)
+            if response.status_code >= 500:
+                continue # Server errors are usually temporary
+            return None
+        content = response.content
+        try:
+            root = etree.fromstring(content)
+        except etree.ParseError as e:
+            print("ERROR: Unable to parse the report for PDB ID {}: {}".format(pdbid, e))
+            if metrics != None:
+                metrics.record(ERROR, seconds, len(content), final=attempt == retries)
+            continue
+        if (root.find("record") != None):
+            missingColumns = getMissingColumns(root)
+            if missingColumns != []:
+                print("ERROR: The report for PDB ID {} is missing columns: {}".format(pdbid, ", ".join(missingColumns)))
+                if metrics != None:
+                    metrics.record(ERROR, seconds, len(content), final=attempt == retries)
+                continue
+            if metrics != None:
+                metrics.record(OK, seconds, len(content))
+            if cache != None:
+                cache.put(pdbid, content)
+            return root
+        else:
+            if metrics != None:
+                metrics.record(EMPTY, seconds, len(content))
+            print("\n-------------------- ERROR --------------------\nNo entry found with PDB ID "
+            + str(pdbid)+"\n-----------------------------------------------\n")
+            return None
+    return None
+
+def getStructureFromRoot(pdbid, root): # Structure
+    """Takes the <root> branch of a customReport xml file (see loadPdb) and returns a Structure object
+    Fields which are "null" or missing in the report are set to None"""
+    details = getReportText(root, "dimStructure.pdbxDetails")
+    pmcid = getReportText(root, "dimStructure.pmc")
+    if (pmcid != None):
+        pmcid = pmcid[3:]
+    try:
+        pH = float(getReportText(root, "dimStructure.phValue"))
+    except (ValueError, TypeError):
+        pH = None
+    try:
+        temperature = float(getReportText(root, "dimStructure.crystallizationTempK"))
+    except (ValueError, TypeError):
+        temperature = None
+    method = getReportText(root, "dimStructure.crystallizationMethod")
+    sequences = []
+    for tag in root.findall("record/dimEntity.sequence"):
+        sequences.append(tag.text)
+    try:
+        resolution = float(getReportText(root, "dimStructure.resolution"))
+    except (ValueError, TypeError):
+        resolution = None
+    return Structure(pdbid, pmcid, details, [], pH, temperature, method, sequences, resolution)
+
+def getMissingColumns(root): # list
+    """Returns the columns of REQUIRED_COLUMNS which are missing from any record of a customReport"""
+    missingColumns = []
+    for record in root.findall("record"):
+        for column in REQUIRED_COLUMNS:
+            if record.find(column) == None and column not in missingColumns:
+                missingColumns.append(column)
+    return missingColumns
+
+def getReportText(root, column): # string
+    """Returns the text of a column of the first record of a report, or None if it is "null" or missing"""
+    element = root.find("record/" + column)
+    if element == None or element.text == "null":
         return None
+    return element.text
 
-def fetchStructures(pdbList, structureFile=STRUCTURES_FILE, onlyDetails=True, ignorePdbsWithoutDetails=True, ignoreCompletedPdbs=True, saveFrequency=1000): # list
+@profiled
+def fetchStructures(pdbList, structureFile=STRUCTURES_FILE, onlyDetails=True, ignorePdbsWithoutDetails=True, ignoreCompletedPdbs=True, saveFrequency=1000, detailsIndexFile=None, cache=None, refresh=False, fetchLogFile=FETCH_LOG_FILE, metrics=None, retries=0, requestDelay=REQUEST_DELAY): # list
     """Takes a list of pdbids and creates Structure objects for them, outputing them to structureFile
     If onlyDetails is True the function will only output Structures that have crystallization details
     If ignoreCompletedPdbs is True, then the function will read the Structure file and ignore Pdbs which already
@@ -50,6 +167,17 @@ def fetchStructures(pdbList, structureFile=STRUCTURES_FILE, onlyDetails=True, ig
     If ignorePdbsWithoutDetails is True then the function will ignore Pdbs from WITHOUT_DETAILS_FILE
     saveFrequency is the number of pdbs downloaded before the files are saved
         increasing this number makes the script faster, but more unsaved data is lost when the script is exited
+    If detailsIndexFile is not None, then the details index in that file is updated with every fetched structure
+        (a new index of the whole structure file is built if the file does not exist)
+    If structureFile is a SQLite database, every fetched structure is written to it immediately as a single-row upsert,
+        instead of rewriting the whole file every saveFrequency pdbs
+    If cache is a ResponseCache, then cached responses are used instead of downloading them (see loadPdb)
+    If refresh is True, cached responses are ignored and replaced by new downloads
+    If fetchLogFile is not None, the time each pdb was fetched and the hash of the fetched structure are recorded in it
+        (used by refreshStructures to find stale and revised entries)
+    If metrics is a FetchMetrics (see fetch_metrics.py), every request is recorded in it and it is exported periodically
+    Requests which time out or get a server error are tried again up to retries times (see loadPdb)
+    requestDelay is the number of seconds to wait before each request
     """
     global structureList
     global pdbsWithoutDetails
@@ -73,6 +201,23 @@ def fetchStructures(pdbList, structureFile=STRUCTURES_FILE, onlyDetails=True, ig
                 completedPdbList.append(struc.pdbid)
     except FileNotFoundError:
         print("File {} not found. A new structure file will be created.".format(structureFile))
+    # Maps a pdbid to its position in structureList, so that updated structures can be replaced without searching the list
+    structurePositions = {structure.pdbid: i for i, structure in enumerate(structureList)}
+
+    fetchLog = loadFetchLog(fetchLogFile) if fetchLogFile != None else None
+
+    detailsIndex = None
+    if detailsIndexFile != None:
+        try:
+            detailsIndex = loadDetailsIndex(detailsIndexFile)
+        except FileNotFoundError:
+            print("File {} not found. A new details index will be created.".format(detailsIndexFile))
+            detailsIndex = DetailsIndex()
+            detailsIndex.addStructures(structureList)
+
+    connection = None
+    if isSqliteFile(structureFile):
+        connection = connect(structureFile)
 
     ignoredPdbList = []
 
@@ -83,78 +228,209 @@ def fetchStructures(pdbList, structureFile=STRUCTURES_FILE, onlyDetails=True, ig
 
     print("Removing completed pdbs (May take a minute)...")
     pdbList = list(set(pdbList)-set(ignoredPdbList))
+    pdbsWithoutDetailsSet = set(pdbsWithoutDetails)
 
     if pdbList == []:
         print("All PDBs have been ignored. No more PDBs need to be downloaded.")
+    if metrics != None:
+        metrics.setTotal(len(pdbList))
 
     for pdbid in pdbList:
-        sleep(0.05) # Add delay to avoid sending too many requests
+        if cache == None or pdbid not in cache or refresh:
+            sleep(requestDelay) # Add delay to avoid sending too many requests
         if count == 1:
             print("Downloading {} structure objects from the pdb".format(len(pdbList)))
         if count % 100 == 0:
             print("Loading pdb {} of {}...".format(count, len(pdbList)))
-        root = loadPdb(pdbid)
+            if metrics != None:
+                print(metrics)
+        root = loadPdb(pdbid, cache=cache, refresh=refresh, metrics=metrics, retries=retries)
+        if metrics != None:
+            metrics.maybeExport()
         count += 1
         if (root != None):
-            details = root.find("record/dimStructure.pdbxDetails").text
-            if details == "null":
-                details = None
+            structure = getStructureFromRoot(pdbid, root)
+            if fetchLog != None:
+                fetchLog[pdbid] = [time(), structure.getFetchedHash()]
+            if structure.details == None and pdbid not in pdbsWithoutDetailsSet:
                 pdbsWithoutDetails.append(pdbid)
-            if details != None or not onlyDetails:
-                pmcid = root.find("record/dimStructure.pmc").text
-                if (pmcid != "null"):
-                    pmcid = pmcid[3:]
-                else:
-                    pmcid = None
-                try:
-                    pH = float(root.find("record/dimStructure.phValue").text)
-                except ValueError:
-                    pH = None
-                try:
-                    temperature = float(root.find("record/dimStructure.crystallizationTempK").text)
-                except ValueError:
-                    temperature = None
-                method = root.find("record/dimStructure.crystallizationMethod").text
-                if method == "null":
-                    method = None
-                sequences = []
-                for tag in root.findall("record/dimEntity.sequence"):
-                    sequences.append(tag.text)
-                try:
-                    resolution = float(root.find("record/dimStructure.resolution").text)
-                except ValueError:
-                    resolution = None
-                structure = Structure(pdbid, pmcid, details, [], pH, temperature, method, sequences, resolution)
+                pdbsWithoutDetailsSet.add(pdbid)
+            elif structure.details != None and pdbid in pdbsWithoutDetailsSet: # Details were added upstream
+                pdbsWithoutDetails.remove(pdbid)
+                pdbsWithoutDetailsSet.remove(pdbid)
+            if structure.details == None and onlyDetails and pdbid in structurePositions: # Details were removed upstream
+                position = structurePositions.pop(pdbid)
+                del structureList[position]
+                for i in range(position, len(structureList)):
+                    structurePositions[structureList[i].pdbid] = i
+                if connection != None:
+                    deleteStructures([pdbid], connection=connection)
+                if detailsIndex != None:
+                    detailsIndex.removeStructure(pdbid)
+            if structure.details != None or not onlyDetails:
                 # If the pdb already has a structure in the list, update it
-                structureAlreadyInList = getStructure(structureList, structure.pdbid)
-                if structureAlreadyInList != None:
-                    structureList.remove(structureAlreadyInList)
-                structureList.append(structure)
+                if structure.pdbid in structurePositions:
+                    structureList[structurePositions[structure.pdbid]] = structure
+                else:
+                    structurePositions[structure.pdbid] = len(structureList)
+                    structureList.append(structure)
+                if connection != None:
+                    upsertStructures([structure], connection=connection)
+                if detailsIndex != None:
+                    detailsIndex.addStructure(structure)
                 if count % saveFrequency == 0:
                     # Save structures
-                    writeStructures(structureList, structureFile)
+                    if connection == None:
+                        writeStructures(structureList, structureFile)
                     writeJson(pdbsWithoutDetails, WITHOUT_DETAILS_FILE)
+                    if detailsIndex != None:
+                        writeDetailsIndex(detailsIndex, detailsIndexFile)
+                    if cache != None:
+                        cache.save()
+                    if fetchLog != None:
+                        writeJson(fetchLog, fetchLogFile)
 
-    writeStructures(structureList, structureFile)
+    if connection != None:
+        connection.close()
+    else:
+        writeStructures(structureList, structureFile)
+    writeJson(pdbsWithoutDetails, WITHOUT_DETAILS_FILE)
+    if detailsIndex != None:
+        writeDetailsIndex(detailsIndex, detailsIndexFile)
+    if cache != None:
+        cache.save()
+    if fetchLog != None:
+        writeJson(fetchLog, fetchLogFile)
+    if metrics != None:
+        metrics.export()
+        print(metrics)
     print("Done fetching Structures")
     return structureList
 
+def rebuildStructuresFromCache(cache, structureFile=None, onlyDetails=True): # list
+    """Recreates Structure objects for every response in a ResponseCache without downloading anything
+    Useful after changing which fields are read from the responses (see getStructureFromRoot)
+    If onlyDetails is True, only Structures that have crystallization details are returned
+    If structureFile is not None, then the structures are also written to that file"""
+    print("Rebuilding structures from {} cached responses...".format(len(cache)))
+    structureList = []
+    count = 1
+    for pdbid, content in cache.iterResponses():
+        if count % 10000 == 0:
+            print("Rebuilding structure {} of {}...".format(count, len(cache)))
+        count += 1
+        try:
+            root = etree.fromstring(content)
+            if root.find("record") == None:
+                continue
+            if getMissingColumns(root) != []:
+                print("ERROR: The cached response for PDB ID {} is missing columns. Fetch it again".format(pdbid))
+                continue
+            structure = getStructureFromRoot(pdbid, root)
+        except Exception as e:
+            print("ERROR: Unable to read the cached response for PDB ID {}: {}".format(pdbid, e))
+            continue
+        if structure.details != None or not onlyDetails:
+            structureList.append(structure)
+    print("Rebuilt {} structures".format(len(structureList)))
+    if structureFile != None:
+        writeStructures(structureList, structureFile)
+    return structureList
+
 def getAllPdbs(filename=""): # list
     """Returns a list of every pdbid in the PDB
     # filename = an optional argument to also export the list as a json file"""
     print("Getting a list of all pdbs...")
-    response = requests.get("https://www.rcsb.org/pdb/json/getCurrent").text
+    response = requests.get(GET_CURRENT_URL).text
     dictionary = json.loads(response)
     allPdbs = dictionary["idList"]
     if filename != "":
         writeJson(allPdbs, filename)
     return allPdbs
 
+def loadFetchLog(fetchLogFile=FETCH_LOG_FILE): # dictionary
+    """Returns the fetch log, a dictionary mapping pdbids to [time fetched, hash of the fetched structure]"""
+    try:
+        return loadJson(fetchLogFile)
+    except FileNotFoundError:
+        return {}
+
+def refreshStructures(structureFile=STRUCTURES_FILE, maxAge=MAX_AGE, maxStale=None, cache=None, fetchLogFile=FETCH_LOG_FILE, **kwargs): # dictionary
+    """Brings the structure file up to date with the PDB without downloading everything again
+    Compares the current list of pdbids to the structure file, and then:
+        - fetches added pdbids (current pdbids which are neither structures nor known to be without details)
+        - removes obsolete pdbids (structures and pdbs without details which are no longer current),
+          also from the details index if a detailsIndexFile is passed to fetchStructures
+        - refetches stale pdbids, which were last fetched more than maxAge seconds ago (or never recorded in the fetch log)
+    If maxStale is not None, at most maxStale stale structures (the oldest ones) are refetched, to spread refetching over several runs
+    Other keyword arguments are passed to fetchStructures
+    Returns a dictionary with the sets of "added", "removed", "stale" and "revised" pdbids,
+        where revised pdbids are stale pdbids whose fetched fields changed"""
+    global pdbsWithoutDetails
+    currentPdbs = set(getAllPdbs())
+    try:
+        existingStructures = loadStructures(structureFile)
+    except FileNotFoundError:
+        existingStructures = []
+    try:
+        pdbsWithoutDetails = loadJson(WITHOUT_DETAILS_FILE)
+    except FileNotFoundError:
+        pdbsWithoutDetails = []
+    fetchLog = loadFetchLog(fetchLogFile)
+
+    knownPdbs = {structure.pdbid for structure in existingStructures}
+    added = currentPdbs - knownPdbs - set(pdbsWithoutDetails)
+    removed = (knownPdbs | set(pdbsWithoutDetails)) - currentPdbs
+    now = time()
+    # Pdbs without details are refreshed too, since details may be added to an entry after it is released
+    stale = [pdbid for pdbid in (knownPdbs | set(pdbsWithoutDetails)) & currentPdbs if pdbid not in fetchLog or now - fetchLog[pdbid][0] > maxAge]
+    stale.sort(key=lambda pdbid: fetchLog[pdbid][0] if pdbid in fetchLog else 0)
+    if maxStale != None:
+        stale = stale[:maxStale]
+    stale = set(stale)
+    print("Refreshing: {} added, {} removed, {} stale".format(len(added), len(removed), len(stale)))
+
+    # Remove obsolete entries
+    if removed:
+        structureList = [structure for structure in existingStructures if structure.pdbid not in removed]
+        writeStructures(structureList, structureFile)
+        pdbsWithoutDetails = [pdbid for pdbid in pdbsWithoutDetails if pdbid not in removed]
+        writeJson(pdbsWithoutDetails, WITHOUT_DETAILS_FILE)
+        for pdbid in removed:
+            fetchLog.pop(pdbid, None)
+            if cache != None:
+                cache.remove(pdbid)
+        writeJson(fetchLog, fetchLogFile)
+        detailsIndexFile = kwargs.get("detailsIndexFile")
+        if detailsIndexFile != None and Path(detailsIndexFile).exists():
+            detailsIndex = loadDetailsIndex(detailsIndexFile)
+            for pdbid in removed:
+                detailsIndex.removeStructure(pdbid)
+            writeDetailsIndex(detailsIndex, detailsIndexFile)
+    oldHashes = {pdbid: fetchLog[pdbid][1] for pdbid in stale if pdbid in fetchLog}
+
+    # Fetch added entries, and refetch stale ones (bypassing the cache, since a cached response would be just as stale)
+    if added:
+        fetchStructures(list(added), structureFile, cache=cache, fetchLogFile=fetchLogFile, **kwargs)
+    if stale:
+        fetchStructures(list(stale), structureFile, ignoreCompletedPdbs=False, ignorePdbsWithoutDetails=False,
+            cache=cache, refresh=True, fetchLogFile=fetchLogFile, **kwargs)
+
+    fetchLog = loadFetchLog(fetchLogFile)
+    revised = {pdbid for pdbid in oldHashes if pdbid in fetchLog and fetchLog[pdbid][1] != oldHashes[pdbid]}
+    print("{} stale structures were revised upstream".format(len(revised)))
+    return {"added": added, "removed": removed, "stale": stale, "revised": revised}
+
 if __name__ == "__main__":
+    # Offline rebuild from cached responses:
+    # from response_cache import ResponseCache
+    # rebuildStructuresFromCache(ResponseCache(), STRUCTURES_FILE)
+    # Update an existing structure file instead of downloading everything:
+    # refreshStructures(STRUCTURES_FILE, maxStale=10000)
     allPdbs = getAllPdbs()
 
     try:
-        fetchStructures(allPdbs)
+        fetchStructures(allPdbs, metrics=FetchMetrics())
     except (Exception, KeyboardInterrupt) as e:
         # Print traceback
         print(traceback.format_exc())
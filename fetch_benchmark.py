@@ -0,0 +1,129 @@
+import io, random, tempfile, contextlib
+from pathlib import Path
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import download_structures
+from download_structures import loadPdb, getStructureFromRoot
+from fetch_metrics import FetchMetrics
+from mock_pdb_server import MockPdbServer, FaultProfile, FAULTS
+
+CLIENT_TIMEOUT = 1.0 # Seconds loadPdb waits for the mock server (download_structures.REQUEST_TIMEOUT during a benchmark)
+RETRIES = 2
+
+PROFILES = [
+    FaultProfile("clean", latency=0.02),
+    FaultProfile("slow tail", latency=0.02, latencySpread=1.2),
+    FaultProfile("server errors", latency=0.02, serverErrorRate=0.05),
+    FaultProfile("timeouts", latency=0.02, timeoutRate=0.02, hangTime=2 * CLIENT_TIMEOUT),
+    FaultProfile("malformed xml", latency=0.02, malformedRate=0.05),
+    FaultProfile("null fields", latency=0.02, nullRate=0.05),
+    FaultProfile("mixed", latency=0.02, latencySpread=0.8, timeoutRate=0.01, serverErrorRate=0.03, malformedRate=0.02, nullRate=0.02,
+        hangTime=2 * CLIENT_TIMEOUT),
+]
+
+def makeRecords(count, seed=0): # dictionary
+    """Returns records (see MockPdbServer) for count made up pdbids, one in ten without details"""
+    rng = random.Random(seed)
+    records = {}
+    for i in range(count):
+        pdbid = "{}{:03X}".format(1 + i % 9, i)
+        record = {"dimStructure.phValue": rng.choice([6.5, 7.0, 7.5]), "dimStructure.crystallizationTempK": 293,
+            "dimStructure.crystallizationMethod": "VAPOR DIFFUSION, HANGING DROP", "dimStructure.resolution": round(rng.uniform(1, 3), 2),
+            "sequences": ["".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for j in range(rng.randint(50, 300)))]}
+        if i % 10 != 0:
+            record["dimStructure.pdbxDetails"] = "0.1 M HEPES pH 7.5, {}% w/v PEG 3350, 0.2 M sodium chloride".format(rng.randint(5, 30))
+        records[pdbid] = record
+    return records
+
+def fetchSequential(pdbList, structureFile, metrics, retries): # list
+    """Fetches with download_structures.fetchStructures, without its request delay"""
+    return download_structures.fetchStructures(pdbList, structureFile, ignorePdbsWithoutDetails=False, ignoreCompletedPdbs=False,
+        saveFrequency=len(pdbList) + 1, fetchLogFile=None, metrics=metrics, retries=retries, requestDelay=0)
+
+def makeThreadedFetcher(workers=8): # function
+    """Returns a fetcher which calls loadPdb from a pool of threads, as a concurrent replacement for fetchStructures would"""
+    def fetchThreaded(pdbList, structureFile, metrics, retries): # list
+        def fetch(pdbid): # Structure
+            root = loadPdb(pdbid, metrics=metrics, retries=retries)
+            return getStructureFromRoot(pdbid, root) if root != None else None
+        with ThreadPoolExecutor(workers) as executor:
+            return [structure for structure in executor.map(fetch, pdbList) if structure != None and structure.details != None]
+    fetchThreaded.__name__ = "threaded ({} workers)".format(workers)
+    return fetchThreaded
+
+def checkStructures(records, structureList): # tuple
+    """Compares fetched structures to the records they came from
+    Returns (lost, corrupted): the pdbids with details which are missing, and those whose fields differ from their record"""
+    structures = {structure.pdbid: structure for structure in structureList}
+    lost = []
+    corrupted = []
+    for pdbid, record in records.items():
+        if record.get("dimStructure.pdbxDetails") == None:
+            continue
+        structure = structures.get(pdbid)
+        if structure == None:
+            lost.append(pdbid)
+        elif (structure.details != record["dimStructure.pdbxDetails"] or structure.pH != record["dimStructure.phValue"]
+                or structure.resolution != record["dimStructure.resolution"] or structure.sequences != record["sequences"]):
+            corrupted.append(pdbid)
+    return lost, corrupted
+
+def runProfile(server, profile, fetcher, records, retries=RETRIES, quiet=True): # dictionary
+    """Fetches every record from the server with one fault profile and fetcher, and returns the results"""
+    server.setFaultProfile(profile)
+    pdbList = list(records)
+    with tempfile.TemporaryDirectory() as directory:
+        metrics = FetchMetrics(exportFile=Path(directory) / "fetch_metrics.json", total=len(pdbList))
+        output = io.StringIO()
+        start = perf_counter()
+        with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+            structureList = fetcher(pdbList, Path(directory) / "structures.pkl", metrics, retries)
+        seconds = perf_counter() - start
+    lost, corrupted = checkStructures(records, structureList)
+    snapshot = metrics.getSnapshot()
+    return {"profile": profile.name, "fetcher": fetcher.__name__, "seconds": seconds, "pdbsPerSecond": len(pdbList) / seconds,
+        "p50": metrics.getLatencyQuantile(0.5), "p95": metrics.getLatencyQuantile(0.95), "p99": metrics.getLatencyQuantile(0.99),
+        "outcomes": snapshot["outcomes"], "retries": snapshot["retries"], "faults": dict(server.faultCounts), "lost": lost, "corrupted": corrupted}
+
+def formatSeconds(seconds): # string
+    if seconds == None:
+        return "-"
+    return "inf" if seconds == float("inf") else "{:.0f}ms".format(seconds * 1000)
+
+def printResults(results):
+    print("{:14s} {:22s} {:>8s} {:>7s} {:>7s} {:>7s} {:>8s} {:>6s} {:>9s} {}".format("profile", "fetcher", "pdbs/s", "p50", "p95", "p99",
+        "retries", "lost", "corrupted", "faults injected"))
+    for result in results:
+        faults = ", ".join("{} {}".format(fault, count) for fault, count in result["faults"].items() if count > 0 and fault != FAULTS[0])
+        print("{:14s} {:22s} {:8.1f} {:>7s} {:>7s} {:>7s} {:8d} {:6d} {:9d} {}".format(result["profile"], result["fetcher"],
+            result["pdbsPerSecond"], formatSeconds(result["p50"]), formatSeconds(result["p95"]), formatSeconds(result["p99"]),
+            result["retries"], len(result["lost"]), len(result["corrupted"]), faults))
+
+def runBenchmark(fetchers=None, profiles=PROFILES, pdbCount=200, retries=RETRIES, clientTimeout=CLIENT_TIMEOUT, seed=0, quiet=True): # list
+    """Drives each fetcher against a mock PDB server with each fault profile, and prints the sustained throughput,
+    latency percentiles (upper bounds of the FetchMetrics histogram buckets), retries and data loss of every run
+    A pdbid is lost if it has details but was not fetched, and corrupted if it was fetched with different fields
+    A fetcher is a function fetcher(pdbList, structureFile, metrics, retries) which returns the fetched structures
+    Returns the list of results"""
+    if fetchers == None:
+        fetchers = [fetchSequential, makeThreadedFetcher(8)]
+    records = makeRecords(pdbCount, seed)
+    results = []
+    savedFiles = (download_structures.WITHOUT_DETAILS_FILE, download_structures.REQUEST_TIMEOUT)
+    with tempfile.TemporaryDirectory() as directory, MockPdbServer(records, seed=seed) as server:
+        # Keep the benchmark away from the real list of pdbs without details
+        download_structures.WITHOUT_DETAILS_FILE = Path(directory) / "pdbs_without_details.json"
+        download_structures.REQUEST_TIMEOUT = clientTimeout
+        try:
+            for profile in profiles:
+                for fetcher in fetchers:
+                    print("Benchmarking {} with profile {}...".format(fetcher.__name__, profile))
+                    results.append(runProfile(server, profile, fetcher, records, retries, quiet))
+        finally:
+            download_structures.WITHOUT_DETAILS_FILE, download_structures.REQUEST_TIMEOUT = savedFiles
+    printResults(results)
+    return results
+
+if __name__ == "__main__":
+    runBenchmark(pdbCount=200)
+    # runBenchmark([fetchSequential], [PROFILES[-1]], pdbCount=1000, retries=0)
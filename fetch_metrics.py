@@ -0,0 +1,156 @@
+import json, os, threading
+from time import time
+from pathlib import Path
+from pdb_crystal_database import OUTPUT_DIR
+
+FETCH_METRICS_FILE = OUTPUT_DIR / "fetch_metrics.json"
+
+# Upper bounds (in seconds) of the latency histogram buckets. Slower requests go in a final "+Inf" bucket
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+EXPORT_INTERVAL = 60 # Seconds between automatic exports
+
+# Outcomes of a fetch (see loadPdb)
+OK = "ok" # A record was downloaded
+CACHED = "cached" # A record was read from the response cache
+EMPTY = "empty" # The PDB returned no record for the pdbid
+TIMEOUT = "timeout" # The request timed out or could not connect
+ERROR = "error" # The PDB returned an error status or a response which could not be parsed
+OUTCOMES = [OK, CACHED, EMPTY, TIMEOUT, ERROR]
+
+class FetchMetrics:
+    """Collects metrics of the download path (see loadPdb and fetchStructures) and exports them to a file
+    Counts requests by outcome, retries and bytes downloaded, keeps a histogram of request latencies,
+    and estimates the time left from the rate at which pdbs are completed.
+    The export format is JSON, or Prometheus text format if exportFile ends in ".prom".
+    Safe to share between threads"""
+
+    def __init__(self, exportFile=FETCH_METRICS_FILE, exportInterval=EXPORT_INTERVAL, total=None):
+        self.exportFile = exportFile
+        self.exportInterval = exportInterval
+        self.total = total # Number of pdbs to fetch, used for the ETA
+        self.lock = threading.Lock()
+        self.startTime = time()
+        self.lastExport = self.startTime
+        self.completed = 0 # Number of pdbs which are finished (a pdb may take several requests when they are retried)
+        self.outcomes = {outcome: 0 for outcome in OUTCOMES} # Counts requests (and cache reads) by outcome
+        self.retries = 0
+        self.bytesReceived = 0
+        self.bucketCounts = [0] * (len(LATENCY_BUCKETS)+1)
+        self.latencySum = 0.0 # Seconds, summed over every request sent to the PDB
+        self.latencyCount = 0
+
+    def record(self, outcome, seconds=None, bytesReceived=0, final=True):
+        """Records the outcome of one request (or cache read), and its latency if a request was sent
+        final is False if the request is about to be retried, so the pdb is not finished yet"""
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if final:
+                self.completed += 1
+            self.bytesReceived += bytesReceived
+            if seconds != None:
+                self.latencySum += seconds
+                self.latencyCount += 1
+                bucket = 0
+                while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+                    bucket += 1
+                self.bucketCounts[bucket] += 1
+
+    def recordRetry(self):
+        with self.lock:
+            self.retries += 1
+
+    def setTotal(self, total):
+        with self.lock:
+            self.total = total
+
+    def getLatencyQuantile(self, quantile): # float
+        """Returns an estimate of a latency quantile (e.g. 0.95) from the histogram: the upper bound of the bucket it falls in"""
+        target = quantile * self.latencyCount
+        seen = 0
+        for i, count in enumerate(self.bucketCounts):
+            seen += count
+            if seen >= target and count > 0:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return None
+
+    def getSnapshot(self): # dictionary
+        """Returns a dictionary of the current metrics"""
+        with self.lock:
+            elapsed = time() - self.startTime
+            completed = self.completed
+            requests = self.latencyCount
+            rate = completed / elapsed if elapsed > 0 else 0
+            eta = None
+            if self.total != None and rate > 0:
+                eta = max(self.total - completed, 0) / rate
+            return {
+                "elapsedSeconds": elapsed,
+                "completed": completed,
+                "total": self.total,
+                "etaSeconds": eta,
+                "pdbsPerSecond": rate,
+                "requests": requests,
+                "requestsPerSecond": requests / elapsed if elapsed > 0 else 0,
+                "outcomes": dict(self.outcomes),
+                "retries": self.retries,
+                "bytesReceived": self.bytesReceived,
+                "latency": {
+                    "buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], self.bucketCounts)},
+                    "sumSeconds": self.latencySum,
+                    "count": self.latencyCount,
+                    "averageSeconds": self.latencySum / self.latencyCount if self.latencyCount > 0 else None,
+                    "p50Seconds": self.getLatencyQuantile(0.5),
+                    "p95Seconds": self.getLatencyQuantile(0.95),
+                },
+            }
+
+    def toPrometheus(self): # string
+        """Returns the current metrics in Prometheus text format"""
+        snapshot = self.getSnapshot()
+        lines = []
+        lines.append("# TYPE pdb_fetch_total counter")
+        for outcome, count in snapshot["outcomes"].items():
+            lines.append('pdb_fetch_total{{outcome="{}"}} {}'.format(outcome, count))
+        lines.append("# TYPE pdb_fetch_retries_total counter")
+        lines.append("pdb_fetch_retries_total {}".format(snapshot["retries"]))
+        lines.append("# TYPE pdb_fetch_bytes_total counter")
+        lines.append("pdb_fetch_bytes_total {}".format(snapshot["bytesReceived"]))
+        lines.append("# TYPE pdb_fetch_latency_seconds histogram")
+        cumulative = 0
+        for bound, count in snapshot["latency"]["buckets"].items():
+            cumulative += count
+            lines.append('pdb_fetch_latency_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+        lines.append("pdb_fetch_latency_seconds_sum {}".format(snapshot["latency"]["sumSeconds"]))
+        lines.append("pdb_fetch_latency_seconds_count {}".format(snapshot["latency"]["count"]))
+        lines.append("# TYPE pdb_fetch_pdbs_per_second gauge")
+        lines.append("pdb_fetch_pdbs_per_second {}".format(snapshot["pdbsPerSecond"]))
+        if snapshot["total"] != None:
+            lines.append("# TYPE pdb_fetch_remaining gauge")
+            lines.append("pdb_fetch_remaining {}".format(max(snapshot["total"] - snapshot["completed"], 0)))
+        if snapshot["etaSeconds"] != None:
+            lines.append("# TYPE pdb_fetch_eta_seconds gauge")
+            lines.append("pdb_fetch_eta_seconds {}".format(snapshot["etaSeconds"]))
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Writes the metrics to exportFile. The file is replaced atomically, so a reader never sees a partial file"""
+        if Path(self.exportFile).suffix == ".prom":
+            content = self.toPrometheus()
+        else:
+            content = json.dumps(self.getSnapshot(), indent=4)
+        temporaryFile = str(self.exportFile) + ".tmp"
+        with open(temporaryFile, "w") as f:
+            f.write(content)
+        os.replace(temporaryFile, self.exportFile)
+        self.lastExport = time()
+
+    def maybeExport(self):
+        """Exports the metrics if more than exportInterval seconds have passed since the last export"""
+        if time() - self.lastExport >= self.exportInterval:
+            self.export()
+
+    def __str__(self):
+        snapshot = self.getSnapshot()
+        eta = "{:.0f}s".format(snapshot["etaSeconds"]) if snapshot["etaSeconds"] != None else "unknown"
+        return "{} pdbs fetched ({:.2f}/s), {} timeouts, {} errors, {} empty, {} retries, ETA {}".format(snapshot["completed"],
+            snapshot["pdbsPerSecond"], snapshot["outcomes"][TIMEOUT], snapshot["outcomes"][ERROR], snapshot["outcomes"][EMPTY], snapshot["retries"], eta)
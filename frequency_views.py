@@ -0,0 +1,326 @@
+import os, pickle
+from pathlib import Path
+from time import perf_counter
+import pdb_crystal_database as database
+from pdb_crystal_database import (loadStructures, countCompoundFrequencies, countSetFrequencies, writeCompoundFrequencies, writeSetFrequencies,
+    STRUCTURES_FILE)
+from misc_functions import getKey
+from snapshot_diff import HASH_LENGTH
+
+VIEWS_VERSION = 2
+
+class FrequencyViews:
+    """The compound, unknown, pending and set frequency tables of a database (see exportOutputFiles), kept up to date
+    as structures are added, updated or removed and as the compound dictionary and unknown list change, instead of recounted
+    The tables hold the same counts as countCompoundFrequencies (recognized compounds of sensible structures, unknown and
+    pending compounds of all structures) and countSetFrequencies (sets of compounds of sensible structures)
+    Besides the tables it keeps the compound names of every structure, and which structures have each name,
+    so a dictionary change only touches the names and structures it affects
+    It also keeps the content hash of every structure counted, so the views can be brought in line with a structure file
+    which was written without them (see syncStructureFile)"""
+
+    def __init__(self, compoundDictionary=None, unknownList=None):
+        self.version = VIEWS_VERSION
+        self.compoundDictionary = dict(compoundDictionary if compoundDictionary != None else database.compoundDictionary) # Copies the tables were counted with
+        self.unknownSet = set(unknownList if unknownList != None else database.unknownList)
+        self.dictionaryValues = set(self.compoundDictionary.values())
+
+        self.compoundFrequency = {"Total Compounds": 0}
+        self.unknownFrequency = {"Total Compounds": 0}
+        self.pendingFrequency = {"Total Compounds": 0}
+        self.setFrequency = {} # Maps a frozenset of compounds to the number of sensible structures with exactly those compounds
+
+        self.structureNames = {} # Maps a pdbid to the compound names of the structure (compounds[::2])
+        self.recognized = {} # Maps the pdbid of a sensible structure to the names it added to compoundFrequency
+        self.occurrences = {} # Maps a compound name to the number of times it appears in all structures
+        self.categories = {} # Maps a compound name to the table it is counted in ("unknown", "pending" or None)
+        self.postings = {} # Maps a compound name to the set of pdbids with it
+        self.namesByKey = {} # Maps a dictionary key (see getKey) to the compound names with that key
+        self.contentHashes = {} # Maps a pdbid to the content hash of the structure counted (as in a snapshot_diff manifest)
+        self.fileState = None # The state (see getFileState) of the structure file when the views last matched it, None if they were changed since
+
+    def __len__(self):
+        return len(self.structureNames)
+
+    def getCategory(self, name): # string
+        """Returns the table a compound name is counted in for every structure: "unknown", "pending" or None (see countCompoundFrequencies)"""
+        key = getKey(name)
+        if key in self.compoundDictionary:
+            return None
+        if key in self.unknownSet:
+            return "unknown"
+        if name not in self.dictionaryValues:
+            return "pending"
+        return None
+
+    def getRecognizedName(self, name): # string
+        """Returns the name a compound of a sensible structure is counted as in compoundFrequency, or None if it is not counted"""
+        name = self.compoundDictionary.get(getKey(name), name)
+        return name if name in self.dictionaryValues else None
+
+    def isSensible(self, names): # boolean
+        return names != [] and all(name in self.dictionaryValues for name in names)
+
+    def getTable(self, category): # dictionary
+        return self.unknownFrequency if category == "unknown" else self.pendingFrequency
+
+    def addStructure(self, structure):
+        """Counts a structure. If a structure with the same pdbid is already counted, it is replaced"""
+        if structure.pdbid in self.structureNames:
+            self.removeStructure(structure.pdbid)
+        names = list(structure.compounds[::2])
+        self.structureNames[structure.pdbid] = names
+        self.contentHashes[structure.pdbid] = structure.getContentHash()[:HASH_LENGTH]
+        self.fileState = None
+        for name in names:
+            if name not in self.occurrences:
+                self.occurrences[name] = 0
+                self.categories[name] = self.getCategory(name)
+                self.postings[name] = set()
+                self.namesByKey.setdefault(getKey(name), set()).add(name)
+            self.occurrences[name] += 1
+            self.postings[name].add(structure.pdbid)
+            if self.categories[name] != None:
+                addCount(self.getTable(self.categories[name]), name, 1)
+        self.addSensible(structure.pdbid)
+
+    def removeStructure(self, pdbid):
+        """Removes the counts of a structure, if it is counted"""
+        names = self.structureNames.pop(pdbid, None)
+        if names == None:
+            return
+        del self.contentHashes[pdbid]
+        self.fileState = None
+        self.removeSensible(pdbid, names)
+        for name in names:
+            self.occurrences[name] -= 1
+            if self.categories[name] != None:
+                addCount(self.getTable(self.categories[name]), name, -1)
+            if self.occurrences[name] == 0:
+                del self.occurrences[name]
+                del self.categories[name]
+                del self.postings[name]
+                self.namesByKey[getKey(name)].discard(name)
+                if not self.namesByKey[getKey(name)]:
+                    del self.namesByKey[getKey(name)]
+        for name in set(names):
+            if name in self.postings:
+                self.postings[name].discard(pdbid)
+
+    def addSensible(self, pdbid):
+        """Adds a structure to compoundFrequency and setFrequency if it is sensible"""
+        names = self.structureNames[pdbid]
+        if not self.isSensible(names):
+            return
+        recognizedNames = [recognizedName for recognizedName in (self.getRecognizedName(name) for name in names) if recognizedName != None]
+        self.recognized[pdbid] = recognizedNames
+        for recognizedName in recognizedNames:
+            addCount(self.compoundFrequency, recognizedName, 1)
+        addCount(self.setFrequency, frozenset(names), 1, hasTotal=False)
+
+    def removeSensible(self, pdbid, names):
+        recognizedNames = self.recognized.pop(pdbid, None)
+        if recognizedNames == None:
+            return
+        for recognizedName in recognizedNames:
+            addCount(self.compoundFrequency, recognizedName, -1)
+        addCount(self.setFrequency, frozenset(names), -1, hasTotal=False)
+
+    def addStructures(self, structureList):
+        """Adds or replaces the counts of a list of structures (e.g. newly fetched or reparsed ones)"""
+        for structure in structureList:
+            self.addStructure(structure)
+
+    def removeStructures(self, pdbidList):
+        for pdbid in pdbidList:
+            self.removeStructure(pdbid)
+
+    def applyChangelog(self, changelog):
+        """Applies a changelog with the changed structures (see snapshot_diff.makeChangelog) to the tables"""
+        from snapshot_diff import applyChangelog
+        self.removeStructures(changelog["removed"])
+        self.addStructures(applyChangelog([], changelog))
+
+    def syncStructureFile(self, structureFile=STRUCTURES_FILE): # int
+        """Brings the views in line with a structure file, reading it one chunk at a time: structures whose content hash
+        differs from the one counted are counted again, and structures which are not in the file any more are removed
+        Returns the number of structures added, changed or removed"""
+        from chunked_processing import iterStructureChunks
+        fileState = getFileState(structureFile)
+        changed = 0
+        pdbids = set()
+        for chunk in iterStructureChunks(structureFile):
+            for structure in chunk:
+                pdbids.add(structure.pdbid)
+                if self.contentHashes.get(structure.pdbid) != structure.getContentHash()[:HASH_LENGTH]:
+                    self.addStructure(structure)
+                    changed += 1
+        removed = set(self.structureNames) - pdbids
+        self.removeStructures(removed)
+        self.fileState = fileState
+        return changed + len(removed)
+
+    def updateDictionaries(self, compoundDictionary=None, unknownList=None): # int
+        """Moves counts between the tables after the compound dictionary or unknown list changed (by default, to the current ones)
+        Only the names whose key changed, which became or stopped being a dictionary value, and the structures with them are recounted
+        Returns the number of names affected"""
+        newDictionary = dict(compoundDictionary if compoundDictionary != None else database.compoundDictionary)
+        newUnknownSet = set(unknownList if unknownList != None else database.unknownList)
+        newValues = set(newDictionary.values())
+        changedKeys = {key for key in set(newDictionary) | set(self.compoundDictionary) if newDictionary.get(key) != self.compoundDictionary.get(key)}
+        changedKeys |= newUnknownSet ^ self.unknownSet
+        changedValues = newValues ^ self.dictionaryValues
+
+        affectedNames = set()
+        for key in changedKeys:
+            affectedNames |= self.namesByKey.get(key, set())
+        affectedNames |= changedValues & set(self.occurrences)
+        affectedPdbids = set()
+        for name in affectedNames:
+            affectedPdbids |= self.postings[name]
+
+        for pdbid in affectedPdbids:
+            self.removeSensible(pdbid, self.structureNames[pdbid])
+        self.compoundDictionary = newDictionary
+        self.unknownSet = newUnknownSet
+        self.dictionaryValues = newValues
+        for name in affectedNames:
+            category = self.getCategory(name)
+            if category != self.categories[name]:
+                if self.categories[name] != None:
+                    addCount(self.getTable(self.categories[name]), name, -self.occurrences[name])
+                if category != None:
+                    addCount(self.getTable(category), name, self.occurrences[name])
+                self.categories[name] = category
+        for pdbid in affectedPdbids:
+            self.addSensible(pdbid)
+        return len(affectedNames)
+
+    def getSensibleCount(self): # int
+        return len(self.recognized)
+
+    def verify(self, structureList): # list
+        """Recounts the tables from a structure list with countCompoundFrequencies and countSetFrequencies (with the dictionaries
+        the views were last updated with) and returns a list of (table, key, maintained count, recounted count) differences"""
+        savedDictionaries = (database.compoundDictionary, database.unknownList)
+        database.compoundDictionary, database.unknownList = self.compoundDictionary, list(self.unknownSet)
+        try:
+            sensibleStructures = [structure for structure in structureList if self.isSensible(structure.compounds[::2])]
+            recounts = {"compoundFrequency": countCompoundFrequencies(sensibleStructures, "recognized"),
+                "unknownFrequency": countCompoundFrequencies(structureList, "unknown"),
+                "pendingFrequency": countCompoundFrequencies(structureList, "pending"),
+                "setFrequency": countSetFrequencies(sensibleStructures, {})}
+        finally:
+            database.compoundDictionary, database.unknownList = savedDictionaries
+        differences = []
+        for table, recount in recounts.items():
+            maintained = getattr(self, table)
+            for key in set(maintained) | set(recount):
+                if maintained.get(key, 0) != recount.get(key, 0):
+                    differences.append((table, key, maintained.get(key, 0), recount.get(key, 0)))
+        return differences
+
+    def writeFiles(self):
+        """Writes the tables to the frequency files written by exportOutputFiles"""
+        writeCompoundFrequencies(self.compoundFrequency, database.COMPOUND_FREQUENCY_FILE, database.COMPOUND_FREQUENCY_CSV_FILE)
+        writeCompoundFrequencies(self.unknownFrequency, database.UNKNOWN_FREQUENCY_FILE, database.UNKNOWN_FREQUENCY_CSV_FILE)
+        writeCompoundFrequencies(self.pendingFrequency, database.PENDING_FREQUENCY_FILE, database.PENDING_FREQUENCY_CSV_FILE)
+        writeSetFrequencies(self.setFrequency, database.SET_FREQUENCY_FILE, database.SET_FREQUENCY_CSV_FILE)
+
+def addCount(table, key, count, hasTotal=True):
+    """Adds count to a key of a frequency table (and to its "Total Compounds"), removing keys which reach 0 as a recount would"""
+    newCount = table.get(key, 0) + count
+    if newCount == 0:
+        table.pop(key, None)
+    else:
+        table[key] = newCount
+    if hasTotal:
+        table["Total Compounds"] += count
+
+def getFileState(structureFile): # tuple
+    """Returns the size and modification time of a structure file and of its sidecar files (e.g. the SQLite -wal file),
+    or of every file in it if it is a directory (shards), to tell cheaply whether it was written since"""
+    structureFile = Path(structureFile)
+    if structureFile.is_dir():
+        paths = sorted(path for path in structureFile.rglob("*") if path.is_file())
+    else:
+        paths = [structureFile] + sorted(structureFile.parent.glob(structureFile.name + "-*"))
+    state = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        state.append((str(path), stat.st_size, stat.st_mtime_ns))
+    return tuple(state)
+
+def getViewsFile(structureFile=STRUCTURES_FILE): # Path
+    """Returns the file the frequency views of a structure file are saved in, next to it (structures.pkl --> structures.frequencies.pkl)"""
+    structureFile = Path(structureFile)
+    return structureFile.with_name(structureFile.stem + ".frequencies.pkl")
+
+def buildFrequencyViews(structureList): # FrequencyViews
+    """Counts a list of structures from scratch with the current dictionaries"""
+    views = FrequencyViews()
+    views.addStructures(structureList)
+    return views
+
+def buildFileFrequencyViews(structureFile=STRUCTURES_FILE): # FrequencyViews
+    """Counts a structure file from scratch with the current dictionaries, one chunk at a time"""
+    views = FrequencyViews()
+    views.syncStructureFile(structureFile)
+    return views
+
+def saveFrequencyViews(views, structureFile=STRUCTURES_FILE):
+    viewsFile = getViewsFile(structureFile)
+    temporaryFile = str(viewsFile) + ".tmp"
+    with open(temporaryFile, "wb") as f:
+        pickle.dump(views, f)
+    os.replace(temporaryFile, viewsFile)
+
+def loadFrequencyViews(structureFile=STRUCTURES_FILE, updateDictionaries=True): # FrequencyViews
+    """Returns the saved frequency views of a structure file, or counts them from the structure file if there are none
+    If the structure file was written since the views last matched it (e.g. by fetchStructures, refreshStructures or
+    processInChunks), only the structures which changed are counted again (see syncStructureFile)
+    If updateDictionaries is True, the views are updated to the current compound dictionary and unknown list"""
+    viewsFile = getViewsFile(structureFile)
+    views = None
+    if viewsFile.exists():
+        with open(viewsFile, "rb") as f:
+            views = pickle.load(f)
+        if getattr(views, "version", None) != VIEWS_VERSION:
+            print("{} was saved by a different version. Counting again...".format(viewsFile))
+            views = None
+    if views == None:
+        print("Counting frequency views of {}...".format(structureFile))
+        views = buildFileFrequencyViews(structureFile)
+        saveFrequencyViews(views, structureFile)
+        return views
+    if views.fileState != getFileState(structureFile):
+        print("{} was written since its frequency views were saved. Updating them...".format(structureFile))
+        changed = views.syncStructureFile(structureFile)
+        print("{} structures were added, changed or removed".format(changed))
+        saveFrequencyViews(views, structureFile)
+    if updateDictionaries:
+        affected = views.updateDictionaries()
+        if affected > 0:
+            print("Dictionary changes affected {} compound names".format(affected))
+    return views
+
+def verifyFrequencyViews(views, structureList): # boolean
+    """Prints the differences between frequency views and a full recount, and returns True if there are none"""
+    start = perf_counter()
+    differences = views.verify(structureList)
+    for table, key, maintained, recount in sorted(differences, key=str)[:20]:
+        print("{}: {} is {} but a recount gives {}".format(table, key, maintained, recount))
+    print("Verified {} structures in {:.1f} s: {} differences".format(len(structureList), perf_counter() - start, len(differences)))
+    return differences == []
+
+if __name__ == "__main__":
+    # After fetching new structures (or editing the dictionaries), update the tables instead of recounting them
+    views = loadFrequencyViews(STRUCTURES_FILE)
+    # views.addStructures(newStructures)
+    # views.applyChangelog(snapshot_diff.loadChangelog())
+    views.writeFiles()
+    saveFrequencyViews(views, STRUCTURES_FILE) # Views changed in memory are checked against the structure file again when loaded
+    # verifyFrequencyViews(views, loadStructures(STRUCTURES_FILE))
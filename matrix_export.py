@@ -0,0 +1,182 @@
+import math, os
+from array import array
+from pathlib import Path
+from time import perf_counter
+import pdb_crystal_database as database
+from pdb_crystal_database import parseConcentration, isSensible, STRUCTURES_FILE, STRUCTURE_DIR
+
+MATRIX_FILE = STRUCTURE_DIR / "sensible_matrix.npz"
+
+class StructureMatrix:
+    """A sparse structures x compounds matrix of concentrations, built one structure at a time
+    Rows are structures and columns are the canonical compounds (the values of the compound dictionary, in sorted order,
+    so the column of a compound only changes when the dictionary does). An entry is stored for every compound
+    of a structure, with the parsed concentration as its value (NaN if the concentration is unknown)
+    and the units of the concentration as a separate code (see units). The arrays are kept in compact
+    typed arrays in the CSR layout (data, indices, indptr), together with aligned pH, temperature and resolution arrays"""
+
+    def __init__(self, compounds=None):
+        if compounds == None:
+            compounds = sorted(set(database.compoundDictionary.values()))
+        self.compounds = compounds # Column names
+        self.columns = {compound: i for i, compound in enumerate(compounds)}
+        self.units = [] # Unit names, indexed by the codes in unitCodes
+        self.unitIds = {}
+        self.pdbids = [] # Row names
+        self.data = array("d")
+        self.unitCodes = array("h")
+        self.indices = array("i")
+        self.indptr = array("q", [0])
+        self.pH = array("d")
+        self.temperature = array("d")
+        self.resolution = array("d")
+        self.skippedCompounds = 0 # Compounds which are not dictionary values (only possible for structures which are not sensible)
+
+    def __len__(self):
+        return len(self.pdbids)
+
+    def getShape(self): # tuple
+        return (len(self.pdbids), len(self.compounds))
+
+    def getUnitCode(self, units): # int
+        if units == None:
+            return -1
+        code = self.unitIds.get(units)
+        if code == None:
+            code = len(self.units)
+            self.unitIds[units] = code
+            self.units.append(units)
+        return code
+
+    def addStructure(self, structure):
+        seen = set()
+        entries = []
+        for i in range(0, len(structure.compounds), 2):
+            column = self.columns.get(structure.compounds[i])
+            if column == None:
+                self.skippedCompounds += 1
+                continue
+            if column in seen:
+                continue # Keep the first concentration of a compound which appears twice
+            seen.add(column)
+            value, units = parseConcentration(structure.compounds[i+1])
+            entries.append((column, value if value != None else math.nan, self.getUnitCode(units)))
+        entries.sort() # CSR column indices are sorted within a row
+        for column, value, code in entries:
+            self.indices.append(column)
+            self.data.append(value)
+            self.unitCodes.append(code)
+        self.indptr.append(len(self.indices))
+        self.pdbids.append(structure.pdbid)
+        self.pH.append(getNumber(structure.pH))
+        self.temperature.append(getNumber(structure.temperature))
+        self.resolution.append(getNumber(structure.resolution))
+
+    def addStructures(self, structureList, sensibleOnly=True):
+        dictionaryValues = set(self.compounds)
+        for structure in structureList:
+            if not sensibleOnly or isSensible(structure, dictionaryValues):
+                self.addStructure(structure)
+
+def getNumber(value): # float
+    """Returns a float for a pH, temperature or resolution, using NaN for None or values which are not numbers"""
+    try:
+        return float(value) if value != None else math.nan
+    except (TypeError, ValueError):
+        return math.nan
+
+def buildMatrix(source=STRUCTURES_FILE, sensibleOnly=True, chunkSize=5000): # StructureMatrix
+    """Builds a StructureMatrix from a list of structures or a structure file
+    Structure files are read one chunk at a time (see chunked_processing.py), so only the matrix is held in memory"""
+    matrix = StructureMatrix()
+    if isinstance(source, list):
+        matrix.addStructures(source, sensibleOnly)
+    else:
+        from chunked_processing import iterStructureChunks
+        for chunk in iterStructureChunks(source, chunkSize):
+            matrix.addStructures(chunk, sensibleOnly)
+    return matrix
+
+def writeNpz(matrix, outputFile=MATRIX_FILE):
+    """Writes a matrix to a compressed NumPy .npz file (requires numpy)
+    The CSR arrays use the names and layout of scipy.sparse.save_npz, so scipy.sparse.load_npz(outputFile) returns the
+    concentration matrix. The file also holds unitCodes (aligned with data), units, pdbids, compounds, pH, temperature and resolution"""
+    try:
+        import numpy
+    except ImportError:
+        print("ERROR: numpy is required to write .npz files. Install it with 'pip install numpy' or write a Matrix Market file (.mtx)")
+        raise
+    print("Writing matrix to {}...".format(outputFile))
+    temporaryFile = str(outputFile) + ".tmp.npz" # numpy adds .npz to names without it
+    numpy.savez_compressed(temporaryFile,
+        format=numpy.array(b"csr"),
+        shape=numpy.array(matrix.getShape(), dtype=numpy.int64),
+        data=numpy.frombuffer(matrix.data, dtype=numpy.float64),
+        indices=numpy.frombuffer(matrix.indices, dtype=numpy.int32),
+        indptr=numpy.frombuffer(matrix.indptr, dtype=numpy.int64),
+        unitCodes=numpy.frombuffer(matrix.unitCodes, dtype=numpy.int16),
+        units=numpy.array(matrix.units, dtype=str),
+        pdbids=numpy.array(matrix.pdbids, dtype=str),
+        compounds=numpy.array(matrix.compounds, dtype=str),
+        pH=numpy.frombuffer(matrix.pH, dtype=numpy.float64),
+        temperature=numpy.frombuffer(matrix.temperature, dtype=numpy.float64),
+        resolution=numpy.frombuffer(matrix.resolution, dtype=numpy.float64))
+    os.replace(temporaryFile, outputFile)
+
+def getMatrixMarketFiles(outputFile): # dictionary
+    """Returns the files written by writeMatrixMarket next to a .mtx file"""
+    stem = str(outputFile)[:-len(".mtx")] if str(outputFile).endswith(".mtx") else str(outputFile)
+    return {"matrix": stem + ".mtx", "units": stem + ".units.mtx", "rows": stem + ".rows.tsv", "columns": stem + ".columns.tsv",
+        "unitNames": stem + ".units.tsv"}
+
+def writeMatrixMarket(matrix, outputFile=STRUCTURE_DIR / "sensible_matrix.mtx"):
+    """Writes a matrix in Matrix Market coordinate format, which needs no extra libraries to write or read
+    Also writes the unit codes as a second integer matrix with the same entries (.units.mtx), the rows (pdbid, pH,
+    temperature and resolution) and columns (compounds) as tab-separated files, and the unit names (.units.tsv)"""
+    files = getMatrixMarketFiles(outputFile)
+    print("Writing matrix to {}...".format(files["matrix"]))
+    rows, columns = matrix.getShape()
+    with open(files["matrix"], "w") as f, open(files["units"], "w") as unitsFile:
+        f.write("%%MatrixMarket matrix coordinate real general\n% Concentrations of structures (rows) x compounds (columns)\n")
+        unitsFile.write("%%MatrixMarket matrix coordinate integer general\n% Unit codes of the concentrations (see .units.tsv, -1 is unknown)\n")
+        for outputFileObject in (f, unitsFile):
+            outputFileObject.write("{} {} {}\n".format(rows, columns, len(matrix.data)))
+        for row in range(rows):
+            for position in range(matrix.indptr[row], matrix.indptr[row+1]):
+                f.write("{} {} {!r}\n".format(row+1, matrix.indices[position]+1, matrix.data[position]))
+                unitsFile.write("{} {} {}\n".format(row+1, matrix.indices[position]+1, matrix.unitCodes[position]))
+    with open(files["rows"], "w") as f:
+        f.write("pdbid\tpH\ttemperature\tresolution\n")
+        for i, pdbid in enumerate(matrix.pdbids):
+            f.write("{}\t{!r}\t{!r}\t{!r}\n".format(pdbid, matrix.pH[i], matrix.temperature[i], matrix.resolution[i]))
+    with open(files["columns"], "w") as f:
+        f.write("compound\n")
+        for compound in matrix.compounds:
+            f.write(compound + "\n")
+    with open(files["unitNames"], "w") as f:
+        f.write("code\tunits\n")
+        for code, units in enumerate(matrix.units):
+            f.write("{}\t{}\n".format(code, units))
+
+def exportMatrix(source=STRUCTURES_FILE, outputFile=MATRIX_FILE, sensibleOnly=True, chunkSize=5000): # StructureMatrix
+    """Exports the (sensible) structures of a structure list or file as a sparse concentration matrix
+    The format depends on the suffix of outputFile: .npz (NumPy, requires numpy) or .mtx (Matrix Market)"""
+    start = perf_counter()
+    matrix = buildMatrix(source, sensibleOnly, chunkSize)
+    if Path(outputFile).suffix == ".mtx":
+        writeMatrixMarket(matrix, outputFile)
+    else:
+        writeNpz(matrix, outputFile)
+    rows, columns = matrix.getShape()
+    print("Exported a {} x {} matrix with {} entries in {:.1f} s".format(rows, columns, len(matrix.data), perf_counter() - start))
+    return matrix
+
+if __name__ == "__main__":
+    exportMatrix(STRUCTURES_FILE, MATRIX_FILE)
+    # exportMatrix(STRUCTURES_FILE, STRUCTURE_DIR / "sensible_matrix.mtx")
+
+    # Loading the matrix:
+    # import numpy, scipy.sparse
+    # matrix = scipy.sparse.load_npz(MATRIX_FILE)
+    # arrays = numpy.load(MATRIX_FILE)
+    # pdbids, compounds, pH = arrays["pdbids"], arrays["compounds"], arrays["pH"]
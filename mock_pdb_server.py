@@ -0,0 +1,259 @@
+import json, threading, tempfile, random
+import xml.etree.ElementTree as etree
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+import download_structures
+from details_index import loadDetailsIndex
+from misc_functions import loadJson
+
+# Columns of a customReport record, and the value used when a record does not set them
+REPORT_COLUMNS = {
+    "dimStructure.pdbxDetails": "null",
+    "dimStructure.pmc": "null",
+    "dimStructure.phValue": "null",
+    "dimStructure.crystallizationTempK": "null",
+    "dimStructure.crystallizationMethod": "null",
+    "dimStructure.resolution": "null",
+}
+
+# Kinds of fault a FaultProfile can inject into a customReport response
+NO_FAULT = "ok"
+TIMEOUT_FAULT = "timeout" # No response until the client gives up
+SERVER_ERROR_FAULT = "serverError" # A 500, 502 or 503 status
+MALFORMED_FAULT = "malformed" # Truncated xml, or a record which is missing columns
+NULL_FAULT = "null" # Some columns of the record are "null"
+FAULTS = [NO_FAULT, TIMEOUT_FAULT, SERVER_ERROR_FAULT, MALFORMED_FAULT, NULL_FAULT]
+
+class FaultProfile:
+    """Describes how a MockPdbServer misbehaves when serving customReport requests
+    Every response is delayed by a latency drawn from a lognormal distribution with median latency seconds
+    (latencySpread is its sigma, 0 for a fixed latency), and each fault is injected into a fraction of responses"""
+
+    def __init__(self, name="clean", latency=0.0, latencySpread=0.0, timeoutRate=0.0, serverErrorRate=0.0, malformedRate=0.0,
+            nullRate=0.0, hangTime=30.0):
+        self.name = name
+        self.latency = latency
+        self.latencySpread = latencySpread
+        self.rates = {TIMEOUT_FAULT: timeoutRate, SERVER_ERROR_FAULT: serverErrorRate, MALFORMED_FAULT: malformedRate, NULL_FAULT: nullRate}
+        self.hangTime = hangTime # Seconds a timed out request is held before the connection is closed
+
+    def getLatency(self, rng): # float
+        if self.latencySpread == 0:
+            return self.latency
+        return self.latency * rng.lognormvariate(0, self.latencySpread)
+
+    def chooseFault(self, rng): # string
+        value = rng.random()
+        for fault, rate in self.rates.items():
+            if value < rate:
+                return fault
+            value -= rate
+        return NO_FAULT
+
+    def __str__(self):
+        faults = ", ".join("{} {:.0%}".format(fault, rate) for fault, rate in self.rates.items() if rate > 0)
+        return "{} (latency {:.0f} ms{}{})".format(self.name, self.latency * 1000,
+            " lognormal sigma {}".format(self.latencySpread) if self.latencySpread > 0 else "", ", " + faults if faults != "" else "")
+
+class MockPdbServer:
+    """A local stand-in for the PDB web services used by download_structures.py
+    Serves the list of current pdbids (getCurrent) and customReport xml files from a dictionary of records,
+    which can be changed while the server is running to script upstream additions, removals and revisions.
+    A record is a dictionary mapping report columns (see REPORT_COLUMNS) to values, plus a list of "sequences"
+    A FaultProfile adds latency and injects timeouts, server errors, malformed xml and null fields (see fetch_benchmark.py)"""
+
+    def __init__(self, records=None, port=0, faultProfile=None, seed=0):
+        self.records = dict(records) if records != None else {} # Maps a pdbid to its record
+        self.idList = None # The pdbids returned by getCurrent (None means every pdbid in records)
+        self.requestCounts = {} # Maps a pdbid to the number of times its report was requested
+        self.faultProfile = faultProfile if faultProfile != None else FaultProfile()
+        self.random = random.Random(seed)
+        self.faultCounts = {fault: 0 for fault in FAULTS} # Counts the responses served with each fault
+        self.lastFaults = {} # Maps a pdbid to the fault of the last response served for it
+        self.stopEvent = threading.Event() # Set when the server stops, so requests which are being held can finish
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.getHandler())
+        self.server.daemon_threads = True
+        self.thread = None
+        self.originalUrls = None
+
+    def getHandler(self): # class
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith("getCurrent"):
+                    mock.sendResponse(self, "application/json", json.dumps({"idList": mock.getIdList()}).encode())
+                elif url.path.endswith("customReport.xml"):
+                    pdbid = parse_qs(url.query).get("pdbids", [""])[0]
+                    mock.sendReport(self, pdbid)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass # Keep the output of the scripts which use the server readable
+        return Handler
+
+    def sendReport(self, handler, pdbid):
+        """Sends the customReport for a pdbid, with the latency and faults of the fault profile"""
+        profile = self.faultProfile
+        with self.lock:
+            latency = profile.getLatency(self.random)
+            fault = profile.chooseFault(self.random)
+            self.faultCounts[fault] += 1
+            self.lastFaults[pdbid] = fault
+            nullColumns = self.random.sample(list(REPORT_COLUMNS), self.random.randint(1, len(REPORT_COLUMNS))) if fault == NULL_FAULT else []
+            truncate = self.random.random() < 0.5
+            errorStatus = self.random.choice([500, 502, 503])
+        if latency > 0:
+            self.stopEvent.wait(latency)
+        try:
+            if fault == TIMEOUT_FAULT:
+                self.stopEvent.wait(profile.hangTime)
+                return # Close the connection without answering
+            if fault == SERVER_ERROR_FAULT:
+                handler.send_error(errorStatus)
+                return
+            body = self.getReport(pdbid, nullColumns)
+            if fault == MALFORMED_FAULT:
+                if truncate:
+                    body = body[:len(body) // 2]
+                else:
+                    body = body.replace(b"dimStructure.phValue", b"dimStructure.phVal")
+            self.sendResponse(handler, "text/xml", body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # The client gave up waiting
+
+    def sendResponse(self, handler, contentType, body):
+        handler.send_response(200)
+        handler.send_header("Content-Type", contentType)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def getIdList(self): # list
+        with self.lock:
+            return list(self.idList) if self.idList != None else list(self.records)
+
+    def getReport(self, pdbid, nullColumns=()): # bytes
+        """Returns the customReport xml for a pdbid, with one <record> per sequence like the real service
+        Unknown pdbids return a dataset without records. Columns in nullColumns are "null" """
+        with self.lock:
+            self.requestCounts[pdbid] = self.requestCounts.get(pdbid, 0) + 1
+            record = self.records.get(pdbid)
+        dataset = etree.Element("dataset")
+        if record != None:
+            for sequence in record.get("sequences", ["null"]) or ["null"]:
+                recordElement = etree.SubElement(dataset, "record")
+                etree.SubElement(recordElement, "dimStructure.structureId").text = pdbid
+                for column, default in REPORT_COLUMNS.items():
+                    value = record.get(column, default) if column not in nullColumns else None
+                    etree.SubElement(recordElement, column).text = default if value == None else str(value)
+                etree.SubElement(recordElement, "dimEntity.sequence").text = sequence
+        return etree.tostring(dataset)
+
+    def setRecord(self, pdbid, **columns):
+        """Adds or replaces the record for a pdbid. Keyword arguments are report columns without the "dimStructure." prefix
+        (e.g. pdbxDetails="...", phValue=7.0) or sequences=[...]"""
+        record = {}
+        for column, value in columns.items():
+            record[column if column == "sequences" else "dimStructure." + column] = value
+        with self.lock:
+            self.records[pdbid] = record
+
+    def removeRecord(self, pdbid):
+        """Removes a pdbid, as if it was made obsolete upstream"""
+        with self.lock:
+            self.records.pop(pdbid, None)
+
+    def setFaultProfile(self, faultProfile):
+        """Changes the fault profile and resets the fault counts"""
+        with self.lock:
+            self.faultProfile = faultProfile
+            self.faultCounts = {fault: 0 for fault in FAULTS}
+            self.lastFaults = {}
+
+    def getUrl(self): # string
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """Starts serving in a background thread and points download_structures at the server"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.originalUrls = (download_structures.CUSTOM_REPORT_URL, download_structures.GET_CURRENT_URL)
+        download_structures.CUSTOM_REPORT_URL = self.getUrl() + "/pdb/rest/customReport.xml?pdbids="
+        download_structures.GET_CURRENT_URL = self.getUrl() + "/pdb/json/getCurrent"
+
+    def stop(self):
+        """Stops the server and points download_structures back at the PDB"""
+        self.stopEvent.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.originalUrls != None:
+            download_structures.CUSTOM_REPORT_URL, download_structures.GET_CURRENT_URL = self.originalUrls
+            self.originalUrls = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+def runRefreshScenario(): # boolean
+    """Checks refreshStructures against a scripted sequence of upstream changes, without touching the real files
+    Returns True if every check passed"""
+    server = MockPdbServer()
+    server.setRecord("1AAA", pdbxDetails="20% PEG 3350, 0.1 M HEPES pH 7.5", phValue=7.5, sequences=["MKV"])
+    server.setRecord("1BBB", pdbxDetails="1.5 M ammonium sulfate", phValue=6.0, sequences=["GSH", "MAA"])
+    server.setRecord("1CCC", sequences=["MTT"]) # No details
+    server.setRecord("1DDD", pdbxDetails="0.2 M sodium chloride", resolution=2.1, sequences=["MLL"])
+
+    savedFile = download_structures.WITHOUT_DETAILS_FILE
+    passed = True
+    with tempfile.TemporaryDirectory() as directory, server:
+        directory = Path(directory)
+        download_structures.WITHOUT_DETAILS_FILE = directory / "pdbs_without_details.json"
+        structureFile = directory / "structures.pkl"
+        fetchLogFile = directory / "fetch_log.json"
+        detailsIndexFile = directory / "details_index.pkl"
+        try:
+            checks = []
+            result = download_structures.refreshStructures(structureFile, fetchLogFile=fetchLogFile, detailsIndexFile=detailsIndexFile)
+            checks.append(("first refresh adds everything", result["added"] == {"1AAA", "1BBB", "1CCC", "1DDD"}))
+
+            result = download_structures.refreshStructures(structureFile, fetchLogFile=fetchLogFile)
+            checks.append(("nothing is refetched when nothing is stale", result["added"] == set() and result["stale"] == set()))
+
+            # Revise one entry, obsolete another, release a new one and add details to the entry without details
+            server.setRecord("1AAA", pdbxDetails="25% PEG 3350, 0.1 M HEPES pH 7.5", phValue=7.5, sequences=["MKV"])
+            server.removeRecord("1BBB")
+            server.setRecord("1EEE", pdbxDetails="10% MPD", sequences=["MEE"])
+            server.setRecord("1CCC", pdbxDetails="2 M sodium formate", sequences=["MTT"])
+            result = download_structures.refreshStructures(structureFile, maxAge=0, fetchLogFile=fetchLogFile, detailsIndexFile=detailsIndexFile)
+            structures = {structure.pdbid: structure for structure in download_structures.loadStructures(structureFile)}
+            checks.append(("added entries are fetched", result["added"] == {"1EEE"} and "1EEE" in structures))
+            checks.append(("removed entries are dropped", result["removed"] == {"1BBB"} and "1BBB" not in structures))
+            checks.append(("revised entries are detected", result["revised"] == {"1AAA", "1CCC"}))
+            checks.append(("revised entries are updated", structures["1AAA"].details.startswith("25%") and "1CCC" in structures))
+            checks.append(("unchanged entries are kept", structures["1DDD"].resolution == 2.1))
+            checks.append(("removed entries are dropped from the details index", "1BBB" not in loadDetailsIndex(detailsIndexFile)))
+
+            # Remove the details of an entry
+            server.setRecord("1DDD", resolution=2.1, sequences=["MLL"])
+            result = download_structures.refreshStructures(structureFile, maxAge=0, fetchLogFile=fetchLogFile, detailsIndexFile=detailsIndexFile)
+            structures = {structure.pdbid: structure for structure in download_structures.loadStructures(structureFile)}
+            checks.append(("entries whose details were removed are dropped", "1DDD" not in structures and "1DDD" in loadJson(download_structures.WITHOUT_DETAILS_FILE)))
+            checks.append(("entries whose details were removed are dropped from the details index", "1DDD" not in loadDetailsIndex(detailsIndexFile)))
+
+            for name, ok in checks:
+                print("{}: {}".format("PASSED" if ok else "FAILED", name))
+                passed = passed and ok
+        finally:
+            download_structures.WITHOUT_DETAILS_FILE = savedFile
+    return passed
+
+if __name__ == "__main__":
+    runRefreshScenario()
@@ -0,0 +1,219 @@
+import os, random, importlib.util, multiprocessing
+from collections import OrderedDict
+from pathlib import Path
+from time import perf_counter, process_time
+import pdb_crystal_database
+from pdb_crystal_database import (loadStructures, STRUCTURES_FILE, INPUT_DIR, OUTPUT_DIR, UNKNOWN_LIST_FILE, COMPOUND_DICTIONARY_FILE,
+    LOWERCASE_REPLACEMENT_FILE, SENSITIVE_REPLACEMENT_FILE, MIXTURES_FILE, STOP_WORDS_FILE)
+from misc_functions import loadJson
+
+PARSER_DIFF_FILE = OUTPUT_DIR / "parser_diff.txt"
+
+CHUNK_SIZE = 500 # Structures sent to a worker process at once
+EXAMPLES = 20 # Examples written to the report for each change type
+
+CHANGE_TYPES = ["compoundsAdded", "compoundsRemoved", "concentrationsChanged", "orderChanged", "becameSensible", "becameNonsensible",
+    "parseErrorIntroduced", "parseErrorFixed"]
+
+class ParserConfig:
+    """A parser configuration: the input files (replacement lists, stop words, compound dictionary...) in inputDir
+    and the parsing code in moduleFile (a copy of pdb_crystal_database.py, or None for the current one)
+    To try a change, copy the Input folder or the script, edit the copy and compare it to the current configuration"""
+
+    def __init__(self, name, inputDir=INPUT_DIR, moduleFile=None, standardize=True):
+        self.name = name
+        self.inputDir = Path(inputDir)
+        self.moduleFile = moduleFile
+        self.standardize = standardize # Also standardize the compound names, as standardizeAllNames does
+
+    def __str__(self):
+        return "{} (input: {}, code: {}{})".format(self.name, self.inputDir, self.moduleFile or "pdb_crystal_database.py",
+            ", standardized" if self.standardize else "")
+
+def loadParserModule(config): # module
+    """Returns a pdb_crystal_database module set up with the input files and code of a configuration
+    Configurations with their own input files get their own copy of the module, so two configurations never share dictionaries"""
+    if config.moduleFile == None and config.inputDir == INPUT_DIR:
+        module = pdb_crystal_database
+    else:
+        spec = importlib.util.spec_from_file_location("parser_config_" + config.name, config.moduleFile or pdb_crystal_database.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    if config.inputDir != INPUT_DIR:
+        module.unknownList = loadJson(config.inputDir / UNKNOWN_LIST_FILE.name)
+        module.compoundDictionary = loadJson(config.inputDir / COMPOUND_DICTIONARY_FILE.name)
+        module.lowercaseReplacement = loadJson(config.inputDir / LOWERCASE_REPLACEMENT_FILE.name, object_pairs_hook=OrderedDict)
+        module.sensitiveReplacement = loadJson(config.inputDir / SENSITIVE_REPLACEMENT_FILE.name, object_pairs_hook=OrderedDict)
+        module.mixturesDictionary = loadJson(config.inputDir / MIXTURES_FILE.name)
+        module.STOP_WORDS = set(loadJson(config.inputDir / STOP_WORDS_FILE.name)) - {'m'} - {'am'}
+        module.expansionTable = None
+    module.importNLTK()
+    return module
+
+# Set in each worker process by initWorker
+workerConfigs = None
+workerModules = None
+
+def initWorker(configs):
+    global workerConfigs, workerModules
+    workerConfigs = configs
+    workerModules = [loadParserModule(config) for config in configs]
+
+def parseWith(module, config, pdbid, details): # list
+    """Returns the compounds a configuration parses from a details string, or None if parsing fails"""
+    structure = module.Structure(pdbid, None, details, [], None, None, None, [], None)
+    try:
+        structure.parseDetails()
+        if config.standardize:
+            structure.standardizeNames()
+    except Exception:
+        return None
+    return structure.compounds
+
+def isSensible(compounds, dictionaryValues): # boolean
+    return compounds != None and compounds != [] and all(compound in dictionaryValues for compound in compounds[::2])
+
+def compareChunk(chunk): # tuple
+    """Parses a chunk of (pdbid, details) pairs with both configurations, one structure at a time so both see the same load
+    Returns the structures whose compounds or sensibility differ, the CPU seconds of each configuration and the sensible counts"""
+    dictionaryValues = [set(module.compoundDictionary.values()) for module in workerModules]
+    times = [0.0, 0.0]
+    sensibleCounts = [0, 0]
+    differences = []
+    for pdbid, details in chunk:
+        results = []
+        for i in range(2):
+            start = process_time()
+            results.append(parseWith(workerModules[i], workerConfigs[i], pdbid, details))
+            times[i] += process_time() - start
+        sensible = [isSensible(results[i], dictionaryValues[i]) for i in range(2)]
+        sensibleCounts[0] += sensible[0]
+        sensibleCounts[1] += sensible[1]
+        if results[0] != results[1] or sensible[0] != sensible[1]:
+            differences.append((pdbid, details, results[0], results[1], sensible[0], sensible[1]))
+    return differences, times, sensibleCounts
+
+def getChangeTypes(before, after, sensibleBefore, sensibleAfter): # list
+    """Returns the kinds of change between two compound lists of the same structure (see CHANGE_TYPES)"""
+    changeTypes = []
+    if before == None or after == None:
+        if before != None:
+            changeTypes.append("parseErrorIntroduced")
+        elif after != None:
+            changeTypes.append("parseErrorFixed")
+    elif before != after:
+        concentrationsBefore = dict(reversed(list(zip(before[::2], before[1::2])))) # First concentration of each compound
+        concentrationsAfter = dict(reversed(list(zip(after[::2], after[1::2]))))
+        if set(concentrationsAfter) - set(concentrationsBefore):
+            changeTypes.append("compoundsAdded")
+        if set(concentrationsBefore) - set(concentrationsAfter):
+            changeTypes.append("compoundsRemoved")
+        if any(concentrationsBefore[c] != concentrationsAfter[c] for c in set(concentrationsBefore) & set(concentrationsAfter)):
+            changeTypes.append("concentrationsChanged")
+        if changeTypes == []:
+            changeTypes.append("orderChanged")
+    if sensibleAfter and not sensibleBefore:
+        changeTypes.append("becameSensible")
+    if sensibleBefore and not sensibleAfter:
+        changeTypes.append("becameNonsensible")
+    return changeTypes
+
+class ParserDiff:
+    """The result of comparing two parser configurations (see compareParsers)"""
+
+    def __init__(self, configs, structureCount):
+        self.configs = configs
+        self.structureCount = structureCount
+        self.changes = {changeType: [] for changeType in CHANGE_TYPES} # Maps a change type to a list of differences
+        self.changedCount = 0
+        self.cpuTimes = [0.0, 0.0] # CPU seconds spent parsing by each configuration, summed over the workers
+        self.sensibleCounts = [0, 0]
+        self.compoundChanges = {} # Maps "+compound" or "-compound" to the number of structures which gained or lost it
+        self.wallTime = 0.0
+
+    def addChunkResult(self, differences, times, sensibleCounts):
+        for i in range(2):
+            self.cpuTimes[i] += times[i]
+            self.sensibleCounts[i] += sensibleCounts[i]
+        for difference in differences:
+            pdbid, details, before, after, sensibleBefore, sensibleAfter = difference
+            changeTypes = getChangeTypes(before, after, sensibleBefore, sensibleAfter)
+            if before != after:
+                self.changedCount += 1
+            for changeType in changeTypes:
+                self.changes[changeType].append(difference)
+            if before != None and after != None:
+                for compound in set(after[::2]) - set(before[::2]):
+                    self.compoundChanges["+" + compound] = self.compoundChanges.get("+" + compound, 0) + 1
+                for compound in set(before[::2]) - set(after[::2]):
+                    self.compoundChanges["-" + compound] = self.compoundChanges.get("-" + compound, 0) + 1
+
+    def getReport(self, examples=EXAMPLES): # list
+        lines = []
+        lines.append("Compared {} structures in {:.1f} s".format(self.structureCount, self.wallTime))
+        for i in range(2):
+            perStructure = self.cpuTimes[i] / self.structureCount * 1000 if self.structureCount > 0 else 0
+            lines.append("{} {}: {:.1f} CPU s ({:.3f} ms per structure), {} sensible".format("A" if i == 0 else "B", self.configs[i],
+                self.cpuTimes[i], perStructure, self.sensibleCounts[i]))
+        if self.cpuTimes[0] > 0:
+            lines.append("Parse time change: {:+.1f}%".format((self.cpuTimes[1] / self.cpuTimes[0] - 1) * 100))
+        lines.append("Sensible structures: {} --> {} ({:+d})".format(self.sensibleCounts[0], self.sensibleCounts[1],
+            self.sensibleCounts[1] - self.sensibleCounts[0]))
+        lines.append("Structures with different compounds: {}".format(self.changedCount))
+        for changeType in CHANGE_TYPES:
+            lines.append("{:22s}: {:8d}".format(changeType, len(self.changes[changeType])))
+
+        lines.append("")
+        lines.append("Compounds gained (+) or lost (-), by number of structures:")
+        for compound, count in sorted(self.compoundChanges.items(), key=lambda item: item[1], reverse=True)[:examples]:
+            lines.append("{:50s}: {:8d}".format(compound, count))
+
+        for changeType in CHANGE_TYPES:
+            if self.changes[changeType] == []:
+                continue
+            lines.append("")
+            lines.append("----- {} ({} structures) -----".format(changeType, len(self.changes[changeType])))
+            for pdbid, details, before, after, sensibleBefore, sensibleAfter in self.changes[changeType][:examples]:
+                lines.append("{}: {}".format(pdbid, details))
+                lines.append("    A: {}".format(before))
+                lines.append("    B: {}".format(after))
+        return lines
+
+def compareParsers(configA, configB, structureList=None, structureFile=STRUCTURES_FILE, sampleSize=None, seed=0,
+        processes=None, chunkSize=CHUNK_SIZE, reportFile=PARSER_DIFF_FILE): # ParserDiff
+    """Parses the details of a structure list (or a random sample of sampleSize structures) with two parser configurations
+    side by side in a pool of worker processes, and reports which structures changed (grouped by change type),
+    the parse time of each configuration and the change in the number of sensible structures
+    The report is printed and written to reportFile"""
+    if structureList == None:
+        structureList = loadStructures(structureFile)
+    structures = [structure for structure in structureList if structure.details != None]
+    if sampleSize != None and sampleSize < len(structures):
+        structures = random.Random(seed).sample(structures, sampleSize)
+    chunks = [[(s.pdbid, s.details) for s in structures[i:i+chunkSize]] for i in range(0, len(structures), chunkSize)]
+    configs = [configA, configB]
+    processes = processes or os.cpu_count()
+    print("Comparing parser configurations on {} structures with {} processes...".format(len(structures), processes))
+
+    diff = ParserDiff(configs, len(structures))
+    start = perf_counter()
+    with multiprocessing.Pool(processes, initializer=initWorker, initargs=(configs,)) as pool:
+        for count, result in enumerate(pool.imap(compareChunk, chunks)):
+            diff.addChunkResult(*result)
+            if (count+1) % 20 == 0:
+                print("Compared {} of {} chunks...".format(count+1, len(chunks)))
+    diff.wallTime = perf_counter() - start
+
+    report = diff.getReport()
+    for line in report[:len(CHANGE_TYPES) + 6]:
+        print(line)
+    if reportFile != None:
+        print("Writing report to {}...".format(reportFile))
+        with open(reportFile, "w") as f:
+            f.write("\n".join(report) + "\n")
+    return diff
+
+if __name__ == "__main__":
+    # Copy the Input folder to Input_new/ (or pdb_crystal_database.py to a new file), make the change there, then compare:
+    compareParsers(ParserConfig("current"), ParserConfig("new", inputDir="Input_new/"), sampleSize=20000)
+    # compareParsers(ParserConfig("current"), ParserConfig("new", moduleFile="pdb_crystal_database_new.py"))
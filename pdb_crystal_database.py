@@ -1,5 +1,6 @@
-import sys, json, pickle, operator, traceback, os, csv, itertools
+import sys, json, pickle, operator, traceback, os, csv, itertools, hashlib, collections
 from misc_functions import loadJson, writeJson, printList, fileToList, listToFile, getKey
+from profiling import profiled
 from time import sleep
 from collections import OrderedDict
 from pathlib import Path
@@ -53,6 +54,7 @@ SET_FREQUENCY_CSV_FILE = OUTPUT_DIR / "set_frequency.csv"
 
 
 COMPRESSED_DICTIONARY_FILE = OUTPUT_DIR / "compressed_dictionary.json"
+MISSING_COMPONENTS_FILE = OUTPUT_DIR / "missing_components.txt"
 
 # Load lists and dictionaries from files
 print("Loading input files...")
@@ -76,6 +78,9 @@ pendingFrequency = {}
 sensibleStructureList = []
 nonsensibleStructureList = []
 
+# The ExpansionTable of the current dictionaries, compiled when it is first needed (see getExpansionTable)
+expansionTable = None
+
 # Compounds that contain numbers (eg jeffamine 600)
 NUMBERED_COMPOUNDS = ["jeffamine", "propoxylate", "polypropylene", "ndsb"]
 
@@ -108,6 +113,21 @@ class Structure:
         Resolution: {6}
         """.format(self.pdbid, self.pmcid, self.compounds, self.pH, self.temperature, self.method, self.resolution))
 
+    def getFetchedHash(self): # string
+        """Returns a hash of the fields downloaded from the PDB (everything except the parsed compounds)
+        The hash is stable between runs, so it can be stored to find entries which were revised upstream"""
+        fields = [self.pdbid, self.pmcid, self.details, self.pH, self.temperature, self.method, self.sequences, self.resolution]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def getCompoundsHash(self): # string
+        """Returns a hash of the parsed compounds list, which changes when the structure is reparsed or standardized differently"""
+        return hashlib.sha256(json.dumps(self.compounds).encode()).hexdigest()
+
+    def getContentHash(self): # string
+        """Returns a hash of the fetched fields and the parsed compounds, so two structures with the same content hash are the same
+        The hash is stable between runs (see snapshot_diff.py)"""
+        return hashlib.sha256((self.getFetchedHash() + self.getCompoundsHash()).encode()).hexdigest()
+
     def parseDetails(self, detailsString=None, debug=False):
         """Parses the details string and returns a list of compounds, followed by concentration, or None if conc. is not found
         Format of compounds = ['compound name', '100', 'another compound name', '45%']
@@ -546,89 +566,14 @@ class Structure:
 
         return compounds
 
-    def standardizeNames(self):
-        """Standardizes the name of an individual structure"""
-        runAgain = True
-        while(runAgain):
-            runAgain = False
-            for i in range(0, len(self.compounds), 2):
-                if getKey(self.compounds[i]) in compoundDictionary:
-                    self.compounds[i] = compoundDictionary[getKey(self.compounds[i])]
-
-                    # Parse multiple compounds delimited with " / "
-                    if " / " in self.compounds[i]:
-                        multipleCompounds = self.compounds[i].split(" / ")
-                        concentration = self.compounds[i+1]
-                        for c in multipleCompounds:
-                            if c in set(compoundDictionary.values()):
-                                self.compounds.append(c)
-                                self.compounds.append(concentration)
-                            else:
-                                print("ERROR: Compound {} was found in multiple compound {} but is not in dictionary.".format(c, self.compounds[i]))
-                                input = input("Add the key {} : {} to the dictionary? (y/n): ".format(getKey(c), c))
-                                if input == "y":
-                                    compoundDictionary[getKey(c)] = c
-                                    print("Added key to dictionary")
-                                    self.compounds.append(c)
-                                    self.compounds.append(concentration)
-                        del self.compounds[i:i+2]
-                        runAgain = True
-                        break
-
-                    # Parse mixture compounds, that is,
-                    # names of mixtures which refer to multiple chemical compounds
-                    if self.compounds[i] in mixturesDictionary:
-                        mixtureDict = mixturesDictionary[self.compounds[i]] # Dictionary of the compounds in the mixture
-                        concentration = self.compounds[i+1]
-                        if concentration != None:
-                            findPercent = concentration.find("%")
-                            percentUnits = ""
-                            if findPercent != -1:
-                                percentUnits = concentration[findPercent:] # Everything after and including '%'
-                                concentration = concentration[:findPercent] # Everything berfore "%"
-                        for c in mixtureDict:
-                            if c in set(compoundDictionary.values()):
-                                self.compounds.append(c)
-                                if concentration != None:
-                                    if percentUnits == "":
-                                        newConcentration = str(float(concentration)*mixtureDict[c])
-                                    else:
-                                        # If concentration is a percent, then calculate millimolar concentration
-                                        newConcentration = str(float(concentration)*mixtureDict[c]*10)
-                                else:
-                                    newConcentration = None
-                                self.compounds.append(newConcentration)
-                            else:
-                                print("ERROR: Compound {} was found in mixture compound {} but is not in dictionary.".format(c, self.compounds[i]))
-                                input = input("Add the key {} : {} to the dictionary? (y/n): ".format(getKey(c), c))
-                                if input == "y":
-                                    compoundDictionary[getKey(c)] = c
-                                    print("Added key to dictionary")
-                                    self.compounds.append(c)
-                                    if concentration != None:
-                                        if percentUnits == "":
-                                            newConcentration = str(float(concentration)*mixtureDict[c])
-                                        else:
-                                            # If concentration is a percent, then calculate millimolar concentration
-                                            newConcentration = str(float(concentration)*mixtureDict[c]*10)
-                                    else:
-                                        newConcentration = None
-                                    self.compounds.append(newConcentration)
-                        del self.compounds[i:i+2]
-                        runAgain = True
-                        break
-
-                    # Remove duplicate compounds
-                    if self.compounds[i] in self.compounds[:i:2]: # If compound has appeared before
-                        locationOfFirstCompound = self.compounds.index(self.compounds[i], 0, i)
-                        if self.compounds[i+1] == None and self.compounds[locationOfFirstCompound+1] != None: # If only the first compound has a concentrations
-                            del self.compounds[i:i+2] # Remove the second compound
-                            runAgain = True
-                            break
-                        else:
-                            del self.compounds[locationOfFirstCompound:locationOfFirstCompound+2] # Remove first compound
-                            runAgain = True
-                            break
+    def standardizeNames(self, expansionTable=None): # list
+        """Standardizes the compound names of an individual structure (see ExpansionTable.standardizeCompounds)
+        Uses the expansion table of the current dictionaries if expansionTable is None
+        Returns a list of (compound, missing component) tuples for components which are not in the dictionary"""
+        if expansionTable == None:
+            expansionTable = getExpansionTable()
+        self.compounds, missing = expansionTable.standardizeCompounds(self.compounds)
+        return missing
 
     def getXml(self):
         """Returns an elementTree tree root of the structure object"""
@@ -667,11 +612,89 @@ class Structure:
         print(str(errorObject)+"\n")
         print("Crystallization Details: {}\n\nCompounds: {}\n--------------------\n".format(self.details, self.compounds))
 
-def parseAllDetails(structureList, structureFile=None, searchString=None):
+class ExpansionTable:
+    """The compound dictionary and mixtures dictionary compiled into one table for standardizing compound names
+    Maps every dictionary key to its standardized name, and every standardized name which stands for several compounds
+    (multiple compounds delimited with " / ", or mixtures from the mixtures dictionary) to its components
+    Components which are not values of the compound dictionary are left out, and listed in missingComponents"""
+
+    def __init__(self, compoundDictionary, mixturesDictionary):
+        self.names = dict(compoundDictionary) # Maps a key to the standardized name (a single lookup, as in standardizeNames)
+        self.expansions = {} # Maps a standardized name to a list of (component, factor) tuples. factor is None if the concentration is copied
+        self.missingComponents = {} # Maps a standardized name to the list of its components which are not in the dictionary
+        values = set(compoundDictionary.values())
+        for name in values:
+            if " / " in name:
+                components = [(c, None) for c in name.split(" / ")]
+            elif name in mixturesDictionary:
+                components = list(mixturesDictionary[name].items())
+            else:
+                continue
+            self.expansions[name] = [(c, factor) for c, factor in components if c in values]
+            missing = [c for c, factor in components if c not in values]
+            if missing != []:
+                self.missingComponents[name] = missing
+
+    def standardizeCompounds(self, compounds): # tuple
+        """Takes a compounds list and returns a (standardized compounds list, missing components) tuple
+        Names which are dictionary keys are replaced by their standardized names, and names of multiple compounds
+        and mixtures are replaced by their components, which are added to the end of the list
+        (mixture concentrations are multiplied by the fraction of each component, with percents converted to mM)
+        If a compound appears more than once, the one with a concentration is kept (or the later one if both or neither have one)
+        missing components is a list of (compound, component) tuples for components which were left out"""
+        queue = collections.deque(compounds[i:i+2] for i in range(0, len(compounds), 2))
+        output = [] # [name, concentration] pairs, or None where a pair was removed
+        positions = {} # Maps a standardized name to its position in output
+        missing = []
+        while queue:
+            name, concentration = queue.popleft()
+            key = getKey(name)
+            if key not in self.names:
+                output.append([name, concentration]) # Unrecognized names are kept as they are
+                continue
+            name = self.names[key]
+            if name in self.expansions or name in self.missingComponents:
+                for component, factor in self.expansions.get(name, []):
+                    queue.append([component, scaleConcentration(concentration, factor)])
+                for component in self.missingComponents.get(name, []):
+                    missing.append((name, component))
+                continue
+            # Remove duplicate compounds
+            if name in positions:
+                first = positions[name]
+                if concentration == None and output[first][1] != None: # If only the first compound has a concentration
+                    continue
+                output[first] = None
+            positions[name] = len(output)
+            output.append([name, concentration])
+        return ([item for pair in output if pair != None for item in pair], missing)
+
+def scaleConcentration(concentration, factor): # string
+    """Returns the concentration of a component of a mixture, given the concentration of the mixture
+    Percent concentrations are converted to mM (1% --> 10 mM). If factor is None the concentration is returned unchanged"""
+    if concentration == None or factor == None:
+        return concentration
+    findPercent = concentration.find("%")
+    if findPercent == -1:
+        return str(float(concentration)*factor)
+    # If concentration is a percent, then calculate millimolar concentration
+    return str(float(concentration[:findPercent])*factor*10)
+
+def getExpansionTable(): # ExpansionTable
+    """Returns the ExpansionTable of the current dictionaries, compiling it if the dictionaries changed (see updateDictionary)"""
+    global expansionTable
+    if expansionTable == None:
+        expansionTable = ExpansionTable(compoundDictionary, mixturesDictionary)
+    return expansionTable
+
+@profiled
+def parseAllDetails(structureList, structureFile=None, searchString=None, detailsIndex=None):
     """Reparses all of the details for a list of structures
     Should be called when the parseDetails function has been modified
     If search string is not None, then it will only parse Structures
     which have the search string in their details, making it faster
+    If detailsIndex is not None, it is used to find the structures with the search string
+    instead of scanning every details string (see details_index.py)
     If structureFile is specified, the structure list is saved to that file
     """
     global nltk
@@ -682,15 +705,20 @@ def parseAllDetails(structureList, structureFile=None, searchString=None):
     print("Parsing details with search string: \"{}\"...".format(searchString))
     count = 1
 
+    parseList = structureList
     if searchString != None:
-        structureList = [structure for structure in structureList if searchString.lower() in structure.details.lower()]
-        if structureList == []:
+        if detailsIndex != None:
+            matchingPdbids = detailsIndex.searchSubstring(searchString)
+            parseList = [structure for structure in structureList if structure.pdbid in matchingPdbids]
+        else:
+            parseList = [structure for structure in structureList if searchString.lower() in structure.details.lower()]
+        if parseList == []:
             print("No structures found with search string '{}'".format(searchString))
 
-    print("Parsing details of {} structures...".format(len(structureList)))
-    for structure in structureList:
+    print("Parsing details of {} structures...".format(len(parseList)))
+    for structure in parseList:
         if count % 10000 == 0:
-            print("Parsing structure {} of {}...".format(count, len(structureList)))
+            print("Parsing structure {} of {}...".format(count, len(parseList)))
         try:
             structure.parseDetails()
         except Exception as e:
@@ -698,26 +726,84 @@ def parseAllDetails(structureList, structureFile=None, searchString=None):
         count += 1
 
     if structureFile != None:
+        # Write the whole list, not just the structures that matched the search string
         print("Writing to structure file {}...".format(structureFile))
         writeStructures(structureList, structureFile)
 
-def standardizeAllNames(structureList, structureFile=None): # void
+@profiled
+def standardizeAllNames(structureList, structureFile=None, processes=1, chunkSize=5000, missingFile=MISSING_COMPONENTS_FILE): # void
     """Standardizes names of a list of compounds based on the compound Dictionary
     Also parses dictionary values which represent multiple compounds (e.g. acetic acid / sodium acetate)
     Also parses mixture compounds, which are mixtures of multiple compounds (e.g Molecular Dimensions Buffers)
+    Runs without asking for input: components of multiple compounds and mixtures which are not in the dictionary
+    are left out and written to missingFile, so they can be added to the dictionary before the next run
+    If processes is more than 1, chunks of chunkSize structures are standardized in parallel
     If structureFile is specified, the structure list is saved to that file
     """
     updateMiscDictionaries() # Also calls updateDictionary
+    table = getExpansionTable()
     print("Standardizing chemical names...")
-    for structure in structureList:
-        try:
-            structure.standardizeNames()
-        except Exception as e:
-            structure.printError("Unable to standardize compound names", e)
+    missingCounts = {} # Maps (compound, missing component) to the number of structures
+    if processes > 1:
+        import multiprocessing
+        chunks = [[s.compounds for s in structureList[i:i+chunkSize]] for i in range(0, len(structureList), chunkSize)]
+        with multiprocessing.Pool(processes, initializer=setExpansionTable, initargs=(table,)) as pool:
+            results = pool.map(standardizeChunk, chunks)
+        structures = iter(structureList)
+        for chunkResults in results:
+            for compounds, missing, error in chunkResults:
+                structure = next(structures)
+                if error != None:
+                    print("--------------------\nERROR: Unable to standardize compound names for PDB ID {}.\n{}\n--------------------\n".format(structure.pdbid, error))
+                    continue
+                structure.compounds = compounds
+                addMissingCounts(missingCounts, missing)
+    else:
+        for structure in structureList:
+            try:
+                addMissingCounts(missingCounts, structure.standardizeNames(table))
+            except Exception as e:
+                structure.printError("Unable to standardize compound names", e)
+    writeMissingComponents(missingCounts, missingFile)
     if structureFile != None:
         print("Writing to structure file {}...".format(structureFile))
         writeStructures(structureList, structureFile)
 
+def setExpansionTable(table):
+    """Sets the expansion table of a worker process (see standardizeAllNames)"""
+    global expansionTable
+    expansionTable = table
+
+def standardizeChunk(compoundsLists): # list
+    """Standardizes a list of compounds lists in a worker process
+    Returns a list of (compounds, missing components, error message) tuples"""
+    output = []
+    for compounds in compoundsLists:
+        try:
+            standardized, missing = expansionTable.standardizeCompounds(compounds)
+            output.append((standardized, missing, None))
+        except Exception as e:
+            output.append((compounds, [], "{}: {}".format(type(e).__name__, e)))
+    return output
+
+def addMissingCounts(missingCounts, missing):
+    """Adds the missing components of one structure to missingCounts (counting each one once per structure)"""
+    for pair in set(missing):
+        missingCounts[pair] = missingCounts.get(pair, 0) + 1
+
+def writeMissingComponents(missingCounts, missingFile=MISSING_COMPONENTS_FILE):
+    """Writes a report of the components of multiple compounds and mixtures which are not in the dictionary
+    Each line gives the dictionary entry that would add the component, the compound it was found in and the number of structures"""
+    if missingCounts == {}:
+        if os.path.exists(missingFile):
+            os.remove(missingFile)
+        return
+    print("WARNING: {} components of multiple compounds or mixtures are not in the dictionary. See {}".format(len(missingCounts), missingFile))
+    with open(missingFile, "w") as f:
+        f.write("Components which are not in the compound dictionary (key : value, found in, number of structures)\n")
+        for (compound, component), count in sorted(missingCounts.items(), key=operator.itemgetter(1), reverse=True):
+            f.write("\"{}\" : \"{}\", found in {}, {} structures\n".format(getKey(component), component, compound, count))
+
 def importNLTK():
     """Handles importing the NLTK Module"""
     global nltk
@@ -808,19 +894,19 @@ def getSensibleStructures(structureList):
     """Returns a list of structures that make sense
     That is, all of their compounds are found in the dictionary"""
     print("Searching for sensible structures...")
-    sensibleStructures = []
-    for structure in structureList:
-        isSensible = True
-        if structure.compounds == []:
-            isSensible = False
-        for compound in structure.compounds[::2]:
-            if compound not in set(compoundDictionary.values()):
-                isSensible = False
-                break
-        if isSensible:
-            sensibleStructures.append(structure)
-    return sensibleStructures
+    dictionaryValues = set(compoundDictionary.values())
+    return [structure for structure in structureList if isSensible(structure, dictionaryValues)]
+
+def isSensible(structure, dictionaryValues): # boolean
+    """Returns True if a structure has compounds and all of them are in dictionaryValues (the set of compound dictionary values)"""
+    if structure.compounds == []:
+        return False
+    for compound in structure.compounds[::2]:
+        if compound not in dictionaryValues:
+            return False
+    return True
 
+@profiled
 def exportSensibleStructures(structureList, structureFile=SENSIBLE_STRUCTURES_FILE, detailsFile=SENSIBLE_DETAILS_FILE):
     """Exports a list of sensible structures to a serialized pickle file
     Also returns the list of sensible structures from getSensibleStructures
@@ -840,13 +926,17 @@ def getUnknowns(structureList):
 def exportDetails(structureList, outputFilename):
     """Exports the details of a list of structures to a text file"""
     print("Exporting details to \"{}\"...".format(outputFilename))
-    outputList = []
+    with open(outputFilename, "w") as f:
+        writeDetails(structureList, f)
+
+def writeDetails(structureList, f):
+    """Writes the details and compounds of a list of structures to an open text file (see exportDetails)"""
     for structure in structureList:
         if structure.compounds != []:
-            outputList.append(structure.pdbid + ": " + structure.details)
-            outputList.append(structure.compounds)
-    listToFile(outputList, outputFilename)
+            f.write(structure.pdbid + ": " + structure.details + "\n")
+            f.write(str(structure.compounds) + "\n")
 
+@profiled
 def getCompoundFrequencies(structureList, textFilename=None, csvFilename=None, mode="recognized"):
     """Takes a list of structures and returns a dictionary mapping compounds to their frequency
     If textFilename != None, it also outputs compound frequency to an easily readable txt file
@@ -855,18 +945,26 @@ def getCompoundFrequencies(structureList, textFilename=None, csvFilename=None, m
     Mode = "unknown": only export compounds found in unknownList
     Mode = "pending": only export compounds in neither dictionary nor unknown list, pending classification
     """
-    global compoundDictionary
-    global smilesDictionary
-
     print("Exporting compound frequencies to \"{}\"...".format(textFilename))
-    outputDictionary = {"Total Compounds": 0}
+    outputDictionary = countCompoundFrequencies(structureList, mode)
+    writeCompoundFrequencies(outputDictionary, textFilename, csvFilename)
+    return outputDictionary
+
+def countCompoundFrequencies(structureList, mode="recognized", outputDictionary=None): # dictionary
+    """Counts the compounds of a list of structures (see getCompoundFrequencies for the modes)
+    If outputDictionary is not None, the counts are added to it, so a database can be counted one chunk at a time
+    Returns the dictionary of counts"""
+    if outputDictionary == None:
+        outputDictionary = {"Total Compounds": 0}
+    dictionaryValues = set(compoundDictionary.values())
+    unknownSet = set(unknownList)
     if mode == "recognized":
         for structure in structureList:
             for compound in structure.compounds[::2]:
                 c = compound
                 if getKey(c) in compoundDictionary:
                     c = compoundDictionary[getKey(c)]
-                if c in compoundDictionary.values():
+                if c in dictionaryValues:
                     if c not in outputDictionary:
                         outputDictionary[c] = 1
                     else:
@@ -876,7 +974,7 @@ def getCompoundFrequencies(structureList, textFilename=None, csvFilename=None, m
     if mode == "unknown":
         for structure in structureList:
             for compound in structure.compounds[::2]:
-                if getKey(compound) in unknownList and getKey(compound) not in compoundDictionary:
+                if getKey(compound) in unknownSet and getKey(compound) not in compoundDictionary:
                     if compound not in outputDictionary:
                         outputDictionary[compound] = 1
                     else:
@@ -886,14 +984,16 @@ def getCompoundFrequencies(structureList, textFilename=None, csvFilename=None, m
     if mode == "pending":
         for structure in structureList:
             for compound in structure.compounds[::2]:
-                if getKey(compound) not in unknownList and getKey(compound) not in compoundDictionary and compound not in compoundDictionary.values():
+                if getKey(compound) not in unknownSet and getKey(compound) not in compoundDictionary and compound not in dictionaryValues:
                     if compound not in outputDictionary:
                         outputDictionary[compound] = 1
                     else:
                         outputDictionary[compound] += 1
                     outputDictionary["Total Compounds"] += 1
+    return outputDictionary
 
-    # Export
+def writeCompoundFrequencies(outputDictionary, textFilename=None, csvFilename=None):
+    """Exports a dictionary of compound frequencies to a readable txt file and/or a TAB-DELIMITED csv file"""
     if textFilename != None:
         outputList = []
         for key, value in sorted(outputDictionary.items(), key=operator.itemgetter(1), reverse=True):
@@ -908,8 +1008,7 @@ def getCompoundFrequencies(structureList, textFilename=None, csvFilename=None, m
             writer = csv.writer(csvfile, dialect='excel-tab', delimiter="\t")
             writer.writerows(outputList)
 
-    return outputDictionary
-
+@profiled
 def getSetFrequencies(structureList, textFilename=None, csvFilename=None, requiredCompounds=None, subsetLength=None):
     """Takes a compound list and outputs a dictionary of the frequencies of each set of compounds
         The dictionary maps a frozenset of compounds to its frequency as an integer.
@@ -931,12 +1030,7 @@ def getSetFrequencies(structureList, textFilename=None, csvFilename=None, requir
         for requiredCompound in requiredCompounds:
             structureList = [s for s in structureList if requiredCompound in s.compounds[::2]]
 
-    for structure in structureList:
-        compoundSet = frozenset(structure.compounds[::2])
-        if compoundSet in outputDictionary:
-            outputDictionary[compoundSet] += 1
-        else:
-            outputDictionary[compoundSet] = 1
+    countSetFrequencies(structureList, outputDictionary)
 
     if subsetLength != None:
         newOutputDictionary = {}
@@ -960,29 +1054,47 @@ def getSetFrequencies(structureList, textFilename=None, csvFilename=None, requir
                 newOutputDictionary[subset] = frequency
         outputDictionary = newOutputDictionary
 
-    # Export
+    writeSetFrequencies(outputDictionary, textFilename, csvFilename)
+    return outputDictionary
+
+def countSetFrequencies(structureList, outputDictionary): # dictionary
+    """Adds the number of structures with each set of compounds in a list of structures to outputDictionary and returns it"""
+    for structure in structureList:
+        compoundSet = frozenset(structure.compounds[::2])
+        if compoundSet in outputDictionary:
+            outputDictionary[compoundSet] += 1
+        else:
+            outputDictionary[compoundSet] = 1
+    return outputDictionary
+
+def writeSetFrequencies(outputDictionary, textFilename=None, csvFilename=None):
+    """Exports a dictionary of set frequencies to a readable txt file and/or a TAB-DELIMITED csv file
+    Sets are sorted by frequency and then by their compounds, and the compounds of each set are sorted,
+    so the files do not depend on the order of the dictionary or on string hashing (PYTHONHASHSEED)"""
+    sortedSets = sorted((sorted(key), value) for key, value in outputDictionary.items())
+    sortedSets.sort(key=operator.itemgetter(1), reverse=True)
     if textFilename != None:
         outputList = []
-        for key, value in sorted(outputDictionary.items(), key=operator.itemgetter(1), reverse=True):
-            outputList.append("{:80s}: {:20d}".format(printList(list(key)), value))
+        for compounds, value in sortedSets:
+            outputList.append("{:80s}: {:20d}".format(printList(compounds), value))
         listToFile(outputList, textFilename)
 
     if csvFilename != None:
         outputList = []
-        for key, value in sorted(outputDictionary.items(), key=operator.itemgetter(1), reverse=True):
-            outputList.append([printList(list(key)), value])
+        for compounds, value in sortedSets:
+            outputList.append([printList(compounds), value])
         with open(csvFilename, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile, dialect='excel-tab', delimiter="\t")
             writer.writerows(outputList)
 
-    return outputDictionary
-
+@profiled
 def exportOutputFiles(structureList):
     """Just a simple way to export all of the output files
     Also sets a bunch of useful global variables"""
     global compoundFrequency, unknownFrequency, pendingFrequency, sensibleStructureList, nonsensibleStructureList
     sensibleStructureList = exportSensibleStructures(structureList)
-    nonsensibleStructureList = list(set(structureList) - set(sensibleStructureList))
+    sensibleIds = {id(structure) for structure in sensibleStructureList}
+    nonsensibleStructureList = [structure for structure in structureList if id(structure) not in sensibleIds] # Keeps the order of structureList
     exportDetails(structureList, DETAILS_FILE)
     exportDetails(getUnknowns(structureList), UNKNOWN_DETAILS_FILE)
     exportDetails(nonsensibleStructureList, NON_SENSIBLE_DETAILS_FILE)
@@ -993,10 +1105,19 @@ def exportOutputFiles(structureList):
     exportXml(sensibleStructureList, XML_FILE)
     exportCsv(sensibleStructureList, CSV_FILE)
 
+@profiled
 def exportCsv(structureList, outputFilename):
     """Exports a csv file of all of the information in a list of structures"""
     print("Exporting csv file to {}...".format(outputFilename))
-    outputList = []
+    try:
+        with open(outputFilename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, dialect='excel-tab', delimiter="\t")
+            writeCsvRows(structureList, writer)
+    except PermissionError:
+        print("Could not write to {}. Maybe the file is open in another program such as Excel?".format(outputFilename))
+
+def writeCsvRows(structureList, writer):
+    """Writes a row for every structure in a list to a csv writer (see exportCsv)"""
     for structure in structureList:
         row = [str(structure.pdbid), str(structure.pmcid), str(structure.method).replace(',',''), str(structure.resolution), str(structure.temperature), str(structure.pH)]
         for compound in structure.compounds:
@@ -1008,32 +1129,33 @@ def exportCsv(structureList, outputFilename):
             row.append("---")
         for sequence in structure.sequences:
             row.append(sequence)
-        outputList.append(row)
-
-    try:
-        with open(outputFilename, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, dialect='excel-tab', delimiter="\t")
-            writer.writerows(outputList)
-    except PermissionError:
-        print("Could not write to {}. Maybe the file is open in another program such as Excel?".format(outputFilename))
+        writer.writerow(row)
 
+@profiled
 def exportXml(structureList, outputFilename):
-    """Exports a list of structures to an xml file"""
+    """Exports a list of structures to an xml file
+    Structures are pretty-printed one at a time, so the whole document is never held in memory"""
     print("Exporting xml structure list to {}...".format(outputFilename))
-    root = etree.Element("structures")
-    for s in structureList:
-        root.append(s.getXml())
-
-    xmlString = minidom.parseString(etree.tostring(root)).toprettyxml(indent="   ")
-    xmlLineList = xmlString.split("\n")
+    with open(outputFilename, "w") as f:
+        writeXmlStart(f, structureList != [])
+        writeXmlStructures(structureList, f)
+        writeXmlEnd(f, structureList != [])
+
+def writeXmlStart(f, hasStructures=True):
+    """Writes the beginning of a structure xml file, formatted like minidom's toprettyxml"""
+    f.write('<?xml version="1.0" ?>\n')
+    f.write("<structures>\n" if hasStructures else "<structures/>\n")
+
+def writeXmlStructures(structureList, f):
+    """Writes the xml of a list of structures to an open xml file, between writeXmlStart and writeXmlEnd"""
+    for structure in structureList:
+        element = minidom.parseString(etree.tostring(structure.getXml())).documentElement
+        element.writexml(f, "   ", "   ", "\n")
 
-    try:
-        with open(outputFilename, "w") as f:
-            for line in xmlLineList:
-                f.write(line)
-                f.write("\n")
-    except MemoryError:
-        print("ERROR: Not enough memory availible to export xml to {}".format(outputFilename))
+def writeXmlEnd(f, hasStructures=True):
+    if hasStructures:
+        f.write("</structures>\n")
+    f.write("\n") # The file has always ended with an empty line
 
 def getDatabaseSubset(structureList, pdbidList, sensibleOnly=True, structureFile=None):
     """Takes a list of PDB IDs and returns a list of structure files associated with them
@@ -1062,7 +1184,10 @@ def getDatabaseSubset(structureList, pdbidList, sensibleOnly=True, structureFile
 
 def updateDictionary():
     """Makes sure all values in the compound dictionary are also keys
-    This prevents inconsistency in other functions which assume that this is the case"""
+    This prevents inconsistency in other functions which assume that this is the case
+    Also makes the expansion table be compiled again from the updated dictionary"""
+    global expansionTable
+    expansionTable = None
     for value in set(compoundDictionary.values()):
         if getKey(value) not in compoundDictionary:
             compoundDictionary[getKey(value)] = value
@@ -1097,6 +1222,24 @@ def isPercent(s): # Boolean
     else:
         return False # Boolean
 
+def parseConcentration(concentration): # tuple
+    """Takes a concentration string from a compounds list and returns a (value, units) tuple
+    Units are "mM" for plain numbers, or the percent units (e.g. "%", "% w/v")
+    Returns (None, None) if the concentration is None or can not be read as a number"""
+    if concentration == None:
+        return (None, None)
+    findPercent = concentration.find("%")
+    if findPercent != -1:
+        number = concentration[:findPercent]
+        units = concentration[findPercent:].strip()
+    else:
+        number = concentration
+        units = "mM"
+    try:
+        return (float(number.replace(",","")), units)
+    except ValueError:
+        return (None, None)
+
 def isCompound(word): # boolean
     """Takes a string and returns true if the string is part of a chemical compound
     Returns false if the string is a comma or a number"""
@@ -1127,29 +1270,57 @@ def wordReplacement(s, replacementDictionary, debug=False):
             print(details+"\n")
     return details
 
+@profiled
 def loadStructures(structureFile=STRUCTURES_FILE): # list
-    """Returns a list of structures from the pickled structure file"""
+    """Returns a list of structures from the pickled structure file
+    If structureFile is a SQLite database (.db, .sqlite or .sqlite3), the structures are loaded from the database instead
+    If structureFile is a snapshot (.snapshot, see snapshot.py), the structures are loaded from the snapshot instead
+    If structureFile is a shard directory (.shards, see sharded_storage.py), the shards are loaded in parallel instead"""
+    from sqlite_database import isSqliteFile, loadStructuresSqlite
+    if isSqliteFile(structureFile):
+        return loadStructuresSqlite(structureFile)
+    if Path(structureFile).suffix == ".snapshot":
+        from snapshot import loadSnapshot
+        return loadSnapshot(structureFile)
+    if Path(structureFile).suffix == ".shards":
+        from sharded_storage import loadShards
+        return loadShards(structureFile)
     print("Loading structures from file {}...".format(structureFile))
     with open(structureFile, "rb") as f:
         return pickle.load(open(structureFile, "rb"))
 
+@profiled
 def writeStructures(structureList, structureFile, count=0):
     """Writes a list of structures to a pickle file
+    If structureFile is a SQLite database (.db, .sqlite or .sqlite3), the database is replaced by the structure list instead
+    If structureFile is a snapshot (.snapshot, see snapshot.py), a snapshot is written instead
+    If structureFile is a shard directory (.shards, see sharded_storage.py), only the shards which changed are rewritten,
+        and a structure list loaded with only some of the shards or pdbids only replaces the structures it holds
     count keeps track of how many times the function has had to wait to write"""
+    from sqlite_database import isSqliteFile, writeStructuresSqlite
+    if isSqliteFile(structureFile):
+        return writeStructuresSqlite(structureList, structureFile)
+    if Path(structureFile).suffix == ".snapshot":
+        from snapshot import writeSnapshot
+        writeSnapshot(structureList, structureFile)
+        return True
+    if Path(structureFile).suffix == ".shards":
+        from sharded_storage import writeShards
+        writeShards(structureList, structureFile)
+        return True
     if count > 5:
         print("ERROR: Permission denied {} times when trying to write structures to {}".format(count-1, structureFile))
         return None
     try:
-        with open(structureFile, "wb") as f:
-            pickle.dump(structureList, f)
-            if count > 0:
-                print("Successfully wrote structures")
-            return True
-    except KeyboardInterrupt:
-        print("Keyboard interrupt detected. Writing to file...")
-        with open(structureFile, "wb") as f:
+        # Write to a temporary file first and then replace the structure file, so that an interrupted
+        # write (e.g. Ctrl-C, see pipeline.py for graceful shutdown) never leaves a partially written file behind
+        temporaryFile = str(structureFile) + ".tmp"
+        with open(temporaryFile, "wb") as f:
             pickle.dump(structureList, f)
-        sys.exit()
+        os.replace(temporaryFile, structureFile)
+        if count > 0:
+            print("Successfully wrote structures")
+        return True
     except PermissionError:
         if count == 0:
             print("Permission denied when attempting to write structures. Waiting and trying again...")
@@ -1159,10 +1330,12 @@ def writeStructures(structureList, structureFile, count=0):
 
 if __name__ == "__main__":
     # Insert your commands here
+    # Set the environment variable PDB_PROFILE=1 to write cProfile stats and memory reports of each stage to Output/profiles (see profiling.py)
     structureList = loadStructures(STRUCTURES_FILE) # Must have a Structure File availible (see wiki)
     parseAllDetails(structureList, searchString=None, structureFile=STRUCTURES_FILE)
     standardizeAllNames(structureList, structureFile=STRUCTURES_FILE)
     exportOutputFiles(structureList)
+    # To only rerun the steps whose inputs, code or upstream results changed, run artifact_cache.py instead
 
     # Get most common partners
     # listOfMostFrequentCompounds = sorted(compoundFrequency.items(), key=operator.itemgetter(1), reverse=True)[1:11]
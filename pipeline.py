@@ -0,0 +1,289 @@
+import threading, queue
+from time import perf_counter, sleep
+from pdb_crystal_database import loadStructures, writeStructures, updateMiscDictionaries, STRUCTURES_FILE, OUTPUT_DIR
+from download_structures import loadPdb, getStructureFromRoot, getAllPdbs, WITHOUT_DETAILS_FILE
+from misc_functions import loadJson, writeJson
+from sqlite_database import isSqliteFile, connect, upsertStructures
+
+PIPELINE_DETAILS_FILE = OUTPUT_DIR / "pipeline_details.txt"
+
+QUEUE_SIZE = 200 # Maximum number of structures waiting between two stages
+REQUEST_DELAY = 0.05 # Seconds each fetch worker waits between requests, to avoid sending too many requests
+REPORT_INTERVAL = 30 # Seconds between throughput reports
+
+DONE = None # Put on a queue by a stage to tell the next stage that it has finished
+
+class StageStats:
+    """Keeps track of the throughput of one stage of the pipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busyTime = 0.0 # Total seconds spent working (summed over the workers of the stage)
+        self.startTime = perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.items += 1
+            self.busyTime += seconds
+
+    def __str__(self):
+        elapsed = perf_counter() - self.startTime
+        rate = self.items / elapsed if elapsed > 0 else 0
+        averageTime = self.busyTime / self.items * 1000 if self.items > 0 else 0
+        return "{:12s}: {:8d} items, {:8.2f} items/s, {:8.2f} ms/item".format(self.name, self.items, rate, averageTime)
+
+class Pipeline:
+    """A streaming download --> parse --> standardize pipeline
+    Fetch workers download structures and put them on a bounded queue, parse workers parse and standardize them
+    and put them on a second bounded queue, and a single sink writes them to the structure file as they arrive.
+    When a queue is full the stage before it waits (backpressure), so memory use stays bounded.
+    The fetch workers are threads, since they mostly wait on the network. The parse workers are also threads,
+    so parsing overlaps the network waits, but only one parses at a time because of the GIL.
+    Press Ctrl-C (or call stop) to stop fetching: structures which are already downloaded are still
+    parsed and saved before the pipeline exits."""
+
+    def __init__(self, pdbList, structureFile=STRUCTURES_FILE, fetchWorkers=4, parseWorkers=1, queueSize=QUEUE_SIZE,
+            onlyDetails=True, saveFrequency=1000, detailsFile=None, reportInterval=REPORT_INTERVAL, fetchFunction=loadPdb, requestDelay=REQUEST_DELAY):
+        self.pdbList = pdbList
+        self.structureFile = structureFile
+        self.fetchWorkers = fetchWorkers
+        self.parseWorkers = parseWorkers
+        self.onlyDetails = onlyDetails
+        self.saveFrequency = saveFrequency
+        self.detailsFile = detailsFile
+        self.reportInterval = reportInterval
+        self.fetchFunction = fetchFunction
+        self.requestDelay = requestDelay
+
+        # Every fetch worker puts DONE on the parse queue when it finishes, but the parse workers may only stop once all of them have
+        self.parseQueue = CountingQueue(queueSize, expectedDone=fetchWorkers, consumers=parseWorkers)
+        self.sinkQueue = queue.Queue(maxsize=queueSize)
+        self.pdbIterator = iter(pdbList)
+        self.pdbLock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+        self.fetchStats = StageStats("fetch")
+        self.parseStats = StageStats("parse")
+        self.standardizeStats = StageStats("standardize")
+        self.sinkStats = StageStats("sink")
+
+        self.structureDictionary = {} # Maps pdbids to structures, in the order of the structure file
+        self.pdbsWithoutDetails = []
+        self.sinkError = None # The exception which stopped the sink, if any (re-raised by run)
+
+    def stop(self):
+        """Stops fetching new structures. Structures already fetched are still parsed and saved"""
+        self.stopEvent.set()
+
+    def getNextPdb(self): # string
+        """Returns the next pdbid to fetch, or None if there are none left or the pipeline is stopping"""
+        if self.stopEvent.is_set():
+            return None
+        with self.pdbLock:
+            return next(self.pdbIterator, None)
+
+    def fetchWorker(self):
+        """Downloads structures and puts them on the parse queue"""
+        try:
+            pdbid = self.getNextPdb()
+            while pdbid != None:
+                start = perf_counter()
+                root = self.fetchFunction(pdbid)
+                structure = None
+                if root != None:
+                    try:
+                        structure = getStructureFromRoot(pdbid, root)
+                    except Exception as e:
+                        print("ERROR: Unable to read the report for PDB ID {}: {}".format(pdbid, e))
+                self.fetchStats.record(perf_counter() - start)
+                if structure != None:
+                    if structure.details == None:
+                        self.pdbsWithoutDetails.append(pdbid)
+                    if structure.details != None or not self.onlyDetails:
+                        self.parseQueue.put(structure)
+                sleep(self.requestDelay)
+                pdbid = self.getNextPdb()
+        finally:
+            self.parseQueue.put(DONE)
+
+    def parseWorker(self):
+        """Parses and standardizes structures from the parse queue and puts them on the sink queue"""
+        try:
+            structure = self.parseQueue.get()
+            while structure != DONE:
+                start = perf_counter()
+                try:
+                    structure.parseDetails()
+                except Exception as e:
+                    structure.printError("Unable to parse details", e)
+                self.parseStats.record(perf_counter() - start)
+
+                start = perf_counter()
+                try:
+                    structure.standardizeNames()
+                except Exception as e:
+                    structure.printError("Unable to standardize compound names", e)
+                self.standardizeStats.record(perf_counter() - start)
+
+                self.sinkQueue.put(structure)
+                structure = self.parseQueue.get()
+        finally:
+            self.sinkQueue.put(DONE)
+
+    def save(self, connection):
+        """Writes the structures and the list of pdbs without details to their files"""
+        if connection == None:
+            writeStructures(list(self.structureDictionary.values()), self.structureFile)
+        writeJson(self.pdbsWithoutDetails, WITHOUT_DETAILS_FILE)
+
+    def sink(self):
+        """Receives finished structures from the sink queue and writes them out incrementally
+        Runs until every parse worker has finished"""
+        connection = connect(self.structureFile) if isSqliteFile(self.structureFile) else None
+        detailsFile = open(self.detailsFile, "a") if self.detailsFile != None else None
+        finishedWorkers = 0
+        lastReport = perf_counter()
+        try:
+            while finishedWorkers < self.parseWorkers:
+                if perf_counter() - lastReport >= self.reportInterval:
+                    self.report()
+                    lastReport = perf_counter()
+                try:
+                    structure = self.sinkQueue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if structure == DONE:
+                    finishedWorkers += 1
+                else:
+                    start = perf_counter()
+                    # Replace an existing structure by moving it to the end, like fetchStructures does
+                    self.structureDictionary.pop(structure.pdbid, None)
+                    self.structureDictionary[structure.pdbid] = structure
+                    if connection != None:
+                        upsertStructures([structure], connection=connection)
+                    if detailsFile != None and structure.compounds != []:
+                        detailsFile.write(structure.pdbid + ": " + str(structure.details) + "\n")
+                        detailsFile.write(str(structure.compounds) + "\n")
+                    self.sinkStats.record(perf_counter() - start)
+                    if self.sinkStats.items % self.saveFrequency == 0:
+                        self.save(connection)
+            self.save(connection)
+        except Exception as e:
+            self.sinkError = e
+        finally:
+            if connection != None:
+                connection.close()
+            if detailsFile != None:
+                detailsFile.close()
+
+    def report(self):
+        """Prints the throughput of every stage and the number of structures waiting between stages"""
+        print("Pipeline throughput:")
+        for stats in (self.fetchStats, self.parseStats, self.standardizeStats, self.sinkStats):
+            print("\t" + str(stats))
+        print("\tQueued for parsing: {}, queued for saving: {}".format(self.parseQueue.qsize(), self.sinkQueue.qsize()))
+
+    def run(self): # list
+        """Runs the pipeline until every pdbid has been processed or the pipeline is stopped
+        If the sink fails (e.g. the structure file cannot be written), the workers are stopped and its exception is raised
+        Returns the list of structures in the structure file"""
+        print("Starting pipeline with {} fetch workers and {} parse workers...".format(self.fetchWorkers, self.parseWorkers))
+        fetchThreads = [threading.Thread(target=self.fetchWorker, daemon=True) for i in range(self.fetchWorkers)]
+        parseThreads = [threading.Thread(target=self.parseWorker, daemon=True) for i in range(self.parseWorkers)]
+        sinkThread = threading.Thread(target=self.sink, daemon=True)
+
+        for thread in fetchThreads + parseThreads + [sinkThread]:
+            thread.start()
+
+        while sinkThread.is_alive():
+            try:
+                sinkThread.join(timeout=0.5)
+            except KeyboardInterrupt:
+                print("Keyboard interrupt detected. Finishing structures which are already downloaded (press Ctrl-C again to force quit)...")
+                self.stop()
+                try:
+                    while sinkThread.is_alive():
+                        sinkThread.join(timeout=0.5)
+                except KeyboardInterrupt:
+                    print("Forcing quit. Structures since the last save are lost")
+                    raise
+
+        if self.sinkError != None:
+            print("ERROR: Unable to save structures: {}. Stopping the workers...".format(self.sinkError))
+            self.stop()
+            workerThreads = fetchThreads + parseThreads
+            while any(thread.is_alive() for thread in workerThreads):
+                # Nothing reads the sink queue anymore, so empty it for parse workers which are waiting to put a structure on it
+                try:
+                    while True:
+                        self.sinkQueue.get_nowait()
+                except queue.Empty:
+                    pass
+                for thread in workerThreads:
+                    thread.join(timeout=0.1)
+            raise self.sinkError
+
+        self.report()
+        print("Done running pipeline")
+        return list(self.structureDictionary.values())
+
+class CountingQueue(queue.Queue):
+    """A bounded queue which several producers finish by putting DONE on it
+    Consumers only receive DONE once every producer has finished, and then each consumer receives one DONE"""
+
+    def __init__(self, maxsize, expectedDone, consumers):
+        super().__init__(maxsize=maxsize)
+        self.expectedDone = expectedDone
+        self.consumers = consumers
+        self.doneCount = 0
+        self.doneLock = threading.Lock()
+
+    def put(self, item, block=True, timeout=None):
+        if item is DONE:
+            with self.doneLock:
+                self.doneCount += 1
+                if self.doneCount < self.expectedDone:
+                    return
+            for i in range(self.consumers):
+                super().put(DONE, block, timeout)
+        else:
+            super().put(item, block, timeout)
+
+def runPipeline(pdbList, structureFile=STRUCTURES_FILE, ignorePdbsWithoutDetails=True, ignoreCompletedPdbs=True, **kwargs): # list
+    """Fetches, parses and standardizes a list of pdbids with a Pipeline, and adds them to structureFile
+    If ignoreCompletedPdbs is True, pdbids which are already in the structure file are not fetched again
+    If ignorePdbsWithoutDetails is True, pdbids in WITHOUT_DETAILS_FILE are not fetched again
+    Other keyword arguments are passed to the Pipeline constructor
+    Returns the list of structures in the structure file"""
+    updateMiscDictionaries() # Standardization expects every dictionary value to also be a key
+
+    structureDictionary = {}
+    try:
+        for structure in loadStructures(structureFile):
+            structureDictionary[structure.pdbid] = structure
+    except FileNotFoundError:
+        print("File {} not found. A new structure file will be created.".format(structureFile))
+    pdbsWithoutDetails = []
+    try:
+        pdbsWithoutDetails = loadJson(WITHOUT_DETAILS_FILE)
+    except FileNotFoundError:
+        print("File {} not found. One will be created.".format(WITHOUT_DETAILS_FILE))
+
+    ignoredPdbs = set()
+    if ignoreCompletedPdbs:
+        ignoredPdbs |= set(structureDictionary)
+    if ignorePdbsWithoutDetails:
+        ignoredPdbs |= set(pdbsWithoutDetails)
+    pdbList = [pdbid for pdbid in pdbList if pdbid not in ignoredPdbs]
+    print("{} pdbs to fetch".format(len(pdbList)))
+
+    pipeline = Pipeline(pdbList, structureFile, **kwargs)
+    pipeline.structureDictionary = structureDictionary
+    pipeline.pdbsWithoutDetails = pdbsWithoutDetails
+    return pipeline.run()
+
+if __name__ == "__main__":
+    allPdbs = getAllPdbs()
+    runPipeline(allPdbs, STRUCTURES_FILE, detailsFile=PIPELINE_DETAILS_FILE)
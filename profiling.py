@@ -0,0 +1,137 @@
+import os, functools, cProfile, pstats, tracemalloc, io
+from pathlib import Path
+from time import perf_counter, strftime
+
+PROFILE_DIR = Path("Output/") / "profiles"
+PROFILE_REPORT_FILE = PROFILE_DIR / "profile_report.txt"
+
+TOP_ALLOCATIONS = 25 # Lines of code listed in each allocation report
+TRACEBACK_FRAMES = 1 # Frames stored by tracemalloc for each allocation (more frames cost more memory and time)
+
+# Profiling is off unless the PDB_PROFILE environment variable is set (e.g. PDB_PROFILE=1 python pdb_crystal_database.py)
+# or enableProfiling is called. When it is off, a profiled function only costs one extra function call
+enabled = os.environ.get("PDB_PROFILE", "") not in ["", "0"]
+
+stageStack = [] # The stages which are running, outermost first
+stageResults = [] # (stage name, seconds, peak MB, net MB) of every finished stage, in order
+stageCount = 0 # Number of stages started, used to give the files of every stage a unique name
+
+def enableProfiling(profileDir=None):
+    global enabled, PROFILE_DIR, PROFILE_REPORT_FILE
+    enabled = True
+    if profileDir != None:
+        PROFILE_DIR = Path(profileDir)
+        PROFILE_REPORT_FILE = PROFILE_DIR / "profile_report.txt"
+
+def disableProfiling():
+    global enabled
+    enabled = False
+
+class Stage:
+    """A profiled stage of the pipeline (see profileStage)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+        self.startTime = None
+        self.startSnapshot = None
+        self.startMemory = 0
+        self.peakMemory = 0 # Highest traced memory seen while the stage ran (updated when nested stages reset the peak)
+        self.startedTracing = False
+        self.fileName = None # Name of the files of the stage, e.g. 003_exportSensibleStructures.getSensibleStructures
+
+    def start(self):
+        global stageCount
+        stageCount += 1
+        # Repeated and nested stages get their own files, named after the stage number and the names of the outer stages
+        self.fileName = "{:03d}_{}".format(stageCount, getFileName(".".join([stage.name for stage in stageStack] + [self.name])))
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+            self.startedTracing = True
+        if stageStack != []:
+            # Nested stages reset the peak, so save the peak of the outer stages so far
+            peak = tracemalloc.get_traced_memory()[1]
+            for stage in stageStack:
+                stage.peakMemory = max(stage.peakMemory, peak)
+        self.startSnapshot = tracemalloc.take_snapshot()
+        self.startMemory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        # Only one cProfile profiler can run at a time, so nested stages are only timed (they are in the outer stage's pstats)
+        if stageStack == []:
+            self.profiler = cProfile.Profile()
+        stageStack.append(self)
+        self.startTime = perf_counter()
+        if self.profiler != None:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler != None:
+            self.profiler.disable()
+        seconds = perf_counter() - self.startTime
+        stageStack.pop()
+        current, peak = tracemalloc.get_traced_memory()
+        self.peakMemory = max(self.peakMemory, peak)
+        for stage in stageStack:
+            stage.peakMemory = max(stage.peakMemory, peak)
+        endSnapshot = tracemalloc.take_snapshot()
+        if self.startedTracing:
+            tracemalloc.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        fileName = self.fileName
+        if self.profiler != None:
+            self.profiler.dump_stats(PROFILE_DIR / (fileName + ".pstats"))
+        result = (self.name, seconds, (self.peakMemory - self.startMemory) / 1e6, (current - self.startMemory) / 1e6)
+        stageResults.append(result)
+        writeAllocationReport(self, endSnapshot, result, PROFILE_DIR / (fileName + "_memory.txt"))
+        with open(PROFILE_REPORT_FILE, "a") as f:
+            f.write("{} {}{:40s} {:10.2f} s {:10.1f} MB peak {:+10.1f} MB net\n".format(strftime("%Y-%m-%d %H:%M:%S"),
+                "  " * len(stageStack), self.name, seconds, result[2], result[3]))
+        print("Profiled {}: {:.2f} s, {:.1f} MB peak".format(self.name, seconds, result[2]))
+
+def getFileName(name): # string
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+def writeAllocationReport(stage, endSnapshot, result, outputFile, top=TOP_ALLOCATIONS):
+    """Writes the lines of code which allocated the most memory during a stage (still allocated when it ended),
+    followed by the functions which took the most time if the stage has cProfile stats"""
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    differences = endSnapshot.filter_traces(ignored).compare_to(stage.startSnapshot.filter_traces(ignored), "lineno")
+    with open(outputFile, "w") as f:
+        f.write("{}: {:.2f} s, {:.1f} MB peak, {:+.1f} MB net\n\n".format(*result))
+        f.write("Top {} allocations still held at the end of the stage:\n".format(top))
+        for difference in differences[:top]:
+            f.write("{}\n".format(difference))
+        if stage.profiler != None:
+            output = io.StringIO()
+            pstats.Stats(stage.profiler, stream=output).sort_stats("cumulative").print_stats(top)
+            f.write("\nTop {} functions by cumulative time:\n".format(top))
+            f.write(output.getvalue())
+
+class profileStage:
+    """Context manager which profiles the code inside it as a stage, if profiling is enabled
+    The outermost stage is run under cProfile (written to PROFILE_DIR/<number>_<name>.pstats, see the pstats module),
+    and every stage records its time and memory with tracemalloc (PROFILE_DIR/<number>_<name>_memory.txt and PROFILE_REPORT_FILE)
+    number counts the stages started so far, and nested stages are named after their outer stages (e.g. 002_outer.inner)"""
+
+    def __init__(self, name):
+        self.stage = Stage(name) if enabled else None
+
+    def __enter__(self):
+        if self.stage != None:
+            self.stage.start()
+        return self.stage
+
+    def __exit__(self, *args):
+        if self.stage != None:
+            self.stage.stop()
+
+def profiled(function):
+    """Decorator which profiles every call of a function as a stage named after the function, if profiling is enabled"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return function(*args, **kwargs)
+        with profileStage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
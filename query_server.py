@@ -0,0 +1,298 @@
+import json, threading, bisect, operator
+from collections import OrderedDict, deque
+from time import perf_counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pdb_crystal_database import (loadStructures, getSensibleStructures, countCompoundFrequencies, countSetFrequencies, printList,
+    STRUCTURES_FILE)
+
+PORT = 8080
+CACHE_SIZE = 1024 # Query results kept in the LRU cache
+DEFAULT_LIMIT = 100 # Structures returned by a query unless it asks for a different limit
+LATENCY_WINDOW = 1000 # Latencies kept per endpoint for the percentiles in /stats
+
+RANGE_FIELDS = ["pH", "temperature", "resolution"]
+FREQUENCY_MODES = ["recognized", "unknown", "pending"]
+
+class QueryError(Exception):
+    """A query with missing or invalid parameters, answered with HTTP 400"""
+    pass
+
+class StructureQueryIndex:
+    """Read-only indexes over a structure list, built once when the server starts
+    Maps pdbids and compounds to structure numbers, keeps the structure numbers sorted by pH, temperature and resolution
+    for range queries, and holds the compound and set frequencies of the sensible structures"""
+
+    def __init__(self, structureList):
+        print("Indexing {} structures...".format(len(structureList)))
+        self.structureList = structureList
+        self.positions = {structure.pdbid: i for i, structure in enumerate(structureList)} # Maps a pdbid to its structure number
+        self.compoundPostings = {} # Maps a compound to the set of structure numbers which have it
+        for i, structure in enumerate(structureList):
+            for compound in structure.compounds[::2]:
+                if compound in self.compoundPostings:
+                    self.compoundPostings[compound].add(i)
+                else:
+                    self.compoundPostings[compound] = {i}
+        self.sortedNumbers = {} # Maps a field to the structure numbers with a value for it, sorted by value
+        self.sortedValues = {} # Maps a field to the sorted values themselves, for bisect
+        for field in RANGE_FIELDS:
+            pairs = sorted((getattr(structure, field), i) for i, structure in enumerate(structureList) if isinstance(getattr(structure, field), (int, float)))
+            self.sortedNumbers[field] = [i for value, i in pairs]
+            self.sortedValues[field] = [value for value, i in pairs]
+
+        sensibleStructures = getSensibleStructures(structureList)
+        sensibleIds = {id(structure) for structure in sensibleStructures}
+        self.sensibleNumbers = {i for i, structure in enumerate(structureList) if id(structure) in sensibleIds}
+        self.frequencies = {"recognized": countCompoundFrequencies(sensibleStructures, "recognized"),
+            "unknown": countCompoundFrequencies(structureList, "unknown"), "pending": countCompoundFrequencies(structureList, "pending")}
+        self.setFrequency = countSetFrequencies(sensibleStructures, {})
+
+    def getStructureNumbers(self, pdbids): # list
+        return [self.positions[pdbid] for pdbid in pdbids if pdbid in self.positions]
+
+    def getRange(self, field, minimum=None, maximum=None): # set
+        """Returns the structure numbers with minimum <= field <= maximum (either bound may be None)"""
+        values = self.sortedValues[field]
+        start = bisect.bisect_left(values, minimum) if minimum != None else 0
+        end = bisect.bisect_right(values, maximum) if maximum != None else len(values)
+        return set(self.sortedNumbers[field][start:end])
+
+    def search(self, compounds=(), ranges=None, sensibleOnly=False): # list
+        """Returns the sorted structure numbers which have every compound in compounds and fall inside every range
+        ranges maps a field to a (minimum, maximum) tuple"""
+        candidateSets = [self.compoundPostings.get(compound, set()) for compound in compounds]
+        for field, (minimum, maximum) in (ranges or {}).items():
+            candidateSets.append(self.getRange(field, minimum, maximum))
+        if sensibleOnly:
+            candidateSets.append(self.sensibleNumbers)
+        if candidateSets == []:
+            return list(range(len(self.structureList)))
+        candidateSets.sort(key=len) # Intersect starting from the smallest set
+        numbers = set(candidateSets[0])
+        for candidates in candidateSets[1:]:
+            numbers &= candidates
+        return sorted(numbers)
+
+    def getFrequencies(self, mode="recognized", limit=None): # list
+        items = sorted(self.frequencies[mode].items(), key=operator.itemgetter(1), reverse=True)
+        return items[:limit] if limit != None else items
+
+    def getSetFrequencies(self, compounds=(), limit=None): # list
+        """Returns [[compounds], count] for the sets of compounds of the sensible structures, most common first
+        If compounds is not empty, only sets which contain all of them are returned"""
+        required = set(compounds)
+        items = [(key, value) for key, value in self.setFrequency.items() if required <= key]
+        items.sort(key=operator.itemgetter(1), reverse=True)
+        if limit != None:
+            items = items[:limit]
+        return [[sorted(key), value] for key, value in items]
+
+class EndpointStats:
+    """Counts requests, cache hits and latencies of one endpoint"""
+
+    def __init__(self):
+        self.requests = 0
+        self.cacheHits = 0
+        self.errors = 0
+        self.totalSeconds = 0.0
+        self.maxSeconds = 0.0
+        self.recent = deque(maxlen=LATENCY_WINDOW) # Latencies of the most recent requests
+
+    def record(self, seconds, cacheHit, error):
+        self.requests += 1
+        self.cacheHits += cacheHit
+        self.errors += error
+        self.totalSeconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+        self.recent.append(seconds)
+
+    def getSnapshot(self): # dictionary
+        recent = sorted(self.recent)
+        quantile = lambda q: recent[min(int(q * len(recent)), len(recent)-1)] * 1000 if recent != [] else None
+        return {"requests": self.requests, "cacheHits": self.cacheHits, "errors": self.errors,
+            "averageMs": self.totalSeconds / self.requests * 1000 if self.requests > 0 else None,
+            "p50Ms": quantile(0.5), "p95Ms": quantile(0.95), "p99Ms": quantile(0.99), "maxMs": self.maxSeconds * 1000}
+
+class QueryServer:
+    """A local read-only HTTP service which answers queries about a structure database as JSON
+    The database is loaded and indexed once, so each query only looks up the indexes instead of loading the database again.
+    Requests are handled in parallel threads, and the results of recent queries are kept in an LRU cache.
+    Endpoints (all GET):
+        /structure?pdbid=1ABC&pdbid=...                           The structures with these pdbids
+        /search?compound=...&pHMin=...&pHMax=...&limit=&offset=   Structures with every compound, in every range
+                (also temperatureMin/Max, resolutionMin/Max and sensible=1 for sensible structures only)
+        /frequencies?mode=recognized|unknown|pending&limit=       Compound frequencies (see getCompoundFrequencies)
+        /sets?compound=...&limit=                                 Set frequencies of the sensible structures (see getSetFrequencies)
+        /stats                                                    Request counts, cache hits and latency of every endpoint"""
+
+    def __init__(self, structureFile=STRUCTURES_FILE, port=PORT, cacheSize=CACHE_SIZE, structureList=None):
+        if structureList == None:
+            structureList = loadStructures(structureFile)
+        self.index = StructureQueryIndex(structureList)
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict() # Maps a query to its response body, least recently used first
+        self.cacheLock = threading.Lock()
+        self.endpoints = {"/structure": self.queryStructure, "/search": self.querySearch, "/frequencies": self.queryFrequencies,
+            "/sets": self.querySets}
+        self.stats = {path: EndpointStats() for path in list(self.endpoints) + ["/stats"]}
+        self.statsLock = threading.Lock()
+        self.startTime = perf_counter()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.getHandler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def getHandler(self): # class
+        queryServer = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = queryServer.handle(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Latencies are in /stats instead
+        return Handler
+
+    def handle(self, path): # tuple
+        """Answers a request path and returns (HTTP status, JSON body)"""
+        start = perf_counter()
+        url = urlparse(path)
+        if url.path == "/stats":
+            body = json.dumps(self.getStats()).encode()
+            self.recordLatency("/stats", perf_counter() - start, False, False)
+            return 200, body
+        if url.path not in self.endpoints:
+            return 404, json.dumps({"error": "Unknown endpoint {}".format(url.path)}).encode()
+
+        parameters = parse_qs(url.query)
+        cacheKey = (url.path, tuple(sorted((key, tuple(values)) for key, values in parameters.items())))
+        with self.cacheLock:
+            body = self.cache.get(cacheKey)
+            if body != None:
+                self.cache.move_to_end(cacheKey)
+        cacheHit = body != None
+        status = 200
+        if not cacheHit:
+            try:
+                body = json.dumps(self.endpoints[url.path](parameters)).encode()
+                with self.cacheLock:
+                    self.cache[cacheKey] = body
+                    if len(self.cache) > self.cacheSize:
+                        self.cache.popitem(last=False)
+            except QueryError as e:
+                status = 400
+                body = json.dumps({"error": str(e)}).encode()
+        self.recordLatency(url.path, perf_counter() - start, cacheHit, status != 200)
+        return status, body
+
+    def recordLatency(self, path, seconds, cacheHit, error):
+        with self.statsLock:
+            self.stats[path].record(seconds, cacheHit, error)
+
+    def getStats(self): # dictionary
+        with self.statsLock:
+            endpoints = {path: stats.getSnapshot() for path, stats in self.stats.items()}
+        with self.cacheLock:
+            cacheEntries = len(self.cache)
+        return {"structures": len(self.index.structureList), "uptimeSeconds": perf_counter() - self.startTime,
+            "cacheEntries": cacheEntries, "cacheSize": self.cacheSize, "endpoints": endpoints}
+
+    def getStructureList(self, numbers, parameters): # dictionary
+        """Returns one page of a list of structure numbers (see the limit and offset parameters) as structure dictionaries"""
+        limit = getInteger(parameters, "limit", DEFAULT_LIMIT)
+        offset = getInteger(parameters, "offset", 0)
+        page = numbers[offset:offset+limit]
+        return {"count": len(numbers), "offset": offset, "structures": [structureToDictionary(self.index.structureList[i]) for i in page]}
+
+    def queryStructure(self, parameters): # dictionary
+        pdbids = [pdbid.upper() for pdbid in parameters.get("pdbid", [])]
+        if pdbids == []:
+            raise QueryError("Missing parameter: pdbid")
+        numbers = self.index.getStructureNumbers(pdbids)
+        return {"count": len(numbers), "missing": [pdbid for pdbid in pdbids if pdbid not in self.index.positions],
+            "structures": [structureToDictionary(self.index.structureList[i]) for i in numbers]}
+
+    def querySearch(self, parameters): # dictionary
+        ranges = {}
+        for field in RANGE_FIELDS:
+            minimum = getFloat(parameters, field + "Min")
+            maximum = getFloat(parameters, field + "Max")
+            if minimum != None or maximum != None:
+                ranges[field] = (minimum, maximum)
+        sensibleOnly = parameters.get("sensible", ["0"])[0] in ["1", "true"]
+        numbers = self.index.search(parameters.get("compound", []), ranges, sensibleOnly)
+        return self.getStructureList(numbers, parameters)
+
+    def queryFrequencies(self, parameters): # dictionary
+        mode = parameters.get("mode", ["recognized"])[0]
+        if mode not in FREQUENCY_MODES:
+            raise QueryError("mode must be one of: {}".format(printList(FREQUENCY_MODES)))
+        return {"mode": mode, "frequencies": self.index.getFrequencies(mode, getInteger(parameters, "limit", None))}
+
+    def querySets(self, parameters): # dictionary
+        return {"sets": self.index.getSetFrequencies(parameters.get("compound", []), getInteger(parameters, "limit", DEFAULT_LIMIT))}
+
+    def getUrl(self): # string
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def serveForever(self):
+        print("Serving {} structures at {}".format(len(self.index.structureList), self.getUrl()))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+def structureToDictionary(structure): # dictionary
+    return {"pdbid": structure.pdbid, "pmcid": structure.pmcid, "details": structure.details, "compounds": structure.compounds,
+        "pH": structure.pH, "temperature": structure.temperature, "method": structure.method, "sequences": structure.sequences,
+        "resolution": structure.resolution}
+
+def getInteger(parameters, name, default): # int
+    if name not in parameters:
+        return default
+    try:
+        value = int(parameters[name][0])
+    except ValueError:
+        raise QueryError("{} must be an integer".format(name))
+    if value < 0:
+        raise QueryError("{} must not be negative".format(name))
+    return value
+
+def getFloat(parameters, name): # float
+    if name not in parameters:
+        return None
+    try:
+        return float(parameters[name][0])
+    except ValueError:
+        raise QueryError("{} must be a number".format(name))
+
+if __name__ == "__main__":
+    QueryServer(STRUCTURES_FILE, port=PORT).serveForever()
+    # Example queries:
+    # curl "http://127.0.0.1:8080/structure?pdbid=1ABC"
+    # curl "http://127.0.0.1:8080/search?compound=SODIUM%20CHLORIDE&pHMin=6&pHMax=8&sensible=1&limit=10"
+    # curl "http://127.0.0.1:8080/frequencies?mode=recognized&limit=20"
+    # curl "http://127.0.0.1:8080/stats"
@@ -0,0 +1,186 @@
+import os, pickle, zlib, hashlib, threading
+from time import time
+from pathlib import Path
+from pdb_crystal_database import STRUCTURE_DIR
+
+RESPONSE_CACHE_DIR = STRUCTURE_DIR / "response_cache"
+INDEX_FILENAME = "index.pkl"
+
+SEGMENT_SIZE = 64 * 1024 * 1024 # Bytes written to a segment file before a new one is started
+MAX_CACHE_SIZE = 4 * 1024 * 1024 * 1024 # Bytes of compressed responses kept before the least recently used are evicted
+COMPACT_RATIO = 0.5 # Segments are compacted when more than this fraction of their bytes belong to evicted responses
+
+class ResponseCache:
+    """An on-disk cache of raw PDB responses, keyed by pdbid
+    Responses are compressed with zlib and appended to large segment files instead of one file per entry,
+    and are stored by the SHA-256 hash of their content, so identical responses are only stored once.
+    The index (pdbid --> content hash --> location in a segment) is kept in memory and written by save().
+    When the cache grows past maxSize the least recently used responses are evicted, and segments which
+    are mostly evicted data are rewritten by compact()"""
+
+    def __init__(self, cacheDir=RESPONSE_CACHE_DIR, maxSize=MAX_CACHE_SIZE, segmentSize=SEGMENT_SIZE):
+        self.cacheDir = Path(cacheDir)
+        self.maxSize = maxSize
+        self.segmentSize = segmentSize
+        self.lock = threading.RLock()
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+        self.entries = {} # Maps a pdbid to [content hash, time stored, time last used]
+        self.blobs = {} # Maps a content hash to [segment number, offset, compressed length, number of pdbids using it]
+        self.segmentSizes = {} # Maps a segment number to the number of bytes written to it
+        self.liveBytes = 0 # Compressed bytes which are still referenced by an entry
+        try:
+            with open(self.cacheDir / INDEX_FILENAME, "rb") as f:
+                self.entries, self.blobs, self.segmentSizes = pickle.load(f)
+            self.liveBytes = sum(blob[2] for blob in self.blobs.values())
+        except FileNotFoundError:
+            pass
+        self.currentSegment = max(self.segmentSizes) if self.segmentSizes else 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pdbid):
+        return pdbid in self.entries
+
+    def getSegmentFile(self, segment): # Path
+        return self.cacheDir / "segment_{:05d}.dat".format(segment)
+
+    def get(self, pdbid): # bytes
+        """Returns the raw response for a pdbid, or None if it is not cached"""
+        with self.lock:
+            entry = self.entries.get(pdbid)
+            if entry == None:
+                return None
+            entry[2] = time()
+            segment, offset, length, references = self.blobs[entry[0]]
+            with open(self.getSegmentFile(segment), "rb") as f:
+                f.seek(offset)
+                return zlib.decompress(f.read(length))
+
+    def getStoredTime(self, pdbid): # float
+        """Returns the time (in seconds since the epoch) when the response for a pdbid was stored, or None if it is not cached"""
+        entry = self.entries.get(pdbid)
+        return entry[1] if entry != None else None
+
+    def put(self, pdbid, content):
+        """Stores the raw response (bytes) for a pdbid, replacing any cached response"""
+        digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            now = time()
+            oldEntry = self.entries.get(pdbid)
+            if oldEntry != None and oldEntry[0] == digest:
+                oldEntry[1] = now
+                oldEntry[2] = now
+                return
+            if digest in self.blobs:
+                self.blobs[digest][3] += 1
+            else:
+                compressed = zlib.compress(content)
+                if self.segmentSizes.get(self.currentSegment, 0) + len(compressed) > self.segmentSize and self.segmentSizes.get(self.currentSegment, 0) > 0:
+                    self.currentSegment += 1
+                segmentFile = self.getSegmentFile(self.currentSegment)
+                with open(segmentFile, "ab") as f:
+                    offset = f.tell()
+                    f.write(compressed)
+                self.segmentSizes[self.currentSegment] = offset + len(compressed)
+                self.blobs[digest] = [self.currentSegment, offset, len(compressed), 1]
+                self.liveBytes += len(compressed)
+            self.entries[pdbid] = [digest, now, now]
+            if oldEntry != None:
+                self.release(oldEntry[0])
+            if self.liveBytes > self.maxSize:
+                self.evict()
+
+    def remove(self, pdbid):
+        """Removes the cached response for a pdbid, if there is one"""
+        with self.lock:
+            entry = self.entries.pop(pdbid, None)
+            if entry != None:
+                self.release(entry[0])
+
+    def release(self, digest):
+        """Removes one reference to a blob, and forgets the blob if nothing refers to it
+        The bytes stay in the segment file until it is compacted"""
+        blob = self.blobs[digest]
+        blob[3] -= 1
+        if blob[3] == 0:
+            del self.blobs[digest]
+            self.liveBytes -= blob[2]
+
+    def evict(self):
+        """Removes the least recently used responses until the cache is at most 90% of maxSize"""
+        target = self.maxSize * 0.9
+        for pdbid, entry in sorted(self.entries.items(), key=lambda item: item[1][2]):
+            if self.liveBytes <= target:
+                break
+            del self.entries[pdbid]
+            self.release(entry[0])
+        self.compactSegments()
+
+    def compact(self):
+        """Rewrites segments in which more than COMPACT_RATIO of the bytes belong to removed responses"""
+        with self.lock:
+            self.compactSegments()
+
+    def compactSegments(self):
+        liveBySegment = {}
+        for digest, (segment, offset, length, references) in self.blobs.items():
+            liveBySegment[segment] = liveBySegment.get(segment, 0) + length
+        for segment, size in list(self.segmentSizes.items()):
+            if segment == self.currentSegment or size == 0 or liveBySegment.get(segment, 0) / size > 1 - COMPACT_RATIO:
+                continue
+            # Copy the live blobs to the end of the current segment, then delete the old segment
+            with open(self.getSegmentFile(segment), "rb") as f:
+                for digest, blob in list(self.blobs.items()):
+                    if blob[0] == segment:
+                        f.seek(blob[1])
+                        compressed = f.read(blob[2])
+                        with open(self.getSegmentFile(self.currentSegment), "ab") as out:
+                            newOffset = out.tell()
+                            out.write(compressed)
+                        self.segmentSizes[self.currentSegment] = newOffset + len(compressed)
+                        blob[0] = self.currentSegment
+                        blob[1] = newOffset
+            # The index must point at the new locations before the old segment disappears
+            self.writeIndex()
+            os.remove(self.getSegmentFile(segment))
+            del self.segmentSizes[segment]
+        self.writeIndex()
+
+    def writeIndex(self):
+        temporaryFile = self.cacheDir / (INDEX_FILENAME + ".tmp")
+        with open(temporaryFile, "wb") as f:
+            pickle.dump((self.entries, self.blobs, self.segmentSizes), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporaryFile, self.cacheDir / INDEX_FILENAME)
+
+    def save(self):
+        """Writes the index to disk. Responses stored since the last save are lost if the index is not saved"""
+        with self.lock:
+            self.writeIndex()
+
+    def iterResponses(self): # generator
+        """Yields a (pdbid, raw response) tuple for every cached response, in the order they are stored on disk
+        so that a whole cache can be read at disk speed. Does not count as using the responses"""
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda item: self.blobs[item[1][0]][:2])
+        openSegment = None
+        f = None
+        try:
+            for pdbid, entry in items:
+                segment, offset, length, references = self.blobs[entry[0]]
+                if segment != openSegment:
+                    if f != None:
+                        f.close()
+                    f = open(self.getSegmentFile(segment), "rb")
+                    openSegment = segment
+                f.seek(offset)
+                yield (pdbid, zlib.decompress(f.read(length)))
+        finally:
+            if f != None:
+                f.close()
+
+    def getSize(self): # int
+        """Returns the number of compressed bytes in use"""
+        return self.liveBytes
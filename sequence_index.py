@@ -0,0 +1,309 @@
+import pickle, operator, random
+import pdb_crystal_database as database
+from difflib import SequenceMatcher
+from time import perf_counter
+from pdb_crystal_database import loadStructures, isSensible, STRUCTURES_FILE, STRUCTURE_DIR
+
+SEQUENCE_INDEX_FILE = STRUCTURE_DIR / "sequence_index.pkl"
+
+# Sketch parameters - NUM_BINS must be divisible by BANDS
+# With 32 bands of 4 rows each, pairs with a k-mer Jaccard similarity above ~0.4 are very likely to collide
+KMER_LENGTH = 5
+NUM_BINS = 128
+BANDS = 32
+
+HASH_MASK = (1 << 64) - 1
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+EMPTY_BIN = HASH_MASK
+
+class SequenceIndex:
+    """A MinHash/LSH index over the protein sequences of a list of structures
+    Each unique sequence is reduced to a one-permutation MinHash sketch of its k-mers,
+    and the sketch is split into bands which are used as keys in a set of hash tables.
+    Sequences which share at least one band are candidates for a query, and are ranked
+    by the fraction of matching sketch bins (an estimate of the k-mer Jaccard similarity)"""
+
+    def __init__(self, kmerLength=KMER_LENGTH, numBins=NUM_BINS, bands=BANDS, seed=1):
+        if numBins % bands != 0:
+            raise ValueError("numBins ({}) must be divisible by bands ({})".format(numBins, bands))
+        self.kmerLength = kmerLength
+        self.numBins = numBins
+        self.bands = bands
+        self.rows = numBins // bands
+        self.seed = seed
+        self.sequences = [] # Unique sequences, indexed by sequence id
+        self.sequenceIds = {} # Maps a sequence to its sequence id
+        self.pdbids = [] # Maps a sequence id to a list of the pdbids that contain that sequence
+        self.sketches = [] # Maps a sequence id to its sketch (a tuple of ints)
+        self.buckets = [{} for i in range(bands)] # One hash table per band, mapping band values to a list of sequence ids
+        self.clearStructures()
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __getstate__(self):
+        # The structures are not saved with the index, since they are already saved in the structure file
+        state = self.__dict__.copy()
+        for attribute in ("structureList", "structureCount", "structureDictionary", "compoundDictionary", "dictionaryValues"):
+            state.pop(attribute, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clearStructures()
+
+    def clearStructures(self):
+        self.structureList = None # The list of structures used to answer getSimilarConditions (see setStructures)
+        self.structureCount = 0 # The length of structureList when structureDictionary was built
+        self.structureDictionary = {} # Maps pdbids to structures of structureList
+        self.compoundDictionary = {} # A copy of the compound dictionary dictionaryValues was built from
+        self.dictionaryValues = set() # The compound dictionary values, used to check if structures are sensible
+
+    def setStructures(self, structureList):
+        """Sets the list of structures used by getSimilarConditions, so that the lookups it needs are only built once
+        Call it again after replacing structures of the list in place (e.g. structureList[i] = newStructure),
+        which updateStructures can not tell from the length of the list"""
+        self.structureList = structureList
+        self.structureCount = len(structureList)
+        self.structureDictionary = {structure.pdbid: structure for structure in structureList}
+        self.compoundDictionary = dict(database.compoundDictionary)
+        self.dictionaryValues = set(self.compoundDictionary.values())
+
+    def updateStructures(self, structureList):
+        """Rebuilds the lookups of getSimilarConditions if structureList is not the list they were built from,
+        if it was appended to or shortened, or if the compound dictionary changed since"""
+        if structureList is not self.structureList or len(structureList) != self.structureCount:
+            self.setStructures(structureList)
+        elif self.compoundDictionary != database.compoundDictionary:
+            self.compoundDictionary = dict(database.compoundDictionary)
+            self.dictionaryValues = set(self.compoundDictionary.values())
+
+    def getSketch(self, sequence): # tuple
+        """Returns the one-permutation MinHash sketch of a sequence
+        Every k-mer is hashed once, the hash picks a bin, and each bin keeps its minimum value
+        Empty bins are filled from the next non-empty bin so that short sequences can still be compared"""
+        k = self.kmerLength
+        numBins = self.numBins
+        mins = [EMPTY_BIN] * numBins
+        for kmer in {sequence[i:i+k] for i in range(len(sequence)-k+1)}:
+            h = (int.from_bytes(kmer.encode(), "big") * HASH_MULTIPLIER + self.seed) & HASH_MASK
+            h ^= h >> 29
+            h = (h * HASH_MULTIPLIER) & HASH_MASK
+            h ^= h >> 32
+            b = h % numBins
+            v = h // numBins
+            if v < mins[b]:
+                mins[b] = v
+
+        # Densify empty bins by borrowing from the next non-empty bin (rotating)
+        if EMPTY_BIN in mins and any(v != EMPTY_BIN for v in mins):
+            for b in range(numBins):
+                if mins[b] == EMPTY_BIN:
+                    offset = 1
+                    while mins[(b+offset) % numBins] == EMPTY_BIN:
+                        offset += 1
+                    # Add the offset so that borrowed values differ from the bins they were borrowed from
+                    mins[b] = mins[(b+offset) % numBins] + offset * numBins
+        return tuple(mins)
+
+    def getBandKeys(self, sketch): # list
+        """Splits a sketch into one hashable key per band"""
+        rows = self.rows
+        return [sketch[i*rows:(i+1)*rows] for i in range(self.bands)]
+
+    def addSequence(self, sequence, pdbid):
+        """Adds a single sequence belonging to pdbid to the index"""
+        sequence = cleanSequence(sequence)
+        if len(sequence) < self.kmerLength:
+            return
+        if sequence in self.sequenceIds:
+            sequenceId = self.sequenceIds[sequence]
+            if pdbid not in self.pdbids[sequenceId]:
+                self.pdbids[sequenceId].append(pdbid)
+            return
+
+        sequenceId = len(self.sequences)
+        sketch = self.getSketch(sequence)
+        self.sequences.append(sequence)
+        self.sequenceIds[sequence] = sequenceId
+        self.pdbids.append([pdbid])
+        self.sketches.append(sketch)
+        for band, key in zip(self.buckets, self.getBandKeys(sketch)):
+            if key in band:
+                band[key].append(sequenceId)
+            else:
+                band[key] = [sequenceId]
+
+    def addStructures(self, structureList):
+        """Adds the sequences of every structure in a list to the index"""
+        print("Indexing sequences of {} structures...".format(len(structureList)))
+        count = 1
+        for structure in structureList:
+            if count % 10000 == 0:
+                print("Indexing structure {} of {}...".format(count, len(structureList)))
+            for sequence in structure.sequences:
+                if sequence != None:
+                    self.addSequence(sequence, structure.pdbid)
+            count += 1
+        print("Indexed {} unique sequences".format(len(self.sequences)))
+
+    def query(self, sequence, limit=10, minSimilarity=0.0, rerank=False): # list
+        """Returns a list of (sequenceId, similarity) tuples for the indexed sequences most similar to sequence
+        The similarity is the estimated k-mer Jaccard similarity taken from the sketches
+        If rerank is True, then the candidates are re-ranked by an exact sequence similarity (difflib ratio),
+            which is slower but does not depend on the sketch estimate
+        Only results with a similarity of at least minSimilarity are returned"""
+        sequence = cleanSequence(sequence)
+        if len(sequence) < self.kmerLength:
+            return []
+        sketch = self.getSketch(sequence)
+
+        candidates = set()
+        for band, key in zip(self.buckets, self.getBandKeys(sketch)):
+            if key in band:
+                candidates.update(band[key])
+
+        results = []
+        for sequenceId in candidates:
+            otherSketch = self.sketches[sequenceId]
+            matches = sum(1 for a, b in zip(sketch, otherSketch) if a == b)
+            results.append((sequenceId, matches / self.numBins))
+        results.sort(key=operator.itemgetter(1), reverse=True)
+
+        if rerank:
+            # Only re-rank a bounded number of candidates so that the exact step stays cheap
+            reranked = []
+            for sequenceId, estimate in results[:max(limit*5, 50)]:
+                matcher = SequenceMatcher(None, sequence, self.sequences[sequenceId], autojunk=False)
+                reranked.append((sequenceId, matcher.ratio()))
+            results = sorted(reranked, key=operator.itemgetter(1), reverse=True)
+
+        return [(sequenceId, similarity) for sequenceId, similarity in results if similarity >= minSimilarity][:limit]
+
+    def getSimilarPdbids(self, sequence, limit=10, minSimilarity=0.0, rerank=False): # list
+        """Returns a list of (pdbid, similarity) tuples for structures with a sequence similar to sequence
+        Each pdbid only appears once, with the similarity of its most similar sequence"""
+        output = []
+        seen = set()
+        for sequenceId, similarity in self.query(sequence, limit=limit, minSimilarity=minSimilarity, rerank=rerank):
+            for pdbid in self.pdbids[sequenceId]:
+                if pdbid not in seen:
+                    seen.add(pdbid)
+                    output.append((pdbid, similarity))
+        return output
+
+def cleanSequence(sequence): # string
+    """Removes whitespace and makes a sequence uppercase so that equivalent sequences are indexed once"""
+    return "".join(sequence.split()).upper()
+
+def buildSequenceIndex(structureList, indexFile=None, **kwargs): # SequenceIndex
+    """Builds a SequenceIndex from a list of structures
+    If indexFile is not None, the index is also saved to that file
+    Keyword arguments are passed to the SequenceIndex constructor"""
+    index = SequenceIndex(**kwargs)
+    index.addStructures(structureList)
+    if indexFile != None:
+        writeSequenceIndex(index, indexFile)
+    return index
+
+def loadSequenceIndex(indexFile=SEQUENCE_INDEX_FILE): # SequenceIndex
+    """Returns a SequenceIndex from a pickle file"""
+    print("Loading sequence index from file {}...".format(indexFile))
+    with open(indexFile, "rb") as f:
+        return pickle.load(f)
+
+def writeSequenceIndex(index, indexFile=SEQUENCE_INDEX_FILE):
+    """Writes a SequenceIndex to a pickle file"""
+    print("Writing sequence index to file {}...".format(indexFile))
+    with open(indexFile, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def getSimilarConditions(index, structureList, sequence, limit=10, minSimilarity=0.3, rerank=False, sensibleOnly=True): # list
+    """Answers "how were proteins like mine crystallized?"
+    Returns a list of dictionaries with the standardized conditions of structures with sequences similar to sequence,
+    most similar first
+    If sensibleOnly is True, then only structures whose compounds are all found in the dictionary are returned
+    The lookups over structureList are built on the first query and kept on the index (see SequenceIndex.updateStructures)"""
+    index.updateStructures(structureList)
+    structureDictionary = index.structureDictionary
+    # Over-fetch so that filtering out non-sensible structures still leaves enough results
+    similarPdbids = index.getSimilarPdbids(sequence, limit=limit*5 if sensibleOnly else limit, minSimilarity=minSimilarity, rerank=rerank)
+
+    output = []
+    for pdbid, similarity in similarPdbids:
+        structure = structureDictionary.get(pdbid)
+        if structure != None and (not sensibleOnly or isSensible(structure, index.dictionaryValues)):
+            output.append({
+                "pdbid": pdbid,
+                "similarity": similarity,
+                "compounds": structure.compounds,
+                "pH": structure.pH,
+                "temperature": structure.temperature,
+                "method": structure.method,
+                "resolution": structure.resolution
+            })
+        if len(output) >= limit:
+            break
+    return output
+
+def getKmerJaccard(a, b, kmerLength=KMER_LENGTH): # float
+    """Returns the exact Jaccard similarity of the k-mer sets of two sequences"""
+    kmersA = {a[i:i+kmerLength] for i in range(len(a)-kmerLength+1)}
+    kmersB = {b[i:i+kmerLength] for i in range(len(b)-kmerLength+1)}
+    if not kmersA or not kmersB:
+        return 0.0
+    return len(kmersA & kmersB) / len(kmersA | kmersB)
+
+def benchmarkSequenceIndex(structureList, sampleSize=100, bruteForceSampleSize=10, limit=10, minSimilarity=0.5, seed=0):
+    """Benchmarks the sequence index over a list of structures and prints the results
+    Reports the build time, the average query time with and without re-ranking,
+    and the recall of the index compared to a brute force k-mer Jaccard scan (for a smaller sample,
+    since the brute force scan compares the query to every unique sequence)"""
+    start = perf_counter()
+    index = buildSequenceIndex(structureList)
+    buildTime = perf_counter() - start
+
+    rng = random.Random(seed)
+    sample = rng.sample(index.sequences, min(sampleSize, len(index.sequences)))
+    if sample == []:
+        print("No sequences to benchmark")
+        return
+
+    start = perf_counter()
+    for sequence in sample:
+        index.query(sequence, limit=limit)
+    queryTime = (perf_counter() - start) / len(sample)
+
+    start = perf_counter()
+    for sequence in sample:
+        index.query(sequence, limit=limit, rerank=True)
+    rerankTime = (perf_counter() - start) / len(sample)
+
+    found = 0
+    total = 0
+    start = perf_counter()
+    bruteSample = sample[:bruteForceSampleSize]
+    for sequence in bruteSample:
+        exact = [(i, getKmerJaccard(sequence, s, index.kmerLength)) for i, s in enumerate(index.sequences)]
+        exact = {i for i, similarity in sorted(exact, key=operator.itemgetter(1), reverse=True)[:limit] if similarity >= minSimilarity}
+        approximate = {i for i, similarity in index.query(sequence, limit=limit*2)}
+        found += len(exact & approximate)
+        total += len(exact)
+    bruteForceTime = (perf_counter() - start) / len(bruteSample)
+
+    print("Sequence index benchmark:")
+    print("\tUnique sequences: {}".format(len(index)))
+    print("\tBuild time: {:.2f} s".format(buildTime))
+    print("\tQuery time: {:.3f} ms".format(queryTime*1000))
+    print("\tQuery time with re-ranking: {:.3f} ms".format(rerankTime*1000))
+    print("\tBrute force time: {:.3f} ms".format(bruteForceTime*1000))
+    if total > 0:
+        print("\tRecall of top {} (Jaccard >= {}): {:.3f}".format(limit, minSimilarity, found / total))
+
+if __name__ == "__main__":
+    structureList = loadStructures(STRUCTURES_FILE)
+    # index = buildSequenceIndex(structureList, indexFile=SEQUENCE_INDEX_FILE)
+    # index = loadSequenceIndex(SEQUENCE_INDEX_FILE)
+    # for conditions in getSimilarConditions(index, structureList, "MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF", rerank=True):
+    #     print(conditions)
+    benchmarkSequenceIndex(structureList)
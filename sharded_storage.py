@@ -0,0 +1,207 @@
+import pickle, hashlib, json, os
+from pathlib import Path
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from pdb_crystal_database import loadStructures, STRUCTURES_FILE, STRUCTURE_DIR
+
+SHARD_DIR = STRUCTURE_DIR / "structures.shards"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Shards read or written at the same time. Reads overlap with each other, but unpickling holds the GIL,
+# so more threads mostly help when the shards are not in the disk cache (e.g. on a network drive)
+LOAD_THREADS = 4
+
+class ShardedStructureList(list):
+    """A list of structures loaded from a shard directory (see loadShards), which remembers where it was loaded from
+    so that writeShards knows if it holds every structure"""
+
+    def __init__(self, structureList, shardDir, partial):
+        super().__init__(structureList)
+        self.shardDir = Path(shardDir).resolve()
+        self.partial = partial # True if only some of the structures were loaded (with a pdbidList or shardKeys)
+
+    def __reduce__(self):
+        # Pickled (e.g. by writeStructures) as a plain list
+        return (list, (list(self),))
+
+def getShardKey(pdbid): # string
+    """Returns the shard of a pdbid: the middle two characters of the 4 character ID, as in the PDB archive (1ABC --> "ab")
+    Extended IDs (e.g. pdb_00001abc) use the same characters of their last 4 characters"""
+    return pdbid[-3:-1].lower()
+
+def getManifestFile(shardDir=SHARD_DIR): # Path
+    return Path(shardDir) / MANIFEST_NAME
+
+def loadManifest(shardDir=SHARD_DIR): # dictionary
+    """Returns the manifest of a shard directory, or an empty manifest if there is none
+    The manifest maps each shard key to the file, number of structures and sha256 hash of the shard"""
+    manifestFile = getManifestFile(shardDir)
+    if not manifestFile.exists():
+        return {"version": MANIFEST_VERSION, "count": 0, "shards": {}}
+    with open(manifestFile) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("{} has an unsupported manifest version: {}".format(manifestFile, manifest.get("version")))
+    return manifest
+
+def writeManifest(manifest, shardDir=SHARD_DIR):
+    manifest["count"] = sum(shard["count"] for shard in manifest["shards"].values())
+    temporaryFile = str(getManifestFile(shardDir)) + ".tmp"
+    with open(temporaryFile, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(temporaryFile, getManifestFile(shardDir))
+
+def splitIntoShards(structureList): # dictionary
+    """Returns a dictionary mapping shard keys to the lists of structures in each shard, in the order of structureList"""
+    shards = {}
+    for structure in structureList:
+        key = getShardKey(structure.pdbid)
+        if key not in shards:
+            shards[key] = []
+        shards[key].append(structure)
+    return shards
+
+def mergeShard(oldStructures, newStructures): # list
+    """Returns the structures of a shard with newStructures replacing the old structures with the same pdbid
+    New pdbids are added to the end"""
+    positions = {structure.pdbid: i for i, structure in enumerate(oldStructures)}
+    merged = list(oldStructures)
+    for structure in newStructures:
+        if structure.pdbid in positions:
+            merged[positions[structure.pdbid]] = structure
+        else:
+            positions[structure.pdbid] = len(merged)
+            merged.append(structure)
+    return merged
+
+def readShard(shardFile): # list
+    with open(shardFile, "rb") as f:
+        return pickle.loads(f.read())
+
+def writeBytes(data, outputFile):
+    """Writes bytes to a temporary file and then replaces outputFile, so an interrupted write never leaves a partial shard"""
+    temporaryFile = str(outputFile) + ".tmp"
+    with open(temporaryFile, "wb") as f:
+        f.write(data)
+    os.replace(temporaryFile, outputFile)
+
+def writeShards(structureList, shardDir=SHARD_DIR, partial=False, threads=LOAD_THREADS): # dictionary
+    """Writes a list of structures to a shard directory, rewriting only the shards whose contents changed
+    Every shard is pickled and compared to the hash in the manifest, and only shards with a different hash are written,
+    so saving after a small change (e.g. a few new or reparsed structures) writes a few small files instead of the whole database
+    If partial is True, structureList only holds some of the structures (e.g. loaded with loadShards(pdbidList=...)):
+    they replace the stored structures with the same pdbids and everything else is kept. Otherwise structureList replaces
+    the whole database, and shards which have no structures in it are deleted
+    A ShardedStructureList loaded from shardDir is always written as partial if it was a partial load
+    Returns a dictionary with the lists of "written", "unchanged" and "deleted" shard keys"""
+    print("Writing structures to shard directory {}...".format(shardDir))
+    os.makedirs(shardDir, exist_ok=True)
+    manifest = loadManifest(shardDir)
+    shards = splitIntoShards(structureList)
+    loaded = isinstance(structureList, ShardedStructureList) and structureList.shardDir == Path(shardDir).resolve()
+    if loaded and structureList.partial:
+        partial = True
+    changes = {"written": [], "unchanged": [], "deleted": []}
+    if partial:
+        # Structures of a shard which are not in structureList (e.g. a subset was loaded) are kept
+        for key in shards:
+            if key in manifest["shards"]:
+                shards[key] = mergeShard(readShard(Path(shardDir) / manifest["shards"][key]["file"]), shards[key])
+    writes = []
+    for key, shardStructures in shards.items():
+        data = pickle.dumps(shardStructures, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+        oldShard = manifest["shards"].get(key)
+        if oldShard != None and oldShard["sha256"] == digest and (Path(shardDir) / oldShard["file"]).exists():
+            changes["unchanged"].append(key)
+            continue
+        fileName = key + ".pkl"
+        writes.append((data, Path(shardDir) / fileName))
+        manifest["shards"][key] = {"file": fileName, "count": len(shardStructures), "sha256": digest}
+        changes["written"].append(key)
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda write: writeBytes(*write), writes))
+
+    if not partial:
+        for key in list(manifest["shards"]):
+            if key not in shards:
+                shardFile = Path(shardDir) / manifest["shards"][key]["file"]
+                if shardFile.exists():
+                    os.remove(shardFile)
+                del manifest["shards"][key]
+                changes["deleted"].append(key)
+    # The manifest is written last, so it never refers to a shard which has not been written yet
+    writeManifest(manifest, shardDir)
+    print("Wrote {} shards ({} unchanged, {} deleted)".format(len(changes["written"]), len(changes["unchanged"]), len(changes["deleted"])))
+    return changes
+
+def loadShards(shardDir=SHARD_DIR, pdbidList=None, shardKeys=None, threads=LOAD_THREADS): # list
+    """Returns the structures in a shard directory, reading the shards in parallel threads
+    If pdbidList is not None, only the shards holding those pdbids are read, and only those structures are returned
+    If shardKeys is not None, only those shards are read
+    Structures are returned shard by shard (in order of shard key), in the order they were written within each shard,
+    as a ShardedStructureList, so that writing them back with writeShards only writes the shards that changed
+    (and never deletes the shards that were not loaded)"""
+    if not getManifestFile(shardDir).exists():
+        raise FileNotFoundError(2, "No such file or directory", str(getManifestFile(shardDir)))
+    manifest = loadManifest(shardDir)
+    keys = sorted(manifest["shards"])
+    if shardKeys != None:
+        shardKeys = set(shardKeys)
+        keys = [key for key in keys if key in shardKeys]
+    if pdbidList != None:
+        pdbidSet = set(pdbidList)
+        neededKeys = {getShardKey(pdbid) for pdbid in pdbidSet}
+        keys = [key for key in keys if key in neededKeys]
+    print("Loading {} of {} shards from {}...".format(len(keys), len(manifest["shards"]), shardDir))
+    shardFiles = [Path(shardDir) / manifest["shards"][key]["file"] for key in keys]
+    with ThreadPoolExecutor(threads) as executor:
+        shardLists = list(executor.map(readShard, shardFiles))
+    structureList = []
+    for key, shardStructures in zip(keys, shardLists):
+        if pdbidList != None:
+            shardStructures = [structure for structure in shardStructures if structure.pdbid in pdbidSet]
+        structureList.extend(shardStructures)
+    return ShardedStructureList(structureList, shardDir, pdbidList != None or shardKeys != None)
+
+def convertPickleToShards(structureFile=STRUCTURES_FILE, shardDir=SHARD_DIR):
+    writeShards(loadStructures(structureFile), shardDir)
+
+def benchmarkShards(structureFile=STRUCTURES_FILE, shardDir=SHARD_DIR, changed=10):
+    """Prints the time to load and save the pickled structure file and the shard directory,
+    and the time to save the shards after changing a few structures"""
+    from pdb_crystal_database import writeStructures
+    start = perf_counter()
+    structureList = loadStructures(structureFile)
+    pickleLoadTime = perf_counter() - start
+    start = perf_counter()
+    writeStructures(structureList, str(structureFile) + ".copy")
+    pickleWriteTime = perf_counter() - start
+    os.remove(str(structureFile) + ".copy")
+
+    writeShards(structureList, shardDir)
+    start = perf_counter()
+    shardList = loadShards(shardDir)
+    shardLoadTime = perf_counter() - start
+    if sorted(s.pdbid for s in shardList) != sorted(s.pdbid for s in structureList):
+        print("ERROR: The shards do not match the structure file")
+
+    for structure in shardList[::max(len(shardList) // changed, 1)][:changed]:
+        structure.details += " "
+    start = perf_counter()
+    changes = writeShards(shardList, shardDir)
+    shardWriteTime = perf_counter() - start
+
+    pdbids = [structure.pdbid for structure in structureList[:changed]]
+    start = perf_counter()
+    loadShards(shardDir, pdbidList=pdbids)
+    subsetTime = perf_counter() - start
+    print("Pickle: loaded in {:.2f} s, written in {:.2f} s".format(pickleLoadTime, pickleWriteTime))
+    print("Shards: loaded in {:.2f} s, {} changed structures saved in {:.2f} s ({} shards written)".format(shardLoadTime,
+        changed, shardWriteTime, len(changes["written"])))
+    print("{} pdbids loaded from their shards in {:.3f} s".format(len(pdbids), subsetTime))
+
+if __name__ == "__main__":
+    benchmarkShards(STRUCTURES_FILE, SHARD_DIR)
+    # convertPickleToShards(STRUCTURES_FILE, SHARD_DIR)
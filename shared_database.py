@@ -0,0 +1,364 @@
+import json, bisect, math, os
+from array import array
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from pdb_crystal_database import Structure, parseConcentration, loadStructures, STRUCTURES_FILE
+
+HEADER_LENGTH_SIZE = 8 # Bytes at the start of the block holding the length of the JSON header
+ALIGNMENT = 8 # Every array starts at a multiple of this many bytes
+
+# The database of the current process, when it is a worker attached with attachWorker
+workerDatabase = None
+
+class SharedStrings:
+    """A read-only list of strings (or None) stored as one utf-8 pool plus an array of offsets into it"""
+
+    def __init__(self, pool, offsets, nulls):
+        self.pool = pool # Bytes of every string, one after the other
+        self.offsets = offsets # String i is pool[offsets[i]:offsets[i+1]]
+        self.nulls = nulls # 1 if string i is None
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def __getitem__(self, i): # string
+        if self.nulls[i]:
+            return None
+        return bytes(self.pool[self.offsets[i]:self.offsets[i+1]]).decode("utf-8")
+
+class SharedDatabase:
+    """A read-only copy of a structure list in one multiprocessing.shared_memory block
+    Numeric fields are stored as arrays, string fields as pools of utf-8 bytes, and compounds as a compressed
+    sparse row incidence (structure --> compound ids and concentrations) plus the transposed postings
+    (compound --> structures). Worker processes attach by name and read the block directly, so the database
+    is in memory once no matter how many workers use it. Structures are read through StructureView objects.
+    Create one with publish, and attach to it from other processes with SharedDatabase(name)"""
+
+    def __init__(self, name, owner=False):
+        self.memory = shared_memory.SharedMemory(name=name)
+        if not owner and multiprocessing.parent_process() == None:
+            # Before Python 3.13 attaching also registers the block with the resource tracker, which unlinks it when
+            # the process exits. Child processes share the tracker of their parent, but an unrelated process has its own
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.owner = owner
+        self.views = []
+        buffer = self.memory.buf
+        headerLength = int.from_bytes(buffer[:HEADER_LENGTH_SIZE], "little")
+        header = json.loads(bytes(buffer[HEADER_LENGTH_SIZE:HEADER_LENGTH_SIZE+headerLength]).decode("utf-8"))
+        self.count = header["count"]
+        arrays = {}
+        for arrayName, (offset, typecode, size) in header["arrays"].items():
+            view = buffer[offset:offset+size].cast(typecode).toreadonly()
+            self.views.append(view)
+            arrays[arrayName] = view
+
+        self.pdbids = getStrings(arrays, "pdbid")
+        self.pmcids = getStrings(arrays, "pmcid")
+        self.details = getStrings(arrays, "details")
+        self.methods = getStrings(arrays, "method")
+        self.pH = arrays["pH"]
+        self.temperature = arrays["temperature"]
+        self.resolution = arrays["resolution"]
+        self.sortedPdbids = arrays["sortedPdbids"] # Structure indices in order of pdbid, for binary search
+        self.sequenceStarts = arrays["sequenceStarts"] # The sequences of structure i are sequences[sequenceStarts[i]:sequenceStarts[i+1]]
+        self.sequences = getStrings(arrays, "sequence")
+        self.compoundNames = getStrings(arrays, "compoundName") # Sorted, so names can be found by binary search
+        self.entryStarts = arrays["entryStarts"] # The compounds of structure i are entries entryStarts[i] to entryStarts[i+1]
+        self.entryCompounds = arrays["entryCompounds"] # Compound id of each entry
+        self.concentrations = getStrings(arrays, "concentration") # Concentration string of each entry
+        self.concentrationValues = arrays["concentrationValue"] # Concentration of each entry as a number (NaN if unknown)
+        self.postingStarts = arrays["postingStarts"] # The structures containing compound c are postings[postingStarts[c]:postingStarts[c+1]]
+        self.postings = arrays["postings"]
+
+    @classmethod
+    def publish(cls, structureList, name=None): # SharedDatabase
+        """Copies a list of structures into a new shared memory block and returns the database
+        The returned database owns the block: call unlink when the workers are done with it"""
+        data = buildArrays(structureList)
+        header = {"count": len(structureList), "arrays": {}}
+        # The header holds the offsets of the arrays, which depend on the length of the header, so leave room for it
+        offset = 0
+        for arrayName, values in data.items():
+            header["arrays"][arrayName] = [offset, values.typecode, len(values) * values.itemsize]
+            offset += roundUp(len(values) * values.itemsize)
+        headerBytes = json.dumps(header).encode("utf-8")
+        dataStart = roundUp(HEADER_LENGTH_SIZE + len(headerBytes) + 32 * len(data))
+        for arrayName in header["arrays"]:
+            header["arrays"][arrayName][0] += dataStart
+        headerBytes = json.dumps(header).encode("utf-8")
+
+        memory = shared_memory.SharedMemory(name=name, create=True, size=max(dataStart + offset, 1))
+        buffer = memory.buf
+        buffer[:HEADER_LENGTH_SIZE] = len(headerBytes).to_bytes(HEADER_LENGTH_SIZE, "little")
+        buffer[HEADER_LENGTH_SIZE:HEADER_LENGTH_SIZE+len(headerBytes)] = headerBytes
+        for arrayName, values in data.items():
+            start, typecode, size = header["arrays"][arrayName]
+            buffer[start:start+size] = values.tobytes()
+        del buffer
+        name = memory.name
+        memory.close()
+        print("Published {} structures to shared memory block {} ({:.1f} MB)".format(len(structureList), name, (dataStart + offset) / 1e6))
+        return cls(name, owner=True)
+
+    @property
+    def name(self): # string
+        return self.memory.name
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i): # StructureView
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("structure index out of range")
+        return StructureView(self, i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield StructureView(self, i)
+
+    def getIndex(self, pdbid): # int
+        """Returns the index of the structure with a pdbid, or None if there is none"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.pdbids[self.sortedPdbids[middle]] < pdbid:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.pdbids[self.sortedPdbids[low]] == pdbid:
+            return self.sortedPdbids[low]
+        return None
+
+    def getStructure(self, pdbid): # StructureView
+        """Returns the structure with a pdbid, or None if there is none"""
+        i = self.getIndex(pdbid)
+        return StructureView(self, i) if i != None else None
+
+    def getCompoundId(self, name): # int
+        """Returns the id of a compound name, or None if no structure contains it"""
+        i = bisect.bisect_left(self.compoundNames, name)
+        if i < len(self.compoundNames) and self.compoundNames[i] == name:
+            return i
+        return None
+
+    def getStructuresWithCompounds(self, compoundList): # list
+        """Returns a list of StructureViews of the structures which contain every compound in compoundList"""
+        compoundIds = [self.getCompoundId(name) for name in set(compoundList)]
+        if compoundIds == [] or None in compoundIds:
+            return []
+        # Start with the rarest compound, and keep the structures which also contain the others
+        compoundIds.sort(key=lambda c: self.postingStarts[c+1] - self.postingStarts[c])
+        indices = set(self.postings[self.postingStarts[compoundIds[0]]:self.postingStarts[compoundIds[0]+1]])
+        for c in compoundIds[1:]:
+            indices &= set(self.postings[self.postingStarts[c]:self.postingStarts[c+1]])
+        return [StructureView(self, i) for i in sorted(indices)]
+
+    def getCompoundCounts(self): # dictionary
+        """Returns a dictionary mapping every compound name to the number of structures containing it"""
+        return {self.compoundNames[c]: self.postingStarts[c+1] - self.postingStarts[c] for c in range(len(self.compoundNames))}
+
+    def close(self):
+        """Detaches from the block. StructureViews of this database can not be used afterwards"""
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.memory.close()
+
+    def unlink(self):
+        """Detaches from the block and frees it. Only the publishing process should call this"""
+        self.close()
+        self.memory.unlink()
+
+class StructureView:
+    """A read-only view of one structure in a SharedDatabase, with the same fields as a Structure
+    Fields are read from shared memory when they are used, so views are cheap to create"""
+
+    __slots__ = ("database", "index")
+
+    def __init__(self, database, index):
+        self.database = database
+        self.index = index
+
+    @property
+    def pdbid(self):
+        return self.database.pdbids[self.index]
+
+    @property
+    def pmcid(self):
+        return self.database.pmcids[self.index]
+
+    @property
+    def details(self):
+        return self.database.details[self.index]
+
+    @property
+    def method(self):
+        return self.database.methods[self.index]
+
+    @property
+    def pH(self):
+        return getNumber(self.database.pH[self.index])
+
+    @property
+    def temperature(self):
+        return getNumber(self.database.temperature[self.index])
+
+    @property
+    def resolution(self):
+        return getNumber(self.database.resolution[self.index])
+
+    @property
+    def sequences(self): # list
+        database = self.database
+        return [database.sequences[i] for i in range(database.sequenceStarts[self.index], database.sequenceStarts[self.index+1])]
+
+    @property
+    def compounds(self): # list
+        """The compounds list, in the same [name, concentration, name, concentration...] format as Structure.compounds"""
+        database = self.database
+        output = []
+        for entry in range(database.entryStarts[self.index], database.entryStarts[self.index+1]):
+            output.append(database.compoundNames[database.entryCompounds[entry]])
+            output.append(database.concentrations[entry])
+        return output
+
+    def toStructure(self): # Structure
+        """Returns a regular (writable) Structure with a copy of this structure's fields"""
+        structure = Structure(self.pdbid, self.pmcid, self.details, [], self.pH, self.temperature, self.method, self.sequences, self.resolution)
+        structure.compounds = self.compounds
+        return structure
+
+    def __str__(self):
+        return str(self.toStructure())
+
+def buildArrays(structureList): # dictionary
+    """Returns a dictionary mapping array names to the arrays stored in the shared memory block"""
+    data = {}
+    addStrings(data, "pdbid", [s.pdbid for s in structureList])
+    addStrings(data, "pmcid", [s.pmcid for s in structureList])
+    addStrings(data, "details", [s.details for s in structureList])
+    addStrings(data, "method", [s.method for s in structureList])
+    for field in ("pH", "temperature", "resolution"):
+        data[field] = array("d", (getattr(s, field) if getattr(s, field) != None else math.nan for s in structureList))
+    data["sortedPdbids"] = array("q", sorted(range(len(structureList)), key=lambda i: structureList[i].pdbid))
+
+    sequenceStarts = array("q", [0])
+    sequences = []
+    for structure in structureList:
+        sequences.extend(structure.sequences)
+        sequenceStarts.append(len(sequences))
+    data["sequenceStarts"] = sequenceStarts
+    addStrings(data, "sequence", sequences)
+
+    compoundNames = sorted({name for s in structureList for name in s.compounds[::2]})
+    compoundIds = {name: i for i, name in enumerate(compoundNames)}
+    addStrings(data, "compoundName", compoundNames)
+    entryStarts = array("q", [0])
+    entryCompounds = array("q")
+    concentrations = []
+    postingLists = [[] for name in compoundNames]
+    for i, structure in enumerate(structureList):
+        for j in range(0, len(structure.compounds), 2):
+            compoundId = compoundIds[structure.compounds[j]]
+            entryCompounds.append(compoundId)
+            concentrations.append(structure.compounds[j+1])
+            if postingLists[compoundId] == [] or postingLists[compoundId][-1] != i:
+                postingLists[compoundId].append(i)
+        entryStarts.append(len(entryCompounds))
+    data["entryStarts"] = entryStarts
+    data["entryCompounds"] = entryCompounds
+    addStrings(data, "concentration", concentrations)
+    data["concentrationValue"] = array("d", (parseConcentration(c)[0] if parseConcentration(c)[0] != None else math.nan for c in concentrations))
+
+    postingStarts = array("q", [0])
+    postings = array("q")
+    for postingList in postingLists:
+        postings.extend(postingList)
+        postingStarts.append(len(postings))
+    data["postingStarts"] = postingStarts
+    data["postings"] = postings
+    return data
+
+def addStrings(data, name, strings):
+    """Adds the arrays of a SharedStrings (pool, offsets and null flags) for a list of strings to data"""
+    offsets = array("q", [0])
+    nulls = array("B")
+    pool = bytearray()
+    for string in strings:
+        if string != None:
+            pool += string.encode("utf-8")
+        nulls.append(string == None)
+        offsets.append(len(pool))
+    data[name + "Pool"] = array("B", pool)
+    data[name + "Offsets"] = offsets
+    data[name + "Nulls"] = nulls
+
+def getStrings(arrays, name): # SharedStrings
+    return SharedStrings(arrays[name + "Pool"], arrays[name + "Offsets"], arrays[name + "Nulls"])
+
+def getNumber(value): # float
+    """Converts the NaN used for missing numbers back to None"""
+    return None if math.isnan(value) else value
+
+def roundUp(size): # int
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def attachWorker(name):
+    """Attaches the current process to a published database. Use as the initializer of a multiprocessing.Pool:
+        Pool(workers, initializer=attachWorker, initargs=(database.name,))
+    The worker's functions can then read the database with getWorkerDatabase()"""
+    global workerDatabase
+    workerDatabase = SharedDatabase(name)
+
+def getWorkerDatabase(): # SharedDatabase
+    return workerDatabase
+
+def getRss(): # int
+    """Returns the resident memory of the current process in kilobytes (Linux only, otherwise the peak resident memory)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (FileNotFoundError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def countCompounds(structures, chunk): # tuple
+    """Counts the compounds of a range of structures, and returns the counts and the memory used by the worker"""
+    counts = {}
+    for i in range(*chunk):
+        for name in structures[i].compounds[::2]:
+            counts[name] = counts.get(name, 0) + 1
+    return (counts, getRss())
+
+def countCompoundsWorker(chunk): # tuple
+    """Example worker: counts the compounds in a range of the shared database"""
+    return countCompounds(getWorkerDatabase(), chunk)
+
+def countCompoundsCopyWorker(structureFile, chunk): # tuple
+    """The same as countCompoundsWorker, but with the worker's own copy of the structure file (for comparison)"""
+    return countCompounds(loadStructures(structureFile), chunk)
+
+def benchmarkWorkers(structureFile=STRUCTURES_FILE, workerCounts=(1, 2, 4, 8)):
+    """Counts compounds with pools of workers, once attached to a shared database and once with every worker loading
+    the structure file, and prints the memory used by the workers
+    With the shared database the memory of each worker stays about the same as workers are added"""
+    from multiprocessing import get_context
+    context = get_context("spawn") # Spawned workers start empty, where forked workers would inherit the memory of this process
+    database = SharedDatabase.publish(loadStructures(structureFile))
+    try:
+        for workers in workerCounts:
+            chunkSize = len(database) // workers + 1
+            chunks = [(i, min(i + chunkSize, len(database))) for i in range(0, len(database), chunkSize)]
+            with context.Pool(workers, initializer=attachWorker, initargs=(database.name,)) as pool:
+                sharedMemory = max(rss for counts, rss in pool.map(countCompoundsWorker, chunks))
+            with context.Pool(workers) as pool:
+                copyMemory = max(rss for counts, rss in pool.starmap(countCompoundsCopyWorker, [(structureFile, chunk) for chunk in chunks]))
+            print("{} workers: memory per worker {:.1f} MB shared, {:.1f} MB with copies (total {:.1f} MB vs {:.1f} MB)".format(
+                workers, sharedMemory / 1024, copyMemory / 1024, sharedMemory * workers / 1024, copyMemory * workers / 1024))
+    finally:
+        database.unlink()
+
+if __name__ == "__main__":
+    benchmarkWorkers(STRUCTURES_FILE)
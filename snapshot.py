@@ -0,0 +1,258 @@
+import lzma, zlib, pickle, os, bisect
+from time import perf_counter
+from pdb_crystal_database import Structure, loadStructures, STRUCTURES_FILE, STRUCTURE_DIR
+
+SNAPSHOT_FILE = STRUCTURE_DIR / "structures.snapshot"
+
+MAGIC = b"PDBSNAP1"
+FOOTER_POSITION_SIZE = 8 # The last bytes of the file hold the position of the footer
+RECORD_BLOCK_SIZE = 1000 # Structures per compressed record block
+POOL_BLOCK_SIZE = 500 # Strings per compressed pool block
+BLOCK_CACHE_SIZE = 16 # Decompressed blocks kept in memory by a reader
+
+# Compression used for the blocks, identified by the byte after MAGIC
+# zlib loads several times faster, lzma makes the smallest files (useful for archiving snapshots)
+COMPRESSORS = {b"x": (lzma.compress, lzma.decompress), b"z": (lambda data: zlib.compress(data, 9), zlib.decompress)}
+COMPRESSION_CODES = {"lzma": b"x", "zlib": b"z"}
+DEFAULT_COMPRESSION = "zlib"
+
+class SnapshotWriter:
+    """Writes a compressed snapshot of a structure list
+    Repeated strings (sequences, details, methods, compound names and concentrations) are stored once in a shared pool,
+    and structures refer to them by number. Structures and pool strings are written in blocks which are compressed (lzma or zlib)
+    separately, so a reader can decompress only the blocks it needs. Blocks are written as soon as they are full,
+    so structures can be added one at a time without holding the whole list in memory"""
+
+    def __init__(self, snapshotFile=SNAPSHOT_FILE, compression=DEFAULT_COMPRESSION):
+        self.snapshotFile = snapshotFile
+        self.temporaryFile = str(snapshotFile) + ".tmp"
+        code = COMPRESSION_CODES[compression]
+        self.compress = COMPRESSORS[code][0]
+        self.file = open(self.temporaryFile, "wb")
+        self.file.write(MAGIC + code)
+        self.poolIds = {} # Maps a string to its number in the pool
+        self.poolBuffer = [] # Pool strings which are not written yet
+        self.poolBlocks = [] # [position, length] of each pool block
+        self.recordBuffer = [] # Records which are not written yet
+        self.recordBlocks = [] # [position, length] of each record block
+        self.pdbids = [] # The pdbid of every structure, in order
+        self.count = 0
+
+    def intern(self, string): # int
+        """Returns the pool number of a string (None for None), adding it to the pool if it is new"""
+        if string == None:
+            return None
+        poolId = self.poolIds.get(string)
+        if poolId == None:
+            poolId = len(self.poolIds)
+            self.poolIds[string] = poolId
+            self.poolBuffer.append(string)
+            if len(self.poolBuffer) == POOL_BLOCK_SIZE:
+                self.poolBlocks.append(self.writeBlock(self.poolBuffer))
+                self.poolBuffer = []
+        return poolId
+
+    def writeBlock(self, items): # list
+        """Compresses and writes a list, and returns its [position, length] in the file"""
+        data = self.compress(pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL))
+        position = self.file.tell()
+        self.file.write(data)
+        return [position, len(data)]
+
+    def addStructure(self, structure):
+        compounds = []
+        for i in range(0, len(structure.compounds), 2):
+            compounds.append(self.intern(structure.compounds[i]))
+            compounds.append(self.intern(structure.compounds[i+1]))
+        self.recordBuffer.append((structure.pdbid, structure.pmcid, self.intern(structure.details), compounds, structure.pH,
+            structure.temperature, self.intern(structure.method), [self.intern(s) for s in structure.sequences], structure.resolution))
+        self.pdbids.append(structure.pdbid)
+        self.count += 1
+        if len(self.recordBuffer) == RECORD_BLOCK_SIZE:
+            self.recordBlocks.append(self.writeBlock(self.recordBuffer))
+            self.recordBuffer = []
+
+    def addStructures(self, structureList):
+        for structure in structureList:
+            self.addStructure(structure)
+
+    def close(self):
+        """Writes the remaining blocks and the footer, and moves the snapshot into place"""
+        if self.poolBuffer != []:
+            self.poolBlocks.append(self.writeBlock(self.poolBuffer))
+        if self.recordBuffer != []:
+            self.recordBlocks.append(self.writeBlock(self.recordBuffer))
+        footer = {"count": self.count, "poolSize": len(self.poolIds), "poolBlocks": self.poolBlocks, "recordBlocks": self.recordBlocks, "pdbids": self.pdbids}
+        footerPosition = self.file.tell()
+        self.file.write(self.compress(pickle.dumps(footer, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.file.write(footerPosition.to_bytes(FOOTER_POSITION_SIZE, "little"))
+        self.file.close()
+        os.replace(self.temporaryFile, self.snapshotFile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, tb):
+        if exceptionType == None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.temporaryFile)
+
+class SnapshotReader:
+    """Reads structures from a snapshot written by SnapshotWriter
+    Only the footer is read when the snapshot is opened. Reading one structure decompresses only its record block
+    and the pool blocks it refers to, and recently used blocks are cached"""
+
+    def __init__(self, snapshotFile=SNAPSHOT_FILE):
+        self.file = open(snapshotFile, "rb")
+        header = self.file.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC or header[len(MAGIC):] not in COMPRESSORS:
+            self.file.close()
+            raise ValueError("{} is not a structure snapshot".format(snapshotFile))
+        self.decompress = COMPRESSORS[header[len(MAGIC):]][1]
+        self.file.seek(-FOOTER_POSITION_SIZE, os.SEEK_END)
+        footerEnd = self.file.tell()
+        footerPosition = int.from_bytes(self.file.read(FOOTER_POSITION_SIZE), "little")
+        footer = pickle.loads(self.decompress(self.readBytes(footerPosition, footerEnd - footerPosition)))
+        self.count = footer["count"]
+        self.poolSize = footer["poolSize"]
+        self.poolBlocks = footer["poolBlocks"]
+        self.recordBlocks = footer["recordBlocks"]
+        self.pdbids = footer["pdbids"]
+        self.sortedPdbids = sorted(range(self.count), key=lambda i: self.pdbids[i]) # Structure numbers in order of pdbid
+        self.blockCache = {} # Maps ("pool" or "record", block number) to a decompressed block, in order of use
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readBytes(self, position, length): # bytes
+        self.file.seek(position)
+        return self.file.read(length)
+
+    def getBlock(self, kind, number): # list
+        key = (kind, number)
+        block = self.blockCache.pop(key, None)
+        if block == None:
+            position, length = (self.poolBlocks if kind == "pool" else self.recordBlocks)[number]
+            block = pickle.loads(self.decompress(self.readBytes(position, length)))
+            if len(self.blockCache) >= BLOCK_CACHE_SIZE:
+                del self.blockCache[next(iter(self.blockCache))] # Remove the least recently used block
+        self.blockCache[key] = block
+        return block
+
+    def getString(self, poolId): # string
+        if poolId == None:
+            return None
+        return self.getBlock("pool", poolId // POOL_BLOCK_SIZE)[poolId % POOL_BLOCK_SIZE]
+
+    def getStructure(self, i): # Structure
+        """Returns structure number i of the snapshot"""
+        if not 0 <= i < self.count:
+            raise IndexError("structure index out of range")
+        record = self.getBlock("record", i // RECORD_BLOCK_SIZE)[i % RECORD_BLOCK_SIZE]
+        return makeStructure(record, self.getString)
+
+    def getIndex(self, pdbid): # int
+        """Returns the number of the structure with a pdbid, or None if there is none"""
+        position = bisect.bisect_left(SortedPdbids(self), pdbid)
+        if position < self.count and self.pdbids[self.sortedPdbids[position]] == pdbid:
+            return self.sortedPdbids[position]
+        return None
+
+    def getStructureByPdbid(self, pdbid): # Structure
+        """Returns the structure with a pdbid, or None if there is none"""
+        i = self.getIndex(pdbid)
+        return self.getStructure(i) if i != None else None
+
+    def getPool(self): # list
+        """Decompresses and returns the whole string pool"""
+        pool = []
+        for number in range(len(self.poolBlocks)):
+            position, length = self.poolBlocks[number]
+            pool.extend(pickle.loads(self.decompress(self.readBytes(position, length))))
+        return pool
+
+    def iterStructures(self): # generator
+        """Yields every structure in order, decompressing each block once
+        Repeated strings are shared between the structures instead of being copied"""
+        pool = self.getPool()
+        getString = lambda poolId: pool[poolId] if poolId != None else None
+        for position, length in self.recordBlocks:
+            for record in pickle.loads(self.decompress(self.readBytes(position, length))):
+                yield makeStructure(record, getString)
+
+class SortedPdbids:
+    """Lets bisect search the pdbids of a SnapshotReader in sorted order"""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.count
+
+    def __getitem__(self, i):
+        return self.reader.pdbids[self.reader.sortedPdbids[i]]
+
+def makeStructure(record, getString): # Structure
+    """Creates a Structure from a snapshot record, using getString to look up pool numbers"""
+    pdbid, pmcid, details, compounds, pH, temperature, method, sequences, resolution = record
+    structure = Structure(pdbid, pmcid, getString(details), [], pH, temperature, getString(method), [getString(s) for s in sequences], resolution)
+    structure.compounds = [getString(c) for c in compounds]
+    return structure
+
+def writeSnapshot(structureList, snapshotFile=SNAPSHOT_FILE, compression=DEFAULT_COMPRESSION):
+    """Writes a list (or any iterable) of structures to a snapshot file
+    compression is "zlib" (faster to load) or "lzma" (smallest, for archiving)"""
+    print("Writing snapshot {}...".format(snapshotFile))
+    with SnapshotWriter(snapshotFile, compression) as writer:
+        writer.addStructures(structureList)
+
+def loadSnapshot(snapshotFile=SNAPSHOT_FILE): # list
+    """Returns the list of structures in a snapshot file"""
+    print("Loading snapshot {}...".format(snapshotFile))
+    with SnapshotReader(snapshotFile) as reader:
+        return list(reader.iterStructures())
+
+def convertPickleToSnapshot(structureFile=STRUCTURES_FILE, snapshotFile=SNAPSHOT_FILE, compression=DEFAULT_COMPRESSION):
+    writeSnapshot(loadStructures(structureFile), snapshotFile, compression)
+
+def benchmarkSnapshot(structureFile=STRUCTURES_FILE, snapshotFile=SNAPSHOT_FILE, compression=DEFAULT_COMPRESSION, lookups=1000):
+    """Prints the size and load time of a pickled structure file and of its snapshot, and the time to read single structures"""
+    start = perf_counter()
+    structureList = loadStructures(structureFile)
+    pickleTime = perf_counter() - start
+    start = perf_counter()
+    writeSnapshot(structureList, snapshotFile, compression)
+    writeTime = perf_counter() - start
+    start = perf_counter()
+    snapshotList = loadSnapshot(snapshotFile)
+    snapshotTime = perf_counter() - start
+    if [s.__dict__ for s in snapshotList] != [s.__dict__ for s in structureList]:
+        print("ERROR: The snapshot does not match the structure file")
+
+    pdbids = [structure.pdbid for structure in structureList[::max(len(structureList) // lookups, 1)]]
+    start = perf_counter()
+    with SnapshotReader(snapshotFile) as reader:
+        for pdbid in pdbids:
+            reader.getStructureByPdbid(pdbid)
+    lookupTime = perf_counter() - start
+
+    pickleSize = os.path.getsize(structureFile)
+    snapshotSize = os.path.getsize(snapshotFile)
+    print("Pickle:        {:10.1f} MB, loaded in {:.2f} s".format(pickleSize / 1e6, pickleTime))
+    print("Snapshot ({}): {:10.1f} MB, loaded in {:.2f} s (written in {:.2f} s)".format(compression, snapshotSize / 1e6, snapshotTime, writeTime))
+    print("Size reduced {:.1f}x. Single structures read in {:.2f} ms on average".format(pickleSize / snapshotSize, lookupTime / len(pdbids) * 1000))
+
+if __name__ == "__main__":
+    benchmarkSnapshot(STRUCTURES_FILE, SNAPSHOT_FILE, "zlib")
+    # benchmarkSnapshot(STRUCTURES_FILE, SNAPSHOT_FILE, "lzma")
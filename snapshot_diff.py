@@ -0,0 +1,156 @@
+import json, hashlib, os
+from pathlib import Path
+from time import time, perf_counter
+from pdb_crystal_database import Structure, STRUCTURES_FILE, STRUCTURE_DIR, OUTPUT_DIR
+
+HASH_MANIFEST_FILE = STRUCTURE_DIR / "structure_hashes.json"
+CHANGELOG_FILE = OUTPUT_DIR / "changelog.json"
+
+HASH_LENGTH = 16 # Hex characters of each hash kept in a manifest (64 bits, plenty to tell revisions of one pdbid apart)
+
+# Parts of a manifest entry
+CONTENT, DETAILS, METADATA, COMPOUNDS = range(4)
+CHANGE_TYPES = ["added", "removed", "detailsChanged", "metadataChanged", "compoundsChanged"]
+
+def getHashes(structure): # list
+    """Returns the manifest entry of a structure: its content hash, and hashes of its details,
+    its other fetched fields (pmcid, pH, temperature, method, sequences and resolution) and its compounds"""
+    metadata = [structure.pmcid, structure.pH, structure.temperature, structure.method, structure.sequences, structure.resolution]
+    return [structure.getContentHash()[:HASH_LENGTH],
+        hashlib.sha256(json.dumps(structure.details).encode()).hexdigest()[:HASH_LENGTH],
+        hashlib.sha256(json.dumps(metadata).encode()).hexdigest()[:HASH_LENGTH],
+        structure.getCompoundsHash()[:HASH_LENGTH]]
+
+def buildManifest(source=STRUCTURES_FILE, chunkSize=5000): # dictionary
+    """Returns a manifest mapping every pdbid of a structure list or structure file to its hashes (see getHashes)
+    Structure files are read one chunk at a time (see chunked_processing.py)"""
+    manifest = {}
+    if isinstance(source, list):
+        for structure in source:
+            manifest[structure.pdbid] = getHashes(structure)
+    else:
+        from chunked_processing import iterStructureChunks
+        for chunk in iterStructureChunks(source, chunkSize):
+            for structure in chunk:
+                manifest[structure.pdbid] = getHashes(structure)
+    return manifest
+
+def writeManifest(manifest, manifestFile=HASH_MANIFEST_FILE):
+    temporaryFile = str(manifestFile) + ".tmp"
+    with open(temporaryFile, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(temporaryFile, manifestFile)
+
+def loadManifest(manifestFile=HASH_MANIFEST_FILE): # dictionary
+    with open(manifestFile) as f:
+        return json.load(f)
+
+def getManifest(source): # dictionary
+    """Returns the manifest of a structure list, a structure file, or a saved manifest (.json) as it is"""
+    if isinstance(source, dict):
+        return source
+    if not isinstance(source, list) and Path(source).suffix == ".json":
+        return loadManifest(source)
+    return buildManifest(source)
+
+def diffManifests(oldManifest, newManifest): # dictionary
+    """Compares two manifests in one pass over each and returns a dictionary mapping every change type
+    (see CHANGE_TYPES) to a sorted list of pdbids. A pdbid can be in several of the "changed" lists"""
+    diff = {changeType: [] for changeType in CHANGE_TYPES}
+    for pdbid, newHashes in newManifest.items():
+        oldHashes = oldManifest.get(pdbid)
+        if oldHashes == None:
+            diff["added"].append(pdbid)
+        elif oldHashes[CONTENT] != newHashes[CONTENT]:
+            if oldHashes[DETAILS] != newHashes[DETAILS]:
+                diff["detailsChanged"].append(pdbid)
+            if oldHashes[METADATA] != newHashes[METADATA]:
+                diff["metadataChanged"].append(pdbid)
+            if oldHashes[COMPOUNDS] != newHashes[COMPOUNDS]:
+                diff["compoundsChanged"].append(pdbid)
+    for pdbid in oldManifest:
+        if pdbid not in newManifest:
+            diff["removed"].append(pdbid)
+    for changeType in CHANGE_TYPES:
+        diff[changeType].sort()
+    return diff
+
+def diffSnapshots(oldSource, newSource): # dictionary
+    """Returns the diff (see diffManifests) between two structure lists, structure files or saved manifests"""
+    return diffManifests(getManifest(oldSource), getManifest(newSource))
+
+def getChangedPdbids(diff): # set
+    """Returns the pdbids which were added or changed in any way"""
+    return set(diff["added"]) | set(diff["detailsChanged"]) | set(diff["metadataChanged"]) | set(diff["compoundsChanged"])
+
+def makeChangelog(diff, newStructureList=None): # dictionary
+    """Returns a changelog of a diff: the counts and pdbids of every change type
+    If newStructureList is not None, the changelog also holds the new version of every added or changed structure,
+    so a consumer can apply it to the old structure list with applyChangelog instead of reloading everything"""
+    changelog = {"created": time(), "counts": {changeType: len(diff[changeType]) for changeType in CHANGE_TYPES}}
+    changelog.update(diff)
+    if newStructureList != None:
+        changed = getChangedPdbids(diff)
+        changelog["structures"] = [structure.__dict__ for structure in newStructureList if structure.pdbid in changed]
+    return changelog
+
+def writeChangelog(changelog, changelogFile=CHANGELOG_FILE):
+    print("Writing changelog to {}...".format(changelogFile))
+    with open(changelogFile, "w") as f:
+        json.dump(changelog, f, indent=1)
+
+def loadChangelog(changelogFile=CHANGELOG_FILE): # dictionary
+    with open(changelogFile) as f:
+        return json.load(f)
+
+def applyChangelog(structureList, changelog): # list
+    """Returns a structure list with a changelog (which must hold the changed structures, see makeChangelog) applied:
+    removed structures are left out, changed structures are replaced in place and added structures go at the end"""
+    if "structures" not in changelog:
+        raise ValueError("The changelog does not hold the changed structures, so it can not be applied")
+    newStructures = {}
+    for fields in changelog["structures"]:
+        structure = Structure(fields["pdbid"], fields["pmcid"], fields["details"], [], fields["pH"], fields["temperature"],
+            fields["method"], fields["sequences"], fields["resolution"])
+        structure.compounds = fields["compounds"]
+        newStructures[structure.pdbid] = structure
+    removed = set(changelog["removed"])
+    output = []
+    for structure in structureList:
+        if structure.pdbid in removed:
+            continue
+        output.append(newStructures.pop(structure.pdbid, structure))
+    output.extend(newStructures.values())
+    return output
+
+def printDiff(diff):
+    for changeType in CHANGE_TYPES:
+        pdbids = diff[changeType]
+        print("{:18s}: {:8d}  {}{}".format(changeType, len(pdbids), " ".join(pdbids[:10]), " ..." if len(pdbids) > 10 else ""))
+
+def updateChangelog(structureFile=STRUCTURES_FILE, manifestFile=HASH_MANIFEST_FILE, changelogFile=CHANGELOG_FILE, includeStructures=True): # dictionary
+    """Compares a structure file to the manifest saved by the last call (e.g. after the last refresh and reparse),
+    writes the changes to changelogFile and saves the new manifest
+    On the first call there is no manifest yet, so every structure is "added" """
+    start = perf_counter()
+    oldManifest = loadManifest(manifestFile) if os.path.exists(manifestFile) else {}
+    if includeStructures:
+        from pdb_crystal_database import loadStructures
+        structureList = loadStructures(structureFile)
+        newManifest = buildManifest(structureList)
+    else:
+        structureList = None
+        newManifest = buildManifest(structureFile)
+    diff = diffManifests(oldManifest, newManifest)
+    printDiff(diff)
+    writeChangelog(makeChangelog(diff, structureList), changelogFile)
+    writeManifest(newManifest, manifestFile)
+    print("Compared {} structures in {:.1f} s".format(len(newManifest), perf_counter() - start))
+    return diff
+
+if __name__ == "__main__":
+    # Run after each refresh and reparse (e.g. after refreshStructures and parseAllDetails)
+    updateChangelog(STRUCTURES_FILE, HASH_MANIFEST_FILE, CHANGELOG_FILE)
+
+    # Compare two structure files directly
+    # printDiff(diffSnapshots(STRUCTURE_DIR / "old_structures.pkl", STRUCTURES_FILE))
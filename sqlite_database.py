@@ -0,0 +1,231 @@
+import sqlite3
+from pathlib import Path
+from pdb_crystal_database import Structure, parseConcentration, loadStructures, STRUCTURES_FILE, STRUCTURE_DIR
+
+DATABASE_FILE = STRUCTURE_DIR / "structures.db"
+
+SQLITE_SUFFIXES = {".db", ".sqlite", ".sqlite3"}
+
+# Seconds to wait for another connection to release a lock before giving up
+LOCK_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS structures (
+    pdbid TEXT PRIMARY KEY,
+    pmcid TEXT,
+    details TEXT,
+    pH REAL,
+    temperature REAL,
+    method TEXT,
+    resolution REAL
+);
+CREATE TABLE IF NOT EXISTS compounds (
+    compound_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS structure_compounds (
+    pdbid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    compound_id INTEGER NOT NULL REFERENCES compounds(compound_id),
+    concentration TEXT,
+    value REAL,
+    units TEXT,
+    PRIMARY KEY (pdbid, position)
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    pdbid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sequence TEXT,
+    PRIMARY KEY (pdbid, position)
+);
+CREATE INDEX IF NOT EXISTS structures_ph ON structures(pH);
+CREATE INDEX IF NOT EXISTS structure_compounds_compound ON structure_compounds(compound_id);
+"""
+
+def isSqliteFile(structureFile): # boolean
+    """Returns True if a structure file name refers to a SQLite database rather than a pickle file"""
+    return Path(structureFile).suffix.lower() in SQLITE_SUFFIXES
+
+def connect(databaseFile=DATABASE_FILE): # sqlite3.Connection
+    """Opens a connection to a structure database, creating the tables if they do not exist
+    The database uses write-ahead logging, so any number of readers can query it while one process writes"""
+    connection = sqlite3.connect(str(databaseFile), timeout=LOCK_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def getCompoundIds(connection, names): # dictionary
+    """Returns a dictionary mapping compound names to their compound_id, adding any names that are not in the compounds table"""
+    names = list(set(names))
+    connection.executemany("INSERT OR IGNORE INTO compounds (name) VALUES (?)", ((name,) for name in names))
+    compoundIds = {}
+    # Stay below SQLite's limit on the number of parameters in one statement
+    for i in range(0, len(names), 500):
+        chunk = names[i:i+500]
+        for name, compoundId in connection.execute("SELECT name, compound_id FROM compounds WHERE name IN ({})".format(", ".join("?"*len(chunk))), chunk):
+            compoundIds[name] = compoundId
+    return compoundIds
+
+def insertStructures(connection, structureList):
+    """Inserts (or replaces) a list of structures using bulk executemany statements
+    Must be called inside of a transaction"""
+    structureList = list(structureList)
+    if structureList == []:
+        return
+    pdbids = [(structure.pdbid,) for structure in structureList]
+    # Remove old rows first, so that structures which lost compounds or sequences do not keep them
+    connection.executemany("DELETE FROM structure_compounds WHERE pdbid = ?", pdbids)
+    connection.executemany("DELETE FROM sequences WHERE pdbid = ?", pdbids)
+    # INSERT OR REPLACE moves replaced structures to the end, just like fetchStructures does with the structure list
+    connection.executemany("INSERT OR REPLACE INTO structures (pdbid, pmcid, details, pH, temperature, method, resolution) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((s.pdbid, s.pmcid, s.details, s.pH, s.temperature, s.method, s.resolution) for s in structureList))
+
+    compoundIds = getCompoundIds(connection, (c for s in structureList for c in s.compounds[::2]))
+    compoundRows = []
+    sequenceRows = []
+    for structure in structureList:
+        for i in range(0, len(structure.compounds), 2):
+            concentration = structure.compounds[i+1]
+            value, units = parseConcentration(concentration)
+            compoundRows.append((structure.pdbid, i//2, compoundIds[structure.compounds[i]], concentration, value, units))
+        for i, sequence in enumerate(structure.sequences):
+            sequenceRows.append((structure.pdbid, i, sequence))
+    connection.executemany("INSERT INTO structure_compounds (pdbid, position, compound_id, concentration, value, units) VALUES (?, ?, ?, ?, ?, ?)", compoundRows)
+    connection.executemany("INSERT INTO sequences (pdbid, position, sequence) VALUES (?, ?, ?)", sequenceRows)
+
+def upsertStructures(structureList, databaseFile=DATABASE_FILE, connection=None):
+    """Inserts or updates a list of structures in a single transaction, without rewriting the rest of the database
+    If connection is not None it is used instead of opening a new connection to databaseFile"""
+    ownConnection = connection == None
+    if ownConnection:
+        connection = connect(databaseFile)
+    try:
+        with connection:
+            insertStructures(connection, structureList)
+    finally:
+        if ownConnection:
+            connection.close()
+
+def deleteStructures(pdbidList, databaseFile=DATABASE_FILE, connection=None):
+    """Removes a list of pdbids from the database in a single transaction"""
+    ownConnection = connection == None
+    if ownConnection:
+        connection = connect(databaseFile)
+    try:
+        with connection:
+            rows = [(pdbid,) for pdbid in pdbidList]
+            connection.executemany("DELETE FROM structure_compounds WHERE pdbid = ?", rows)
+            connection.executemany("DELETE FROM sequences WHERE pdbid = ?", rows)
+            connection.executemany("DELETE FROM structures WHERE pdbid = ?", rows)
+    finally:
+        if ownConnection:
+            connection.close()
+
+def writeStructuresSqlite(structureList, databaseFile=DATABASE_FILE, batchSize=10000):
+    """Replaces the contents of a database with a list of structures (the SQLite version of writeStructures)
+    The whole replacement happens in one transaction, so readers never see a partially written database"""
+    print("Writing structures to database {}...".format(databaseFile))
+    connection = connect(databaseFile)
+    try:
+        with connection:
+            connection.execute("DELETE FROM structure_compounds")
+            connection.execute("DELETE FROM sequences")
+            connection.execute("DELETE FROM structures")
+            for i in range(0, len(structureList), batchSize):
+                insertStructures(connection, structureList[i:i+batchSize])
+        return True
+    finally:
+        connection.close()
+
+def readStructures(connection, where="", parameters=()): # list
+    """Returns a list of Structure objects for the rows of the structures table matching an optional SQL where clause
+    Structures are returned in the order they were inserted"""
+    structureDictionary = {}
+    for pdbid, pmcid, details, pH, temperature, method, resolution in connection.execute(
+            "SELECT pdbid, pmcid, details, pH, temperature, method, resolution FROM structures {} ORDER BY rowid".format(where), parameters):
+        structureDictionary[pdbid] = Structure(pdbid, pmcid, details, [], pH, temperature, method, [], resolution)
+
+    if structureDictionary == {}:
+        return []
+
+    # Fetch compounds and sequences for the whole table when loading everything, otherwise only for the selected pdbids
+    if where == "":
+        compoundRows = connection.execute("SELECT sc.pdbid, c.name, sc.concentration FROM structure_compounds sc "
+            "JOIN compounds c ON c.compound_id = sc.compound_id ORDER BY sc.pdbid, sc.position")
+        sequenceRows = connection.execute("SELECT pdbid, sequence FROM sequences ORDER BY pdbid, position")
+    else:
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected_pdbids (pdbid TEXT PRIMARY KEY)")
+        connection.execute("DELETE FROM selected_pdbids")
+        connection.executemany("INSERT INTO selected_pdbids (pdbid) VALUES (?)", ((pdbid,) for pdbid in structureDictionary))
+        compoundRows = connection.execute("SELECT sc.pdbid, c.name, sc.concentration FROM structure_compounds sc "
+            "JOIN selected_pdbids p ON p.pdbid = sc.pdbid JOIN compounds c ON c.compound_id = sc.compound_id ORDER BY sc.pdbid, sc.position").fetchall()
+        sequenceRows = connection.execute("SELECT s.pdbid, s.sequence FROM sequences s "
+            "JOIN selected_pdbids p ON p.pdbid = s.pdbid ORDER BY s.pdbid, s.position").fetchall()
+
+    for pdbid, name, concentration in compoundRows:
+        structure = structureDictionary[pdbid]
+        structure.compounds.append(name)
+        structure.compounds.append(concentration)
+    for pdbid, sequence in sequenceRows:
+        structureDictionary[pdbid].sequences.append(sequence)
+
+    return list(structureDictionary.values())
+
+def loadStructuresSqlite(databaseFile=DATABASE_FILE): # list
+    """Returns a list of every structure in a database (the SQLite version of loadStructures)"""
+    print("Loading structures from database {}...".format(databaseFile))
+    if not Path(databaseFile).exists():
+        raise FileNotFoundError(2, "No such file or directory", str(databaseFile))
+    connection = connect(databaseFile)
+    try:
+        return readStructures(connection)
+    finally:
+        connection.close()
+
+def getStructuresByPdbid(pdbidList, databaseFile=DATABASE_FILE): # list
+    """Returns a list of the structures in a database with a pdbid in pdbidList"""
+    connection = connect(databaseFile)
+    try:
+        pdbidList = list(set(pdbidList))
+        output = []
+        # Stay below SQLite's limit on the number of parameters in one statement
+        for i in range(0, len(pdbidList), 500):
+            chunk = pdbidList[i:i+500]
+            output.extend(readStructures(connection, "WHERE pdbid IN ({})".format(", ".join("?"*len(chunk))), chunk))
+        return output
+    finally:
+        connection.close()
+
+def getStructuresWithCompounds(compoundList, databaseFile=DATABASE_FILE): # list
+    """Returns a list of the structures in a database which contain every compound in compoundList"""
+    compoundList = list(set(compoundList))
+    if compoundList == []:
+        return []
+    connection = connect(databaseFile)
+    try:
+        where = ("WHERE pdbid IN (SELECT sc.pdbid FROM structure_compounds sc JOIN compounds c ON c.compound_id = sc.compound_id "
+            "WHERE c.name IN ({}) GROUP BY sc.pdbid HAVING COUNT(DISTINCT c.name) = ?)".format(", ".join("?"*len(compoundList))))
+        return readStructures(connection, where, compoundList + [len(compoundList)])
+    finally:
+        connection.close()
+
+def getStructuresInPhRange(minimum, maximum, databaseFile=DATABASE_FILE): # list
+    """Returns a list of the structures in a database with a pH between minimum and maximum (inclusive)"""
+    connection = connect(databaseFile)
+    try:
+        return readStructures(connection, "WHERE pH BETWEEN ? AND ?", (minimum, maximum))
+    finally:
+        connection.close()
+
+def convertPickleToSqlite(structureFile=STRUCTURES_FILE, databaseFile=DATABASE_FILE):
+    """Bulk loads every structure in a pickled structure file into a database"""
+    structureList = loadStructures(structureFile)
+    writeStructuresSqlite(structureList, databaseFile)
+    print("Converted {} structures".format(len(structureList)))
+
+if __name__ == "__main__":
+    convertPickleToSqlite(STRUCTURES_FILE, DATABASE_FILE)
+    # structureList = loadStructuresSqlite(DATABASE_FILE)
+    # print(len(getStructuresWithCompounds(["HEPES", "PEG 3350"], DATABASE_FILE)))
+    # print(len(getStructuresInPhRange(6.5, 7.5, DATABASE_FILE)))
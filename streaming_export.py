@@ -0,0 +1,161 @@
+import csv, json, gzip, os, tracemalloc
+from pathlib import Path
+from time import perf_counter
+import pdb_crystal_database as database
+from pdb_crystal_database import isSensible, STRUCTURES_FILE, STRUCTURE_DIR
+
+JSON_LINES_FILE = STRUCTURE_DIR / "sensible_structures.jsonl.gz"
+
+FIELDS = ["pdbid", "pmcid", "method", "resolution", "temperature", "pH", "details", "compounds", "sequences"]
+SUMMARY_FIELDS = ["pdbid", "pmcid", "method", "resolution", "temperature", "pH", "compounds"] # Everything except the long text fields
+
+class ExportStats:
+    """Counts the records an export wrote and measures its throughput"""
+
+    def __init__(self):
+        self.records = 0
+        self.filtered = 0 # Structures left out by a filter
+        self.characters = 0 # Characters written, before compression
+        self.seconds = 0.0
+        self.peakMemory = None # Peak MB allocated during the export, if it was measured
+
+    def __str__(self):
+        rate = self.records / self.seconds if self.seconds > 0 else 0
+        megabytes = self.characters / 1e6
+        output = "{} records ({} filtered out), {:.1f} MB in {:.1f} s: {:.0f} records/s, {:.1f} MB/s".format(self.records, self.filtered,
+            megabytes, self.seconds, rate, megabytes / self.seconds if self.seconds > 0 else 0)
+        if self.peakMemory != None:
+            output += ", {:.1f} MB peak memory".format(self.peakMemory)
+        return output
+
+def iterStructures(source=STRUCTURES_FILE, chunkSize=5000): # generator
+    """Yields the structures of a structure list or structure file one at a time
+    Structure files are read one chunk at a time (see chunked_processing.py)"""
+    if isinstance(source, list):
+        yield from source
+    else:
+        from chunked_processing import iterStructureChunks
+        for chunk in iterStructureChunks(source, chunkSize):
+            yield from chunk
+
+def getRecord(structure, fields=FIELDS): # dictionary
+    """Returns the fields of a structure as a dictionary of JSON types
+    Compounds are a list of {"name": ..., "concentration": ...} objects, like the compound elements of the xml export"""
+    record = {}
+    for field in fields:
+        if field == "compounds":
+            record["compounds"] = [{"name": structure.compounds[i], "concentration": structure.compounds[i+1]}
+                for i in range(0, len(structure.compounds), 2)]
+        else:
+            record[field] = getattr(structure, field)
+    return record
+
+def iterRecords(source=STRUCTURES_FILE, fields=FIELDS, filters=None, stats=None, chunkSize=5000): # generator
+    """Yields a record (see getRecord) for every structure of a structure list or file which passes all of the filters
+    A filter is a function which takes a structure and returns True to keep it (see makeSensibleFilter)"""
+    if filters == None:
+        filters = []
+    for structure in iterStructures(source, chunkSize):
+        if all(keep(structure) for keep in filters):
+            yield getRecord(structure, fields)
+        elif stats != None:
+            stats.filtered += 1
+
+def makeSensibleFilter(): # function
+    """Returns a filter which keeps the sensible structures (see isSensible)"""
+    dictionaryValues = set(database.compoundDictionary.values())
+    return lambda structure: isSensible(structure, dictionaryValues)
+
+def makeCompoundFilter(compound): # function
+    """Returns a filter which keeps the structures with a compound"""
+    return lambda structure: compound in structure.compounds[::2]
+
+def writeJsonLines(records, f, stats):
+    """Writes each record to an open text file as one line of JSON"""
+    for record in records:
+        line = json.dumps(record) + "\n"
+        f.write(line)
+        stats.records += 1
+        stats.characters += len(line)
+
+def writeCsvRecords(records, f, fields, stats):
+    """Writes each record to an open text file as a row of a tab-delimited csv file with a header
+    Compounds and sequences are written as JSON, so they can be read back without eval"""
+    writer = csv.writer(f, dialect='excel-tab', delimiter="\t")
+    writer.writerow(fields)
+    for record in records:
+        row = [json.dumps(record[field]) if field in ("compounds", "sequences") else record[field] for field in fields]
+        writer.writerow(row)
+        stats.records += 1
+        stats.characters += sum(len(str(value)) + 1 for value in row)
+
+def getFormat(outputFile): # tuple
+    """Returns the format ("jsonl" or "csv") and whether to gzip the output, from the suffixes of outputFile (e.g. .jsonl.gz)"""
+    suffixes = Path(outputFile).suffixes
+    compress = suffixes[-1:] == [".gz"]
+    if compress:
+        suffixes = suffixes[:-1]
+    if suffixes[-1:] in ([".jsonl"], [".json"]):
+        return "jsonl", compress
+    if suffixes[-1:] in ([".csv"], [".tsv"], [".txt"]):
+        return "csv", compress
+    raise ValueError("Unknown export format for {}. Use .jsonl or .csv, optionally followed by .gz".format(outputFile))
+
+def streamExport(source=STRUCTURES_FILE, outputFile=JSON_LINES_FILE, fields=FIELDS, filters=None, chunkSize=5000, measureMemory=False): # ExportStats
+    """Exports the structures of a structure list or file to JSON Lines (.jsonl) or tab-delimited csv (.csv),
+    gzipped if outputFile ends with .gz, one record at a time, so memory use does not grow with the number of structures
+    (unless source is a pickle file, which has to be loaded whole)
+    fields selects and orders the exported fields (see FIELDS), and filters selects the structures (see iterRecords)
+    If measureMemory is True, the peak memory of the export is measured with tracemalloc, which slows it down
+    If the export fails, the partially written file is removed and outputFile is left as it was
+    Returns the ExportStats of the export"""
+    fileFormat, compress = getFormat(outputFile)
+    fields = list(fields)
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("Unknown field: {}. The fields are {}".format(field, ", ".join(FIELDS)))
+    print("Exporting {} to {}...".format(", ".join(fields), outputFile))
+    stats = ExportStats()
+    # tracemalloc is only stopped afterwards if it was started here. If it was already running (e.g. in a profiled stage),
+    # its peak is not reset, so the peak memory may include what was allocated before the export
+    startedTracing = measureMemory and not tracemalloc.is_tracing()
+    if startedTracing:
+        tracemalloc.start()
+    startMemory = tracemalloc.get_traced_memory()[0] if measureMemory else 0
+    start = perf_counter()
+    temporaryFile = str(outputFile) + ".tmp"
+    try:
+        if compress:
+            f = gzip.open(temporaryFile, "wt", newline="", compresslevel=6)
+        else:
+            f = open(temporaryFile, "w", newline="")
+        with f:
+            records = iterRecords(source, fields, filters, stats, chunkSize)
+            if fileFormat == "jsonl":
+                writeJsonLines(records, f, stats)
+            else:
+                writeCsvRecords(records, f, fields, stats)
+        Path(temporaryFile).replace(outputFile)
+    except BaseException:
+        if os.path.exists(temporaryFile):
+            os.remove(temporaryFile)
+        raise
+    finally:
+        stats.seconds = perf_counter() - start
+        if measureMemory:
+            stats.peakMemory = (tracemalloc.get_traced_memory()[1] - startMemory) / 1e6
+        if startedTracing:
+            tracemalloc.stop()
+    print("Exported " + str(stats))
+    return stats
+
+def readJsonLines(inputFile): # generator
+    """Yields the records of a JSON Lines file written by streamExport (gzipped or not)"""
+    with (gzip.open(inputFile, "rt") if str(inputFile).endswith(".gz") else open(inputFile)) as f:
+        for line in f:
+            yield json.loads(line)
+
+if __name__ == "__main__":
+    streamExport(STRUCTURES_FILE, JSON_LINES_FILE, filters=[makeSensibleFilter()])
+    # streamExport(STRUCTURES_FILE, STRUCTURE_DIR / "sensible_summary.csv.gz", SUMMARY_FIELDS, [makeSensibleFilter()])
+    # streamExport(STRUCTURE_DIR / "structures.db", STRUCTURE_DIR / "peg_3350.jsonl", filters=[makeCompoundFilter("PEG 3350")])
@@ -0,0 +1,275 @@
+import sqlite3, pickle, os, sys, socket, threading, traceback
+from time import time, sleep
+from pdb_crystal_database import loadStructures, writeStructures, STRUCTURES_FILE, STRUCTURE_DIR
+from download_structures import loadPdb, getStructureFromRoot, getAllPdbs, WITHOUT_DETAILS_FILE
+from misc_functions import loadJson, writeJson
+
+WORK_QUEUE_FILE = STRUCTURE_DIR / "work_queue.db"
+
+LEASE_TIME = 300 # Seconds a claimed pdbid belongs to a worker before another worker may claim it
+HEARTBEAT_INTERVAL = 60 # Seconds between lease renewals by a running worker
+MAX_ATTEMPTS = 3 # Number of times a pdbid is tried before it is marked as failed
+BATCH_SIZE = 20 # Number of pdbids claimed at once
+LOCK_TIMEOUT = 60 # Seconds to wait for another process to release the database lock
+
+# States of a task
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    pdbid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    pdbid TEXT PRIMARY KEY,
+    has_details INTEGER NOT NULL,
+    structure BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks(state, lease_expires);
+"""
+
+class WorkQueue:
+    """A persistent queue of pdbids to fetch, shared by any number of worker processes through a SQLite file
+    Workers claim batches of pdbids with a lease that expires unless the worker renews it (see heartbeat), so the
+    pdbids of a crashed worker are claimed again by the others. A fetched structure is stored in the same
+    transaction that marks its pdbid as done, so a result is never lost or stored twice.
+    Each connection may only be used by one thread"""
+
+    def __init__(self, queueFile=WORK_QUEUE_FILE):
+        self.queueFile = queueFile
+        # Transactions are started explicitly, so that claims can take the write lock up front (BEGIN IMMEDIATE)
+        self.connection = sqlite3.connect(str(queueFile), timeout=LOCK_TIMEOUT, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def addPdbs(self, pdbList): # int
+        """Adds pdbids to the queue as pending tasks. pdbids already in the queue are left alone
+        Returns the number of pdbids added"""
+        with self.transaction():
+            before = self.connection.total_changes
+            self.connection.executemany("INSERT OR IGNORE INTO tasks (pdbid, state) VALUES (?, ?)", ((pdbid, PENDING) for pdbid in pdbList))
+            return self.connection.total_changes - before
+
+    def claim(self, owner, count=BATCH_SIZE, leaseTime=LEASE_TIME, maxAttempts=MAX_ATTEMPTS): # list
+        """Leases up to count pending pdbids to owner and returns them
+        Expired leases are returned to the pending state first, or marked as failed if they have used up their attempts
+        (e.g. a pdbid which crashes or hangs every worker that claims it)"""
+        now = time()
+        with self.transaction():
+            self.connection.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_owner = NULL, lease_expires = NULL, "
+                "last_error = ? WHERE state = ? AND lease_expires < ?", (maxAttempts, FAILED, PENDING, "lease expired", LEASED, now))
+            pdbids = [row[0] for row in self.connection.execute("SELECT pdbid FROM tasks WHERE state = ? LIMIT ?", (PENDING, count))]
+            self.connection.executemany("UPDATE tasks SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE pdbid = ?",
+                ((LEASED, owner, now + leaseTime, pdbid) for pdbid in pdbids))
+        return pdbids
+
+    def heartbeat(self, owner, leaseTime=LEASE_TIME): # int
+        """Renews every lease held by owner. Returns the number of leases renewed"""
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE tasks SET lease_expires = ? WHERE state = ? AND lease_owner = ?", (time() + leaseTime, LEASED, owner))
+            return cursor.rowcount
+
+    def complete(self, owner, pdbid, structure): # boolean
+        """Stores the structure fetched for a pdbid and marks it as done, in one transaction
+        Returns False (and stores nothing) if owner no longer holds the lease, since another worker may have claimed it"""
+        with self.transaction():
+            cursor = self.connection.execute("UPDATE tasks SET state = ?, lease_owner = NULL, lease_expires = NULL, last_error = NULL "
+                "WHERE pdbid = ? AND state = ? AND lease_owner = ?", (DONE, pdbid, LEASED, owner))
+            if cursor.rowcount == 0:
+                return False
+            self.connection.execute("INSERT OR REPLACE INTO results (pdbid, has_details, structure) VALUES (?, ?, ?)",
+                (pdbid, structure.details != None, pickle.dumps(structure, protocol=pickle.HIGHEST_PROTOCOL)))
+            return True
+
+    def fail(self, owner, pdbid, error, maxAttempts=MAX_ATTEMPTS):
+        """Records an error for a pdbid held by owner. The pdbid is tried again later unless it has used up its attempts"""
+        with self.transaction():
+            self.connection.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_owner = NULL, lease_expires = NULL, last_error = ? "
+                "WHERE pdbid = ? AND state = ? AND lease_owner = ?", (maxAttempts, FAILED, PENDING, str(error), pdbid, LEASED, owner))
+
+    def release(self, owner):
+        """Returns every pdbid leased to owner to the pending state, without counting the attempt"""
+        with self.transaction():
+            self.connection.execute("UPDATE tasks SET state = ?, lease_owner = NULL, lease_expires = NULL, attempts = attempts - 1 "
+                "WHERE state = ? AND lease_owner = ?", (PENDING, LEASED, owner))
+
+    def retryFailed(self):
+        """Returns every failed pdbid to the pending state with its attempts reset"""
+        with self.transaction():
+            self.connection.execute("UPDATE tasks SET state = ?, attempts = 0 WHERE state = ?", (PENDING, FAILED))
+
+    def getCounts(self): # dictionary
+        """Returns a dictionary mapping each state to the number of pdbids in it"""
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        for state, count in self.connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def getFailed(self): # list
+        """Returns a list of (pdbid, attempts, last error) tuples for the failed pdbids"""
+        return self.connection.execute("SELECT pdbid, attempts, last_error FROM tasks WHERE state = ?", (FAILED,)).fetchall()
+
+    def iterResults(self): # generator
+        """Yields every stored Structure"""
+        for (data,) in self.connection.execute("SELECT structure FROM results ORDER BY rowid"):
+            yield pickle.loads(data)
+
+class Transaction:
+    """Context manager which runs a block in a write transaction, rolling it back if an exception is raised"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exceptionType, exception, tb):
+        self.connection.execute("COMMIT" if exceptionType == None else "ROLLBACK")
+
+def getWorkerName(): # string
+    """Returns a name for this process which is unique across the machines sharing a queue"""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def heartbeatLoop(queueFile, owner, stopEvent, interval=HEARTBEAT_INTERVAL):
+    """Renews the leases of owner every interval seconds until stopEvent is set
+    Runs in its own thread, so it uses its own connection"""
+    workQueue = WorkQueue(queueFile)
+    try:
+        while not stopEvent.wait(interval):
+            workQueue.heartbeat(owner)
+    finally:
+        workQueue.close()
+
+def runWorker(queueFile=WORK_QUEUE_FILE, owner=None, batchSize=BATCH_SIZE, requestDelay=0.05, cache=None, pollInterval=HEARTBEAT_INTERVAL): # int
+    """Fetches pdbids from a work queue until none are pending or leased, storing the structures in the queue
+    Any number of workers can run at once, in separate processes or on separate machines sharing queueFile
+    pdbids leased by a crashed worker are pending again once the lease expires, and are picked up by the next claim.
+    When nothing is pending but other workers still hold leases, the worker checks again every pollInterval seconds
+    instead of exiting, so leases of a crashed worker are still picked up once every other worker has run out of work
+    On a keyboard interrupt the leases of the worker are released so other workers can take them right away
+    Returns the number of pdbids completed by this worker"""
+    if owner == None:
+        owner = getWorkerName()
+    workQueue = WorkQueue(queueFile)
+    stopEvent = threading.Event()
+    heartbeatThread = threading.Thread(target=heartbeatLoop, args=(queueFile, owner, stopEvent), daemon=True)
+    heartbeatThread.start()
+    completed = 0
+    print("Worker {} started".format(owner))
+    try:
+        while True:
+            pdbids = workQueue.claim(owner, batchSize)
+            if pdbids == []:
+                leased = workQueue.getCounts()[LEASED]
+                if leased == 0:
+                    break
+                print("Worker {}: nothing pending, waiting for {} leased pdbids...".format(owner, leased))
+                sleep(pollInterval)
+                continue
+            for pdbid in pdbids:
+                try:
+                    root = loadPdb(pdbid, cache=cache)
+                    if root == None:
+                        workQueue.fail(owner, pdbid, "No entry found or request timed out")
+                    elif workQueue.complete(owner, pdbid, getStructureFromRoot(pdbid, root)):
+                        completed += 1
+                except Exception as e:
+                    workQueue.fail(owner, pdbid, traceback.format_exc(limit=1))
+                sleep(requestDelay)
+            if cache != None:
+                cache.save()
+            print("Worker {}: {} completed, queue: {}".format(owner, completed, workQueue.getCounts()))
+    except KeyboardInterrupt:
+        print("Keyboard interrupt detected. Releasing leases of worker {}...".format(owner))
+        workQueue.release(owner)
+    finally:
+        stopEvent.set()
+        workQueue.close()
+    print("Worker {} finished after completing {} pdbids".format(owner, completed))
+    return completed
+
+def fillQueue(pdbList, queueFile=WORK_QUEUE_FILE, structureFile=STRUCTURES_FILE, ignorePdbsWithoutDetails=True, ignoreCompletedPdbs=True): # int
+    """Adds a list of pdbids to a work queue, leaving out the ones which are already done (like fetchStructures)
+    Returns the number of pdbids added"""
+    ignoredPdbs = set()
+    if ignoreCompletedPdbs:
+        try:
+            ignoredPdbs |= {structure.pdbid for structure in loadStructures(structureFile)}
+        except FileNotFoundError:
+            pass
+    if ignorePdbsWithoutDetails:
+        try:
+            ignoredPdbs |= set(loadJson(WITHOUT_DETAILS_FILE))
+        except FileNotFoundError:
+            pass
+    workQueue = WorkQueue(queueFile)
+    try:
+        added = workQueue.addPdbs(pdbid for pdbid in pdbList if pdbid not in ignoredPdbs)
+    finally:
+        workQueue.close()
+    print("Added {} pdbs to the work queue".format(added))
+    return added
+
+def collectResults(queueFile=WORK_QUEUE_FILE, structureFile=STRUCTURES_FILE, onlyDetails=True): # list
+    """Merges the structures stored in a work queue into the structure file and WITHOUT_DETAILS_FILE
+    Structures which are already in the structure file are replaced. Returns the merged list of structures"""
+    try:
+        structureList = loadStructures(structureFile)
+    except FileNotFoundError:
+        structureList = []
+    try:
+        pdbsWithoutDetails = loadJson(WITHOUT_DETAILS_FILE)
+    except FileNotFoundError:
+        pdbsWithoutDetails = []
+    structureDictionary = {structure.pdbid: structure for structure in structureList}
+    pdbsWithoutDetailsSet = set(pdbsWithoutDetails)
+
+    workQueue = WorkQueue(queueFile)
+    try:
+        count = 0
+        for structure in workQueue.iterResults():
+            count += 1
+            if structure.details == None and structure.pdbid not in pdbsWithoutDetailsSet:
+                pdbsWithoutDetails.append(structure.pdbid)
+                pdbsWithoutDetailsSet.add(structure.pdbid)
+            if structure.details != None or not onlyDetails:
+                structureDictionary[structure.pdbid] = structure
+        counts = workQueue.getCounts()
+    finally:
+        workQueue.close()
+
+    print("Collected {} results ({} pdbs still pending or leased, {} failed)".format(count, counts[PENDING] + counts[LEASED], counts[FAILED]))
+    structureList = list(structureDictionary.values())
+    writeStructures(structureList, structureFile)
+    writeJson(pdbsWithoutDetails, WITHOUT_DETAILS_FILE)
+    return structureList
+
+if __name__ == "__main__":
+    # Usage: python work_queue.py fill | work | status | collect
+    # Fill the queue once, start "work" in as many processes as you like, then collect when the queue is empty
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "fill":
+        fillQueue(getAllPdbs())
+    elif command == "work":
+        runWorker()
+    elif command == "collect":
+        collectResults()
+    else:
+        workQueue = WorkQueue()
+        print(workQueue.getCounts())
+        for pdbid, attempts, error in workQueue.getFailed()[:20]:
+            print("{} ({} attempts): {}".format(pdbid, attempts, error))
+        workQueue.close()